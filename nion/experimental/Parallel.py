@@ -0,0 +1,48 @@
+"""
+Helpers for running work on several threads.
+
+Most of the numerical work here (FFTs, interpolation, sparse products) releases the GIL, so splitting it over a few
+threads runs it in parallel. The functions take care of starting and joining the threads and of passing exceptions
+from the worker threads to the caller.
+"""
+
+import threading
+import typing
+
+_T = typing.TypeVar("_T")
+_SequenceT = typing.TypeVar("_SequenceT", bound=typing.Sequence[typing.Any])
+
+
+def distribute(items: _SequenceT, num_workers: int) -> typing.List[_SequenceT]:
+    """Return "items" split round-robin into at most "num_workers" (and at least one) parts.
+
+    Every part is a slice of "items", so a range is split into ranges.
+    """
+    num_workers = max(1, min(num_workers, len(items)))
+    return [typing.cast(_SequenceT, items[i::num_workers]) for i in range(num_workers)]
+
+
+def run_on_threads(function: typing.Callable[[_T], None], args: typing.Sequence[_T]) -> None:
+    """Call "function" once for each item of "args", each call on its own thread, and wait for all calls to finish.
+
+    A single call runs on the calling thread. If any of the calls raised an exception, the first one is raised again
+    after all calls have finished.
+    """
+    exceptions: typing.List[Exception] = list()
+
+    def run_on_thread(arg: _T) -> None:
+        try:
+            function(arg)
+        except Exception as e:
+            exceptions.append(e)
+
+    if len(args) == 1:
+        function(args[0])
+        return
+    threads = [threading.Thread(target=run_on_thread, args=(arg,)) for arg in args]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if exceptions:
+        raise exceptions[0]
@@ -0,0 +1,544 @@
+"""
+Cross-correlation based image registration for many frames of the same shape.
+
+The functions here give the same results as their counterparts in "nion.data.Core" but keep the FFT terms that only
+depend on the reference frame in a least-recently-used cache. When many frames are registered against the same
+reference (as in "measure shifts" with a fixed reference index or the multi-SI alignment), the reference spectrum is
+computed once per run instead of once per frame. Keys contain shape, dtype and a digest of the reference data, so
+a changed reference never returns stale results.
+
+The shift functions apply the measured translations with the same linear interpolation as "Core.function_shift", but
+only along the shifted axes and for many frames at once.
+"""
+
+import dataclasses
+import hashlib
+import math
+import threading
+import typing
+
+import numpy
+import numpy.typing
+import scipy.fft
+import scipy.ndimage
+
+from nion.data import DataAndMetadata
+from nion.data import TemplateMatching
+from nion.experimental import Parallel
+
+_NDArray = numpy.typing.NDArray[typing.Any]
+_DataAndMetadataLike = DataAndMetadata._DataAndMetadataLike
+_NormRectangleType = typing.Tuple[typing.Tuple[float, float], typing.Tuple[float, float]]
+_NormIntervalType = typing.Tuple[float, float]
+
+T = typing.TypeVar("T")
+
+
+class LRUCache:
+    """A thread-safe least-recently-used cache holding at most "max_entries" items.
+
+    If "max_bytes" is given, least recently used items are also evicted while the items together have more bytes (as
+    given by their "nbytes" attribute) and items that have more bytes on their own are returned but not kept.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: typing.Optional[int] = None) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries: typing.Dict[typing.Hashable, typing.Any] = dict()
+        self.__nbytes: typing.Dict[typing.Hashable, int] = dict()
+        self.__lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    @property
+    def nbytes(self) -> int:
+        with self.__lock:
+            return sum(self.__nbytes.values())
+
+    def get_or_create(self, key: typing.Hashable, create_fn: typing.Callable[[], T]) -> T:
+        with self.__lock:
+            if key in self.__entries:
+                # dicts keep insertion order, so re-inserting moves the entry to the most recently used end
+                value = self.__entries.pop(key)
+                self.__entries[key] = value
+                self.hits += 1
+                return typing.cast(T, value)
+            self.misses += 1
+        # create the value outside of the lock so that other threads are not blocked by the calculation
+        value = create_fn()
+        nbytes = int(getattr(value, "nbytes", 0))
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return value
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = value
+            self.__nbytes[key] = nbytes
+            total_bytes = sum(self.__nbytes.values())
+            while len(self.__entries) > self.max_entries or (self.max_bytes is not None and total_bytes > self.max_bytes):
+                evicted_key = next(iter(self.__entries))
+                self.__entries.pop(evicted_key)
+                total_bytes -= self.__nbytes.pop(evicted_key)
+                self.evictions += 1
+        return value
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+            self.__nbytes.clear()
+
+
+# the template match reference terms take about 24 bytes per pixel, so the byte limit allows 16 entries of up to about
+# 800 x 800 pixels and fewer of larger frames.
+registration_cache = LRUCache(16, max_bytes=256 * 1024 * 1024)
+
+
+def _data_key(data: _NDArray) -> typing.Tuple[typing.Any, ...]:
+    digest = hashlib.blake2b(numpy.ascontiguousarray(data).data, digest_size=16).digest()
+    return data.shape, data.dtype.str, digest
+
+
+class TemplateMatchReference:
+    """The terms of the normalized cross-correlation that only depend on the image (i.e. the reference frame).
+
+    "match" gives the same result as "TemplateMatching.match_template(image, template)" for templates of shape
+    "template_shape". 1d images are matched as images of width 1.
+    """
+
+    def __init__(self, image: _NDArray, template_shape: typing.Tuple[int, ...]) -> None:
+        self.ndim = image.ndim
+        if image.ndim == 1:
+            image = image[..., numpy.newaxis]
+            template_shape = tuple(template_shape) + (1,)
+        image = image.astype(numpy.float64)
+        self.image_shape = image.shape
+        self.template_shape = template_shape
+        self.fft_image = scipy.fft.fft2(image)
+        fft_image_squared = scipy.fft.fft2(image ** 2)
+        fft_image_squared_means = scipy.ndimage.fourier_uniform(fft_image_squared, template_shape)
+        image_means_squared = (scipy.fft.ifft2(scipy.ndimage.fourier_uniform(self.fft_image, template_shape)).real) ** 2
+        # use Var(X) = E(X^2) - E(X)^2 to calculate variance
+        self.image_variance = scipy.fft.ifft2(fft_image_squared_means).real - image_means_squared
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.fft_image.nbytes + self.image_variance.nbytes)
+
+    def match(self, template: _NDArray) -> _NDArray:
+        assert template.shape == self.template_shape
+        template = template.astype(numpy.float64)
+        normalized_template = template - numpy.mean(template)
+        # inverting the axis of a real image is the same as taking the conjugate of the fourier transform
+        fft_normalized_template_conj = scipy.fft.fft2(normalized_template[::-1, ::-1], s=self.image_shape)
+        fft_corr = self.fft_image * fft_normalized_template_conj
+        # we need to shift the result back by half the template size
+        shift = (int(-1 * (template.shape[0] - 1) / 2), int(-1 * (template.shape[1] - 1) / 2))
+        corr = numpy.roll(scipy.fft.ifft2(fft_corr).real, shift=shift, axis=(0, 1))
+        denom = self.image_variance * template.size * numpy.sum(normalized_template ** 2)
+        denom[denom < 0] = numpy.amax(denom)
+        ccorr = typing.cast(_NDArray, corr / numpy.sqrt(denom))
+        ccorr[ccorr > 1.1] = 0
+        return ccorr
+
+    def register(self, template: _NDArray, ccorr_mask: typing.Optional[_NDArray] = None) -> typing.Tuple[float, typing.Tuple[float, ...]]:
+        """Same as "register_template" of the image of this reference and "template".
+
+        Callers that register many templates against a reference they own can keep this object instead of looking up
+        the reference terms by a digest of the image in "registration_cache".
+        """
+        if self.ndim == 1:
+            return _locate_ccorr_max(numpy.squeeze(self.match(template[..., numpy.newaxis]), axis=1), self.image_shape[:1], ccorr_mask)
+        return _locate_ccorr_max(self.match(template), self.image_shape, ccorr_mask)
+
+
+def get_template_match_reference(image: _NDArray, template_shape: typing.Tuple[int, ...]) -> TemplateMatchReference:
+    key = ("template_match",) + _data_key(image) + (template_shape,)
+    return registration_cache.get_or_create(key, lambda: TemplateMatchReference(image, template_shape))
+
+
+def _locate_ccorr_max(ccorr: _NDArray, image_shape: typing.Tuple[int, ...], ccorr_mask: typing.Optional[_NDArray]) -> typing.Tuple[float, typing.Tuple[float, ...]]:
+    if ccorr_mask is not None:
+        ccorr *= ccorr_mask
+    error, ccoeff, max_pos = TemplateMatching.find_ccorr_max(ccorr)
+    if not error and ccoeff is not None and max_pos is not None:
+        return ccoeff, tuple(max_pos[i] - image_shape[i] // 2 for i in range(len(image_shape)))
+    return 0.0, (0.0, ) * len(image_shape)
+
+
+def register_template(image_in: _DataAndMetadataLike, template_in: _DataAndMetadataLike, ccorr_mask: typing.Optional[_NDArray] = None,
+                      use_cache: bool = True) -> typing.Tuple[float, typing.Tuple[float, ...]]:
+    """Same as "Core.function_register_template", using cached reference terms for "image_in".
+
+    Pass "use_cache=False" for images that are used only once, so that they are neither hashed nor kept in the cache.
+    """
+    image = numpy.asarray(DataAndMetadata.promote_ndarray(image_in).data)
+    template = numpy.asarray(DataAndMetadata.promote_ndarray(template_in).data)
+    assert image.ndim in (1, 2)
+    assert image.ndim == template.ndim
+    # The template needs to be the smaller of the two if they have different shape
+    assert numpy.less_equal(template.shape, image.shape).all()
+    if use_cache:
+        reference = get_template_match_reference(image, template.shape)
+    else:
+        reference = TemplateMatchReference(image, template.shape)
+    return reference.register(template, ccorr_mask)
+
+
+# least-squares fit of "c0 + c1 * y + c2 * x + c3 * y**2 + c4 * x * y + c5 * x**2" to a 3x3 neighborhood
+_quadratic_offsets = numpy.mgrid[-1:2, -1:2].reshape(2, 9).astype(numpy.float64)
+_quadratic_fit_matrix = numpy.linalg.pinv(numpy.stack([numpy.ones(9), _quadratic_offsets[0], _quadratic_offsets[1], _quadratic_offsets[0] ** 2,
+                                                       _quadratic_offsets[0] * _quadratic_offsets[1], _quadratic_offsets[1] ** 2], axis=1))
+
+
+def refine_peak(ccorr: _NDArray) -> typing.Optional[typing.Tuple[float, float]]:
+    """Return the sub-pixel position of the maximum of the 2d "ccorr", or None if the maximum is at the border.
+
+    The position is the maximum of a quadratic surface fitted to the 3x3 neighborhood of the maximum pixel. Unlike
+    separate parabolas along y and x (as in "TemplateMatching.find_ccorr_max") this is not biased for peaks that are
+    elongated along a diagonal.
+    """
+    max_pos = numpy.unravel_index(numpy.argmax(ccorr), ccorr.shape)
+    if not all(0 < p < length - 1 for p, length in zip(max_pos, ccorr.shape)):
+        return None
+    c = _quadratic_fit_matrix @ ccorr[max_pos[0] - 1:max_pos[0] + 2, max_pos[1] - 1:max_pos[1] + 2].reshape(9)
+    hessian = numpy.array(((2.0 * c[3], c[4]), (c[4], 2.0 * c[5])))
+    offset = numpy.zeros(2)
+    # only use the fit if it has a maximum, otherwise keep the maximum pixel
+    if hessian[0, 0] < 0 and numpy.linalg.det(hessian) > 0:
+        offset = numpy.clip(numpy.linalg.solve(hessian, -c[1:3]), -1.0, 1.0)
+    return float(max_pos[0] + offset[0]), float(max_pos[1] + offset[1])
+
+
+@dataclasses.dataclass
+class PatchRegistrationResult:
+    """The result of "register_patches".
+
+    "shift" and "uncertainty" are in pixels (y, x). "patch_shifts" and "patch_ccorrs" are the results of the single
+    patches and "inliers" tells which of them were used for "shift". "ccorr" is the mean correlation of the inliers or,
+    if there are none, the best correlation of all patches.
+    """
+    shift: _NDArray
+    uncertainty: _NDArray
+    ccorr: float
+    patch_shifts: _NDArray
+    patch_ccorrs: _NDArray
+    inliers: _NDArray
+
+    @property
+    def is_valid(self) -> bool:
+        return bool(numpy.any(self.inliers))
+
+
+def get_patch_slices(shape: typing.Tuple[int, ...], patch_grid: typing.Tuple[int, int] = (3, 3),
+                     patch_fraction: float = 0.5) -> typing.List[typing.Tuple[slice, slice]]:
+    """Return the slices of "patch_grid" patches that are "patch_fraction" of "shape" in size and evenly cover "shape"."""
+    patch_shape = tuple(max(1, int(length * patch_fraction)) for length in shape[:2])
+    starts = [numpy.linspace(0, length - patch_length, count).round().astype(int) if count > 1 else [(length - patch_length) // 2]
+              for length, patch_length, count in zip(shape[:2], patch_shape, patch_grid)]
+    return [(slice(int(y), int(y) + patch_shape[0]), slice(int(x), int(x) + patch_shape[1])) for y in starts[0] for x in starts[1]]
+
+
+def register_patches(reference: _NDArray, frame: _NDArray, *, patch_grid: typing.Tuple[int, int] = (3, 3),
+                     patch_fraction: float = 0.5, max_shift: float = 0.25, ccorr_threshold: float = 0.0,
+                     outlier_threshold: float = 3.0, min_spread: float = 0.5, min_uncertainty: float = 0.05,
+                     num_workers: int = 1) -> PatchRegistrationResult:
+    """Register "frame" against "reference" in several patches and combine the patch shifts to one shift.
+
+    Each patch of "frame" (see "get_patch_slices") is matched like in "register_template" in the same patch of
+    "reference" enlarged by "max_shift" times the frame shape on each side (as far as the frame allows), so the patch
+    content is fully compared for shifts up to that size. This runs on "num_workers" threads and the peak positions are
+    refined by "refine_peak". Patches that correlate worse than "ccorr_threshold" are ignored. Of the others, patches
+    whose shift is further than "outlier_threshold" robust standard deviations (from the median absolute deviation, but
+    at least "min_spread" pixels) from the median shift are rejected as outliers. The result is the mean shift of the
+    remaining patches, with the same sign as "register_template". Overlapping patches are not independent, so the
+    uncertainty is the standard deviation of their shifts rather than its standard error, but at least "min_uncertainty"
+    pixels for the precision of the peak fit. It is infinite for less than two patches.
+    """
+    assert reference.shape == frame.shape
+    assert reference.ndim == 2
+    slices = get_patch_slices(reference.shape, patch_grid, patch_fraction)
+    margins = [int(length * max_shift) for length in reference.shape]
+    patch_shifts = numpy.zeros((len(slices), 2))
+    patch_ccorrs = numpy.zeros(len(slices))
+
+    def register_patches_on_thread(indexes: range) -> None:
+        for i in indexes:
+            window_slices = tuple(slice(max(0, s.start - margin), min(length, s.stop + margin))
+                                  for s, margin, length in zip(slices[i], margins, reference.shape))
+            window = numpy.asarray(reference[window_slices])
+            frame_patch = numpy.asarray(frame[slices[i]])
+            ccorr = TemplateMatchReference(window, frame_patch.shape).match(frame_patch)
+            peak = refine_peak(ccorr)
+            # like "register_template", maxima at the border do not count
+            if peak is not None:
+                patch_ccorrs[i] = float(numpy.amax(ccorr))
+                # the position in the reference that matches the patch relative to the position of the patch
+                patch_shifts[i] = [p + w.start - s.start - (s.stop - s.start) // 2
+                                   for p, w, s in zip(peak, window_slices, slices[i])]
+
+    Parallel.run_on_threads(register_patches_on_thread, Parallel.distribute(range(len(slices)), num_workers))
+    inliers = patch_ccorrs >= max(ccorr_threshold, numpy.finfo(float).tiny)
+    if numpy.any(inliers):
+        distances = numpy.linalg.norm(patch_shifts - numpy.median(patch_shifts[inliers], axis=0), axis=1)
+        spread = max(1.4826 * float(numpy.median(distances[inliers])), min_spread / outlier_threshold)
+        inliers &= distances <= outlier_threshold * spread
+    inlier_count = int(numpy.count_nonzero(inliers))
+    if inlier_count == 0:
+        return PatchRegistrationResult(numpy.zeros(2), numpy.full(2, numpy.inf), float(numpy.amax(patch_ccorrs)),
+                                       patch_shifts, patch_ccorrs, inliers)
+    shift = numpy.mean(patch_shifts[inliers], axis=0)
+    uncertainty = numpy.maximum(numpy.std(patch_shifts[inliers], axis=0, ddof=1), min_uncertainty) if inlier_count > 1 else numpy.full(2, numpy.inf)
+    return PatchRegistrationResult(shift, uncertainty, float(numpy.mean(patch_ccorrs[inliers])), patch_shifts, patch_ccorrs, inliers)
+
+
+class CorrelationReference:
+    """The spectrum of the reference for "scipy.signal.correlate(reference, data, mode='same')".
+
+    The reference spectrum is computed on a zero-padded, FFT-friendly shape, so that "correlate" does not wrap around.
+    """
+
+    def __init__(self, reference: _NDArray) -> None:
+        self.shape = reference.shape
+        self.fft_shape = tuple(scipy.fft.next_fast_len(2 * length - 1, True) for length in self.shape)
+        self.fft_reference = scipy.fft.rfftn(reference, self.fft_shape)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.fft_reference.nbytes)
+
+    def correlate(self, data: _NDArray) -> _NDArray:
+        assert data.shape == self.shape
+        flipped = data[(slice(None, None, -1),) * data.ndim]
+        full = scipy.fft.irfftn(self.fft_reference * scipy.fft.rfftn(flipped, self.fft_shape), self.fft_shape)
+        # take the part of the full correlation that is centered and the same size as the reference
+        same_slices = tuple(slice((length - 1) // 2, (length - 1) // 2 + length) for length in self.shape)
+        return typing.cast(_NDArray, full[same_slices])
+
+
+def get_correlation_reference(reference: _NDArray) -> CorrelationReference:
+    key = ("correlation",) + _data_key(reference)
+    return registration_cache.get_or_create(key, lambda: CorrelationReference(reference))
+
+
+def register(data1_in: _DataAndMetadataLike, data2_in: _DataAndMetadataLike, subtract_means: bool,
+             bounds: typing.Optional[typing.Union[_NormRectangleType, _NormIntervalType]] = None) -> typing.Tuple[float, ...]:
+    """Same as "Core.function_register", using a cached spectrum of "data1_in"."""
+    xdata1 = DataAndMetadata.promote_ndarray(data1_in)
+    xdata2 = DataAndMetadata.promote_ndarray(data2_in)
+    # data dimensionality and descriptors should match
+    assert len(xdata1.data_shape) == len(xdata2.data_shape)
+    assert xdata1.data_descriptor == xdata2.data_descriptor
+    data1 = xdata1.data
+    data2 = xdata2.data
+    if data1 is None or data2 is None:
+        return tuple()
+    # take the slice if there is one
+    if bounds is not None:
+        d_rank = xdata1.datum_dimension_count
+        shape = data1.shape
+        bounds_pixels = numpy.rint(numpy.array(bounds) * numpy.array(shape)).astype(numpy.int_)
+        bounds_slice: typing.Optional[typing.Union[slice, typing.Tuple[slice, ...]]]
+        if d_rank == 1:
+            bounds_slice = slice(max(0, bounds_pixels[0]), min(shape[0], bounds_pixels[1]))
+        elif d_rank == 2:
+            bounds_slice = (slice(max(0, bounds_pixels[0][0]), min(shape[0], bounds_pixels[0][0]+bounds_pixels[1][0])),
+                            slice(max(0, bounds_pixels[0][1]), min(shape[1], bounds_pixels[0][1]+bounds_pixels[1][1])))
+        else:
+            bounds_slice = None
+        data1 = data1[bounds_slice]
+        data2 = data2[bounds_slice]
+    # subtract the means if desired
+    if subtract_means:
+        data1 = data1 - typing.cast(float, numpy.average(data1))
+        data2 = data2 - typing.cast(float, numpy.average(data2))
+    ccorr = get_correlation_reference(data1).correlate(data2)
+    max_pos = TemplateMatching.find_ccorr_max(ccorr)[2]
+    assert max_pos is not None
+    return tuple(max_pos[i] - data1.shape[i] * 0.5 for i in range(len(data1.shape)))
+
+
+def function_sequence_measure_relative_translation(src_in: _DataAndMetadataLike, ref_in: _DataAndMetadataLike, subtract_means: bool,
+                                                   bounds: typing.Optional[typing.Union[_NormRectangleType, _NormIntervalType]] = None) -> DataAndMetadata.DataAndMetadata:
+    """Same as "Core.function_sequence_measure_relative_translation".
+
+    The spectrum of the reference is computed only once for the whole sequence.
+    """
+    src = DataAndMetadata.promote_ndarray(src_in)
+    if not src.is_navigable:
+        raise ValueError("Sequence register translation: source must be a collection or sequence.")
+    d_rank = src.datum_dimension_count
+    if d_rank not in (1, 2):
+        raise ValueError("Sequence register translation: source must be have 1 or 2 dimension data.")
+    src_shape = tuple(src.data_shape)
+    s_shape = src_shape[0:-d_rank]
+    c = int(numpy.prod(s_shape, dtype=numpy.uint64))
+    result = numpy.empty(s_shape + (d_rank, ))
+    src_data = src._data_ex
+    for i in range(c):
+        ii = numpy.unravel_index(i, s_shape)
+        result[ii] = register(ref_in, src_data[ii], subtract_means, bounds=bounds)
+    intensity_calibration = src.dimensional_calibrations[1]  # not the sequence dimension
+    return DataAndMetadata.new_data_and_metadata(data=result, intensity_calibration=intensity_calibration, data_descriptor=DataAndMetadata.DataDescriptor(src.is_sequence, src.collection_dimension_count, 1))
+
+
+# the size in bytes of the part of a frame that is shifted at once.
+SHIFT_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def _shift_axis_linear(src: _NDArray, dst: _NDArray, axis: int, shift: float, cval: typing.Any) -> None:
+    # linear interpolation of "src" shifted by "shift" along "axis" into "dst". like "scipy.ndimage.shift" with
+    # "order=1" and mode "constant", points that come from outside of the input are set to "cval".
+    length = src.shape[axis]
+    offset = math.floor(-shift)
+    weight = -shift - offset
+    start = max(0, -offset)
+    stop = min(length, length - offset - (1 if weight > 0 else 0))
+
+    def index(start_: int, stop_: int) -> typing.Tuple[slice, ...]:
+        return (slice(None),) * axis + (slice(start_, stop_),)
+
+    if start >= stop:
+        dst[...] = cval
+        return
+    dst[index(0, start)] = cval
+    dst[index(stop, length)] = cval
+    if weight == 0:
+        dst[index(start, stop)] = src[index(start + offset, stop + offset)]
+    else:
+        numpy.multiply(src[index(start + offset, stop + offset)], 1 - weight, out=dst[index(start, stop)])
+        dst[index(start, stop)] += weight * src[index(start + offset + 1, stop + offset + 1)]
+
+
+def _shift_work_dtype(dtype: numpy.dtype[typing.Any]) -> numpy.dtype[typing.Any]:
+    # interpolate integer data in double precision so that it is rounded like scipy does
+    if numpy.issubdtype(dtype, numpy.integer):
+        return numpy.dtype(numpy.float64)
+    return numpy.result_type(dtype, numpy.float32)
+
+
+def _frame_block_keys(frame_shape: typing.Tuple[int, ...], shift_axes: typing.Sequence[int], itemsize: int,
+                      min_block_count: int = 1) -> typing.List[typing.Tuple[slice, ...]]:
+    # split a frame into blocks of at most SHIFT_BLOCK_SIZE bytes along the largest axis that is not shifted
+    other_axes = [axis for axis in range(len(frame_shape)) if axis not in shift_axes]
+    if not other_axes:
+        return [(slice(None),) * len(frame_shape)]
+    block_axis = max(other_axes, key=lambda axis: frame_shape[axis])
+    length = frame_shape[block_axis]
+    bytes_per_index = int(numpy.prod(frame_shape, dtype=numpy.int64)) // max(1, length) * itemsize
+    block_length = max(1, min(SHIFT_BLOCK_SIZE // max(1, bytes_per_index), math.ceil(length / min_block_count)))
+    return [(slice(None),) * block_axis + (slice(start, start + block_length),) for start in range(0, length, block_length)]
+
+
+def _shift_block(block: _NDArray, shift: typing.Sequence[float], shift_axes: typing.Sequence[int], cval: typing.Any) -> _NDArray:
+    # the shifted block in the work dtype, rounded for integer data
+    work_dtype = _shift_work_dtype(block.dtype)
+    if not any(shift):
+        return block.astype(work_dtype)
+    buffers = [numpy.empty(block.shape, dtype=work_dtype) for _ in range(min(2, len(shift_axes)))]
+    src = block
+    for i, (axis, axis_shift) in enumerate(zip(shift_axes, shift)):
+        dst = buffers[i % len(buffers)]
+        _shift_axis_linear(src, dst, axis, float(axis_shift), cval)
+        src = dst
+    if numpy.issubdtype(block.dtype, numpy.integer):
+        # scipy.ndimage rounds half away from zero when the output is an integer type
+        src = numpy.copysign(numpy.floor(numpy.abs(src) + 0.5), src)
+    return src
+
+
+def shift_frame(frame: _NDArray, shift: typing.Sequence[float], shift_axes: typing.Sequence[int],
+                cval: typing.Optional[typing.Any] = None, out: typing.Optional[_NDArray] = None) -> _NDArray:
+    """Shift "frame" by "shift" along "shift_axes" with linear interpolation.
+
+    Gives the same result as "Core.function_shift" with a zero shift for all other axes, but interpolates only along
+    "shift_axes", one pass per axis, in blocks along the largest of the other axes (e.g. the energy axis of a spectrum
+    image). Points that come from outside of the frame are set to "cval", which defaults to the mean of the frame.
+    """
+    if cval is None:
+        cval = numpy.mean(frame)
+    if out is None:
+        out = numpy.empty_like(frame)
+    assert out.shape == frame.shape
+    for key in _frame_block_keys(frame.shape, shift_axes, _shift_work_dtype(frame.dtype).itemsize):
+        out[key] = _shift_block(frame[key], shift, shift_axes, cval)
+    return out
+
+
+def shift_frames(data: _NDArray, shifts: _NDArray, shift_axes: typing.Sequence[int], out: typing.Optional[_NDArray] = None,
+                 num_workers: int = 1, progress_fn: typing.Optional[typing.Callable[[int, int], None]] = None) -> _NDArray:
+    """Shift all frames of "data" with "shift_frame".
+
+    The frames are indexed by the leading "shifts.shape[:-1]" axes of "data" and "shifts" has the shift of each frame
+    along "shift_axes" (relative to the frame) in its last axis. The frames are distributed to "num_workers" threads
+    and "progress_fn" is called with the number of finished frames and the total number of frames.
+    """
+    sequence_shape = shifts.shape[:-1]
+    assert tuple(data.shape[:len(sequence_shape)]) == tuple(sequence_shape)
+    assert shifts.shape[-1] == len(shift_axes)
+    if out is None:
+        out = numpy.empty_like(data)
+    frame_count = int(numpy.prod(sequence_shape, dtype=numpy.int64))
+    lock = threading.Lock()
+    finished_count = 0
+
+    def shift_frames_on_thread(indexes: range) -> None:
+        nonlocal finished_count
+        for i in indexes:
+            ii = numpy.unravel_index(i, sequence_shape)
+            shift_frame(data[ii], tuple(shifts[ii]), shift_axes, out=out[ii])
+            with lock:
+                finished_count += 1
+                if progress_fn:
+                    progress_fn(finished_count, frame_count)
+
+    Parallel.run_on_threads(shift_frames_on_thread, Parallel.distribute(range(frame_count), num_workers))
+    return out
+
+
+def sum_shifted_frames(data: _NDArray, shifts: _NDArray, shift_axes: typing.Sequence[int],
+                       weights: typing.Optional[_NDArray] = None, cval: typing.Any = 0.0, num_workers: int = 1,
+                       progress_fn: typing.Optional[typing.Callable[[int, int], None]] = None) -> _NDArray:
+    """Return the sum of all frames of "data" shifted like in "shift_frames", optionally weighted by "weights".
+
+    The shifted frames are never stored. Instead the frames are split into blocks along the largest axis that is not
+    shifted and each worker thread shifts its blocks of all frames and adds them to the sum, so the memory needed is
+    one frame for the sum plus a block per worker. "weights" has one weight per frame (shape "shifts.shape[:-1]").
+    Without weights the sum has the dtype of "numpy.sum" of the data, with weights it is floating point. "progress_fn"
+    is called with the number of finished and the total number of steps (one per frame and block).
+    """
+    sequence_shape = shifts.shape[:-1]
+    assert tuple(data.shape[:len(sequence_shape)]) == tuple(sequence_shape)
+    assert shifts.shape[-1] == len(shift_axes)
+    assert weights is None or weights.shape == sequence_shape
+    frame_shape = tuple(data.shape[len(sequence_shape):])
+    if weights is None:
+        result_dtype = numpy.sum(numpy.zeros(1, dtype=data.dtype)).dtype
+    else:
+        result_dtype = numpy.result_type(_shift_work_dtype(data.dtype), weights.dtype)
+    result = numpy.zeros(frame_shape, dtype=result_dtype)
+    frame_count = int(numpy.prod(sequence_shape, dtype=numpy.int64))
+    block_keys = _frame_block_keys(frame_shape, shift_axes, _shift_work_dtype(data.dtype).itemsize, num_workers)
+    step_count = frame_count * len(block_keys)
+    lock = threading.Lock()
+    finished_count = 0
+
+    def sum_blocks_on_thread(worker_block_keys: typing.Sequence[typing.Tuple[slice, ...]]) -> None:
+        nonlocal finished_count
+        for key in worker_block_keys:
+            for i in range(frame_count):
+                ii = numpy.unravel_index(i, sequence_shape)
+                # index frame and block at once, so that h5py reads only the block
+                shifted = _shift_block(numpy.asarray(data[tuple(ii) + tuple(key)]), tuple(shifts[ii]), shift_axes, cval)
+                if weights is not None:
+                    shifted *= weights[ii]
+                result[key] += shifted.astype(result_dtype, copy=False)
+                with lock:
+                    finished_count += 1
+                    if progress_fn:
+                        progress_fn(finished_count, step_count)
+
+    Parallel.run_on_threads(sum_blocks_on_thread, Parallel.distribute(block_keys, num_workers))
+    return result
@@ -0,0 +1,39 @@
+import threading
+import unittest
+
+from nion.experimental import Parallel
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_distribute_splits_round_robin(self):
+        self.assertEqual([range(0, 7, 3), range(1, 7, 3), range(2, 7, 3)], Parallel.distribute(range(7), 3))
+        self.assertEqual([[0], [1]], Parallel.distribute([0, 1], 4))
+        self.assertEqual([[]], Parallel.distribute([], 4))
+
+    def test_run_on_threads_runs_every_call_and_raises_first_exception(self):
+        thread_ids = dict()
+        lock = threading.Lock()
+
+        def record(indexes):
+            for i in indexes:
+                with lock:
+                    thread_ids[i] = threading.get_ident()
+
+        Parallel.run_on_threads(record, Parallel.distribute(range(10), 3))
+        self.assertEqual(set(range(10)), set(thread_ids))
+        self.assertNotIn(threading.get_ident(), thread_ids.values())
+        # a single call runs on the calling thread
+        Parallel.run_on_threads(record, [range(10, 12)])
+        self.assertEqual(threading.get_ident(), thread_ids[11])
+
+        def fail(index):
+            if index == 1:
+                raise ValueError(index)
+            record([index + 100])
+
+        with self.assertRaises(ValueError):
+            Parallel.run_on_threads(fail, range(4))
+        # the other calls still finished
+        self.assertTrue({100, 102, 103}.issubset(thread_ids))
+
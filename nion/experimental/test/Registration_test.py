@@ -0,0 +1,195 @@
+import typing
+import unittest
+
+import numpy
+import numpy.typing
+import scipy.ndimage
+
+from nion.data import Core
+from nion.data import DataAndMetadata
+
+from nion.experimental import Registration
+
+
+class CountingArray:
+    """Array wrapper that counts the elements read, like a h5py dataset that reads only the indexed hyperslab."""
+
+    def __init__(self, data: numpy.typing.NDArray[typing.Any]) -> None:
+        self.data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.ndim = data.ndim
+        self.read_count = 0
+
+    def __getitem__(self, key: typing.Any) -> numpy.typing.NDArray[typing.Any]:
+        result = numpy.array(self.data[key])
+        self.read_count += result.size
+        return result
+
+
+class TestRegistration(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.rng = numpy.random.default_rng(11)
+        self.image = scipy.ndimage.gaussian_filter(self.rng.random((48, 56)), 2)
+
+    def tearDown(self) -> None:
+        Registration.registration_cache.clear()
+
+    def test_register_template_matches_core(self) -> None:
+        mask = numpy.zeros(self.image.shape, dtype=bool)
+        mask[10:40, 12:44] = True
+        for shift in [(0.0, 0.0), (2.3, -1.7), (-4.0, 3.5)]:
+            with self.subTest(shift=shift):
+                shifted = scipy.ndimage.shift(self.image, shift)
+                self.assertEqual(Core.function_register_template(self.image, shifted), Registration.register_template(self.image, shifted))
+                self.assertEqual(Core.function_register_template(self.image, shifted, ccorr_mask=mask), Registration.register_template(self.image, shifted, ccorr_mask=mask))
+
+    def test_register_template_1d_matches_core(self) -> None:
+        line = self.image[20]
+        shifted = scipy.ndimage.shift(line, 2.5)
+        self.assertEqual(Core.function_register_template(line, shifted), Registration.register_template(line, shifted))
+
+    def test_reference_terms_are_computed_once_for_fixed_reference(self) -> None:
+        cache = Registration.registration_cache
+        misses = cache.misses
+        for shift in [(1.0, 0.0), (0.0, 1.0), (2.0, 2.0)]:
+            Registration.register_template(self.image, scipy.ndimage.shift(self.image, shift))
+        self.assertEqual(cache.misses - misses, 1)
+        Registration.register_template(self.image + 1.0, self.image)
+        self.assertEqual(cache.misses - misses, 2)
+
+    def test_refine_peak_finds_sub_pixel_maximum_of_rotated_peak(self) -> None:
+        y, x = numpy.mgrid[:9, :9]
+        dy, dx = y - 4.3, x - 3.8
+        # quadratic peak that is elongated along the diagonal
+        ccorr = 1.0 - 0.05 * (dy ** 2 + dx ** 2) - 0.04 * dy * dx
+        self.assertTrue(numpy.allclose((4.3, 3.8), Registration.refine_peak(ccorr), atol=1e-8))
+        self.assertIsNone(Registration.refine_peak(numpy.pad(ccorr[4:, 3:], ((0, 0), (0, 1)))))
+
+    def test_register_patches_rejects_outlier_patches(self) -> None:
+        image = scipy.ndimage.gaussian_filter(self.rng.random((160, 160)), 1)
+        shifted = scipy.ndimage.shift(image, (2.3, -1.7), order=3)
+        reference, frame = image[30:130, 30:130], shifted[30:130, 30:130].copy()
+        expected = Registration.register_template(reference, frame)[1]
+        result = Registration.register_patches(reference, frame, ccorr_threshold=0.4)
+        self.assertEqual(9, numpy.count_nonzero(result.inliers))
+        self.assertTrue(numpy.allclose(expected, result.shift, atol=0.1))
+        self.assertTrue(numpy.all(result.uncertainty < 0.1))
+        # identical patch shifts are not more precise than the peak fit
+        self.assertTrue(numpy.array_equal((0.05, 0.05), Registration.register_patches(reference, reference).uncertainty))
+        # a corrupted corner does not change the shift
+        frame[:50, :50] = self.rng.random((50, 50))
+        result = Registration.register_patches(reference, frame, ccorr_threshold=0.4, num_workers=4)
+        self.assertFalse(result.inliers[0])
+        self.assertTrue(result.is_valid)
+        self.assertTrue(numpy.allclose(expected, result.shift, atol=0.1))
+        self.assertTrue(numpy.array_equal(Registration.register_patches(reference, frame, ccorr_threshold=0.4, num_workers=1).patch_shifts, result.patch_shifts))
+        # nothing correlates with noise
+        result = Registration.register_patches(reference, self.rng.random(reference.shape), ccorr_threshold=0.4)
+        self.assertFalse(result.is_valid)
+        self.assertTrue(numpy.all(numpy.isinf(result.uncertainty)))
+
+    def test_sequence_measure_relative_translation_matches_core(self) -> None:
+        data = numpy.array([scipy.ndimage.shift(self.image, self.rng.normal(size=2) * 2) for _ in range(6)])
+        xdata = DataAndMetadata.new_data_and_metadata(data, data_descriptor=DataAndMetadata.DataDescriptor(True, 0, 2))
+        for bounds in [None, ((0.1, 0.2), (0.6, 0.7))]:
+            with self.subTest(bounds=bounds):
+                expected = Core.function_sequence_measure_relative_translation(xdata, xdata[2], True, bounds=bounds)
+                translations = Registration.function_sequence_measure_relative_translation(xdata, xdata[2], True, bounds=bounds)
+                self.assertEqual(translations.data_descriptor, expected.data_descriptor)
+                self.assertTrue(numpy.allclose(translations.data, expected.data, atol=1e-8))
+
+    def test_lru_cache_evicts_least_recently_used_entry(self) -> None:
+        cache = Registration.LRUCache(2)
+        cache.get_or_create("a", lambda: 1)
+        cache.get_or_create("b", lambda: 2)
+        self.assertEqual(cache.get_or_create("a", lambda: 10), 1)
+        cache.get_or_create("c", lambda: 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.get_or_create("b", lambda: 20), 20)
+        self.assertEqual(cache.get_or_create("a", lambda: 10), 10)
+
+    def test_lru_cache_evicts_entries_over_byte_budget(self) -> None:
+        cache = Registration.LRUCache(8, max_bytes=1000)
+        cache.get_or_create("a", lambda: numpy.zeros(50))
+        cache.get_or_create("b", lambda: numpy.zeros(50))
+        self.assertEqual(800, cache.nbytes)
+        cache.get_or_create("c", lambda: numpy.zeros(50))
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.evictions)
+        # too large entries are returned but not kept
+        self.assertEqual(200, cache.get_or_create("d", lambda: numpy.zeros(200)).size)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(800, cache.nbytes)
+
+    def test_register_template_without_cache(self) -> None:
+        cache = Registration.registration_cache
+        misses, length = cache.misses, len(cache)
+        shifted = scipy.ndimage.shift(self.image, (2.3, -1.7))
+        expected = Core.function_register_template(self.image, shifted)
+        self.assertEqual(expected, Registration.register_template(self.image, shifted, use_cache=False))
+        self.assertEqual((misses, length), (cache.misses, len(cache)))
+        reference = Registration.TemplateMatchReference(self.image, self.image.shape)
+        self.assertEqual(expected, reference.register(shifted))
+        self.assertEqual(reference.nbytes, 24 * self.image.size)
+        # 1d references match like "register_template"
+        line = self.image[0]
+        expected = Core.function_register_template(line, numpy.roll(line, 3))
+        self.assertEqual(expected, Registration.TemplateMatchReference(line, line.shape).register(numpy.roll(line, 3)))
+
+    def test_shift_frame_matches_core_shift_along_spatial_axes(self) -> None:
+        si = self.rng.random((12, 10, 3, 7))
+        for shift_axes in [(0, 1), (1, 2), (2, 3)]:
+            for shift in [(1.3, -2.7), (0.0, 3.0), (-0.5, 0.0), (20.0, 1.0)]:
+                with self.subTest(shift_axes=shift_axes, shift=shift):
+                    full_shift = [0.0] * si.ndim
+                    for axis, axis_shift in zip(shift_axes, shift):
+                        full_shift[axis] = axis_shift
+                    expected = Core.function_shift(si, tuple(full_shift)).data
+                    self.assertTrue(numpy.allclose(Registration.shift_frame(si, shift, shift_axes), expected, atol=1e-10))
+
+    def test_shift_frame_works_in_blocks(self) -> None:
+        si = self.rng.random((8, 9, 40)).astype(numpy.float32)
+        expected = Registration.shift_frame(si, (0.4, -1.2), (0, 1))
+        shift_block_size = Registration.SHIFT_BLOCK_SIZE
+        Registration.SHIFT_BLOCK_SIZE = 8 * 9 * 4 * 3
+        try:
+            self.assertTrue(numpy.array_equal(Registration.shift_frame(si, (0.4, -1.2), (0, 1)), expected))
+        finally:
+            Registration.SHIFT_BLOCK_SIZE = shift_block_size
+
+    def test_shift_frames_reports_progress_and_does_not_depend_on_num_workers(self) -> None:
+        data = self.rng.random((2, 3, 12, 10, 5))
+        shifts = self.rng.normal(size=(2, 3, 2)) * 2
+        progress: list[int] = list()
+        result = Registration.shift_frames(data, shifts, (0, 1), num_workers=1, progress_fn=lambda n, count: progress.append(n))
+        self.assertEqual(list(range(1, 7)), progress)
+        for i in numpy.ndindex(2, 3):
+            self.assertTrue(numpy.allclose(result[i], Core.function_shift(data[i], tuple(shifts[i]) + (0.0,)).data))
+        self.assertTrue(numpy.array_equal(result, Registration.shift_frames(data, shifts, (0, 1), num_workers=4)))
+
+    def test_sum_shifted_frames_does_not_depend_on_num_workers(self) -> None:
+        data = (self.rng.random((4, 12, 10, 9)) * 100).astype(numpy.uint16)
+        shifts = self.rng.normal(size=(4, 2)) * 2
+        expected = numpy.sum([Registration.shift_frame(frame, shift, (0, 1), cval=0.0) for frame, shift in zip(data, shifts)], axis=0)
+        progress: list[int] = list()
+        result = Registration.sum_shifted_frames(data, shifts, (0, 1), num_workers=3, progress_fn=lambda n, count: progress.append(count))
+        self.assertEqual(expected.dtype, result.dtype)
+        self.assertTrue(numpy.array_equal(expected, result))
+        self.assertEqual(progress[-1], len(progress))
+
+    def test_sum_shifted_frames_reads_each_block_only_once(self) -> None:
+        data = self.rng.random((4, 12, 10, 48))
+        shifts = self.rng.normal(size=(4, 2)) * 2
+        counting_data = CountingArray(data)
+        shift_block_size = Registration.SHIFT_BLOCK_SIZE
+        # 8 blocks along the last axis
+        Registration.SHIFT_BLOCK_SIZE = 12 * 10 * 6 * 8
+        try:
+            result = Registration.sum_shifted_frames(typing.cast(typing.Any, counting_data), shifts, (0, 1), num_workers=2)
+        finally:
+            Registration.SHIFT_BLOCK_SIZE = shift_block_size
+        self.assertEqual(data.size, counting_data.read_count)
+        self.assertTrue(numpy.allclose(Registration.sum_shifted_frames(data, shifts, (0, 1)), result))
@@ -0,0 +1,172 @@
+"""
+Client for the REST interface of AS2.
+
+The client keeps its HTTP connections open between requests (keep-alive) and runs batches of requests concurrently on
+a small pool of connections. It can be used from any thread and has asyncio versions of its methods, which run the
+requests on worker threads, so that polling AS2 does not block the UI thread.
+"""
+
+from __future__ import annotations
+import asyncio
+import http.client
+import json
+import threading
+import typing
+
+from nion.experimental import Parallel
+
+DEFAULT_PORT = 41532
+CANDIDATE_PORTS = (41532, 8090)
+
+QueryResult = typing.Tuple[typing.Mapping[str, typing.Any], str]
+Request = typing.Tuple[typing.Iterable[str], typing.Optional[typing.Mapping[str, typing.Any]]]
+
+
+def get_path(*args: str) -> str:
+    path = '/AS2'
+    for arg in args:
+        path += '/' + arg
+    return path
+
+
+class AS2Client:
+    """
+    Sends GET and PUT requests to AS2 on `host`:`port` over persistent connections.
+
+    At most `max_connections` connections are open at the same time, which is also the number of requests of a batch
+    that run concurrently.
+    """
+
+    def __init__(self, port: int=DEFAULT_PORT, host: str='localhost', max_connections: int=4):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.__lock = threading.Lock()
+        self.__connection_available = threading.Condition(self.__lock)
+        self.__idle_connections: typing.List[http.client.HTTPConnection] = list()
+        self.__connection_count = 0
+
+    def close(self) -> None:
+        with self.__lock:
+            for connection in self.__idle_connections:
+                connection.close()
+            self.__connection_count -= len(self.__idle_connections)
+            self.__idle_connections = list()
+
+    def __acquire_connection(self, timeout: float) -> typing.Tuple[http.client.HTTPConnection, bool]:
+        """Returns an idle or a new connection and whether it is new."""
+        with self.__connection_available:
+            self.__connection_available.wait_for(lambda: bool(self.__idle_connections) or self.__connection_count < self.max_connections)
+            if self.__idle_connections:
+                connection = self.__idle_connections.pop()
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                return connection, False
+            self.__connection_count += 1
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout), True
+
+    def __release_connection(self, connection: http.client.HTTPConnection, keep: bool) -> None:
+        if not keep:
+            connection.close()
+        with self.__connection_available:
+            if keep:
+                self.__idle_connections.append(connection)
+            else:
+                self.__connection_count -= 1
+            self.__connection_available.notify()
+
+    def query(self, path_components: typing.Iterable[str], value: typing.Optional[typing.Mapping[str, typing.Any]]=None,
+              timeout: float=5.0) -> QueryResult:
+        """
+        Sends a GET request for `path_components` or, if `value` is given, a PUT request with `value` as json body.
+        Returns the decoded json response and an error message, which is empty if the request succeeded.
+        """
+        path = get_path(*path_components)
+        method = 'GET'
+        body = None
+        headers = dict()
+        if value is not None:
+            data_dict: typing.Dict[str, typing.Any] = dict()
+            data_dict.update(value)
+            body = json.dumps(data_dict).encode('utf-8')
+            method = 'PUT'
+            headers['Content-Type'] = 'application/json'
+        while True:
+            connection, is_new = self.__acquire_connection(timeout)
+            keep = False
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                bytes_ = response.read()
+                keep = not response.will_close
+            except (OSError, http.client.HTTPException) as e:
+                if not is_new and isinstance(e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)):
+                    # the server closed the idle connection, so try again on a new one
+                    continue
+                return dict(), f'Query failed with error {e}'
+            finally:
+                self.__release_connection(connection, keep)
+            break
+        result = dict()
+        message = ''
+        if response.status >= 400:
+            message += f'Query failed with error HTTP Error {response.status}: {response.reason}'
+        elif (method == 'GET' and response.status != 200) or (method == 'PUT' and response.status != 204):
+            message += 'Query failed with error code {:.0f}. Reason: {}'.format(response.status, response.reason)
+        elif bytes_:
+            result = json.loads(bytes_.decode('utf-8'))
+        return result, message
+
+    def batch(self, requests: typing.Sequence[Request], timeout: float=5.0) -> typing.List[QueryResult]:
+        """Sends the (path_components, value) `requests` concurrently and returns their results in the same order."""
+        results: typing.List[QueryResult] = [(dict(), '')] * len(requests)
+
+        def query_on_thread(indexes: range) -> None:
+            for index in indexes:
+                results[index] = self.query(requests[index][0], value=requests[index][1], timeout=timeout)
+
+        Parallel.run_on_threads(query_on_thread, Parallel.distribute(range(len(requests)), self.max_connections))
+        return results
+
+    async def query_async(self, path_components: typing.Iterable[str],
+                          value: typing.Optional[typing.Mapping[str, typing.Any]]=None, timeout: float=5.0) -> QueryResult:
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: self.query(path_components, value=value, timeout=timeout))
+
+    async def batch_async(self, requests: typing.Sequence[Request], timeout: float=5.0) -> typing.List[QueryResult]:
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: self.batch(requests, timeout=timeout))
+
+
+# one client per port, shared by all users.
+_clients: typing.Dict[int, AS2Client] = dict()
+_clients_lock = threading.Lock()
+
+
+def get_client(port: typing.Optional[int]=None) -> AS2Client:
+    if port is None:
+        port = DEFAULT_PORT
+    with _clients_lock:
+        if port not in _clients:
+            _clients[port] = AS2Client(port)
+        return _clients[port]
+
+
+_found_port: typing.Optional[int] = None
+
+
+def find_port(ports: typing.Sequence[int]=CANDIDATE_PORTS, timeout: float=1.0) -> typing.Optional[int]:
+    """
+    Returns the first of `ports` on which AS2 answers, or `None`. The ports are probed concurrently and a port that
+    was found is remembered until it stops answering.
+    """
+    global _found_port
+    if _found_port is not None and _found_port in ports and not get_client(_found_port).query([], timeout=timeout)[1]:
+        return _found_port
+    messages: typing.List[str] = [''] * len(ports)
+
+    def probe(index: int) -> None:
+        messages[index] = get_client(ports[index]).query([], timeout=timeout)[1]
+
+    Parallel.run_on_threads(probe, range(len(ports)))
+    _found_port = next((port for port, message in zip(ports, messages) if not message), None)
+    return _found_port
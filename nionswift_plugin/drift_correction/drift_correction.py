@@ -4,15 +4,15 @@ from __future__ import annotations
 import typing
 import gettext
 import threading
+import math
 import time
 import warnings
 import logging
 import asyncio
+import concurrent.futures
 import pkgutil
 import os
 import subprocess
-import json
-import urllib.request
 import ctypes
 
 import numpy
@@ -22,8 +22,11 @@ import scipy.ndimage
 from nion.utils import Registry
 from nion.utils import Event
 from nion.utils import Geometry
-from nion.data import xdata_1_0 as xd
+from nion.data import Calibration
 from nion.data import Core
+from nion.data import DataAndMetadata
+from nion.experimental import Parallel
+from nion.experimental import Registration
 from nion.typeshed import API_1_0
 from nion.ui import Declarative
 from nion.swift.model import PlugInManager
@@ -33,6 +36,7 @@ from nion.swift import DocumentController
 from nion.swift import Workspace
 from nion.ui import CanvasItem
 
+from . import as2_client
 from . import settings_dialog
 
 _NDArray = numpy.typing.NDArray[typing.Any]
@@ -51,6 +55,7 @@ TUNING_DRIFT_RATE_CONTROL = 'Drift' # AS2 (2d) control in which tuning saves the
 SHIFTER_CONTROL = 'CSH' # AS2 probe shifter control
 STAGE_CONTROL = 'SShft'
 AS2_UPDATE_INTERVAL = 1.0 # minimum interval we update from as2 in s
+MAX_STREAMING_RESTARTS = 3 # number of times a failed continuous drift measurement is restarted
 AS2_PORT = None # Set this to a port to make the plugin use it. Otherwise it will try to find a working one automatically
 
 
@@ -130,6 +135,509 @@ def make_binary_image(image: _NDArray, *, blur_radius: float=2, threshold: typin
     return binary_image
 
 
+class ApertureTracker:
+    """
+    Finds the aperture in (ronchigram) images and returns its moments like `calculate_image_moments` of the binary
+    image.
+
+    The aperture is detected on an image binned to at most `max_binned_size` pixels. Only the blocks of the binned
+    image at the edge of the aperture are thresholded again at full resolution, inside the bounding box of the aperture,
+    which is blurred by `blur_radius` like in `make_binary_image`. The result is kept and returned without detecting the
+    aperture again as long as the total intensity and intensity centroid of the binned image change by less than
+    `stability_tolerance` (relative to the intensity and image size). `locate` can be called from several threads.
+    """
+
+    def __init__(self, max_binned_size: int=512, stability_tolerance: float=0.01, blur_radius: float=2.0):
+        self.max_binned_size = max_binned_size
+        self.stability_tolerance = stability_tolerance
+        self.blur_radius = blur_radius
+        self.detection_count = 0
+        self.__lock = threading.Lock()
+        self.__fingerprint: typing.Optional[_NDArray] = None
+        self.__moments: typing.Optional[typing.Tuple[float, float, float, float, float, float]] = None
+
+    def reset(self) -> None:
+        with self.__lock:
+            self.__fingerprint = None
+            self.__moments = None
+
+    def locate(self, image: _NDArray) -> typing.Tuple[float, float, float, float, float, float]:
+        with self.__lock:
+            return self.__locate(image)
+
+    def __locate(self, image: _NDArray) -> typing.Tuple[float, float, float, float, float, float]:
+        binning = max(1, -(-max(image.shape) // self.max_binned_size))
+        binned_shape = (image.shape[0] // binning, image.shape[1] // binning)
+        blocks = image[:binned_shape[0] * binning, :binned_shape[1] * binning].reshape(binned_shape[0], binning, binned_shape[1], binning)
+        binned_image = numpy.asarray(numpy.mean(blocks, axis=(1, 3), dtype=numpy.float32))
+        # total intensity and intensity centroid of the frame
+        proj_y = numpy.sum(binned_image, axis=1, dtype=numpy.float64)
+        proj_x = numpy.sum(binned_image, axis=0, dtype=numpy.float64)
+        total = numpy.sum(proj_y)
+        fingerprint = numpy.array((total, numpy.dot(proj_y, numpy.arange(binned_shape[0])) / total / binned_shape[0],
+                                   numpy.dot(proj_x, numpy.arange(binned_shape[1])) / total / binned_shape[1]))
+        if self.__moments is not None and self.__fingerprint is not None:
+            changes = numpy.abs(fingerprint - self.__fingerprint)
+            changes[0] /= abs(self.__fingerprint[0])
+            if numpy.all(changes < self.stability_tolerance):
+                return self.__moments
+        self.detection_count += 1
+        # binning is already a blur by (about) half the binning, so only blur by what is left
+        blur_radius = self.blur_radius / binning
+        blurred_image = scipy.ndimage.gaussian_filter(binned_image, blur_radius) if blur_radius >= 0.5 else binned_image
+        threshold = Core.auto_threshold(blurred_image)
+        binned_mask: _NDArray = blurred_image >= threshold
+        # the blocks that are not surrounded by blocks of the same kind contain the edge of the aperture
+        edge_blocks = scipy.ndimage.binary_dilation(binned_mask) & ~scipy.ndimage.binary_erosion(binned_mask, border_value=1)
+        block_indices = numpy.nonzero(binned_mask | edge_blocks)
+        if len(block_indices[0]) == 0:
+            self.__moments = calculate_image_moments(binned_mask.astype(numpy.int8))
+        else:
+            top, left = int(numpy.amin(block_indices[0])), int(numpy.amin(block_indices[1]))
+            bottom, right = int(numpy.amax(block_indices[0])) + 1, int(numpy.amax(block_indices[1])) + 1
+            box_mask = binned_mask[top:bottom, left:right] & ~edge_blocks[top:bottom, left:right]
+            mask: numpy.typing.NDArray[numpy.int8] = numpy.repeat(numpy.repeat(box_mask.astype(numpy.int8), binning, axis=0), binning, axis=1)
+            mask_blocks = mask.reshape(bottom - top, binning, right - left, binning)
+            edge_y, edge_x = numpy.nonzero(edge_blocks[top:bottom, left:right])
+            # blur the bounding box like make_binary_image blurs the image before thresholding. only the edge blocks are
+            # needed, so each is blurred with a margin of the filter size around it (gaussian_filter truncates at 4
+            # sigma), which gives the same values as blurring the whole bounding box.
+            margin = int(math.ceil(4.0 * self.blur_radius)) if self.blur_radius > 0 else 0
+            box_slices = (slice(top * binning, bottom * binning), slice(left * binning, right * binning))
+            crop_slices = tuple(slice(max(0, s.start - margin), min(length, s.stop + margin)) for s, length in zip(box_slices, image.shape))
+            padding = [(margin - (s.start - c.start), margin - (c.stop - s.stop)) for s, c in zip(box_slices, crop_slices)]
+            # scipy.ndimage reflects at the image border like the "symmetric" mode of numpy.pad
+            box_image = numpy.pad(image[crop_slices], padding, mode='symmetric') if numpy.any(padding) else image[crop_slices]
+            windows = numpy.lib.stride_tricks.sliding_window_view(box_image, (binning + 2 * margin, binning + 2 * margin))
+            edge_windows = numpy.asarray(windows[edge_y * binning, edge_x * binning], dtype=numpy.float32)
+            if margin > 0:
+                edge_windows = scipy.ndimage.gaussian_filter(edge_windows, (0, self.blur_radius, self.blur_radius))
+            mask_blocks[edge_y, :, edge_x, :] = edge_windows[:, margin:margin + binning, margin:margin + binning] >= threshold
+            sum_, center_y, center_x, a, b, angle = calculate_image_moments(mask)
+            self.__moments = sum_, center_y + top * binning, center_x + left * binning, a, b, angle
+        self.__fingerprint = fingerprint
+        return self.__moments
+
+
+class DriftRateEstimator:
+    """
+    Recursive estimate of the drift rate from a stream of measured positions (Kalman filter).
+
+    The state of each axis is its position and rate, the rate follows a random walk with spectral density `rate_noise`
+    (in units of position**2 / s**3) and the positions are measured with standard deviation `measurement_noise`. All
+    axes share the same covariance because they are measured at the same times with the same noise.
+    Measurements that are further than `outlier_threshold` standard deviations from the prediction are rejected, so
+    single bad frames do not disturb the estimate.
+    """
+
+    def __init__(self, measurement_noise: float=0.25, rate_noise: float=1e-4, outlier_threshold: float=4.0, ndim: int=2):
+        self.measurement_noise = measurement_noise
+        self.rate_noise = rate_noise
+        self.outlier_threshold = outlier_threshold
+        self.ndim = ndim
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.__lock:
+            # state has shape (ndim, 2) with position and rate of each axis
+            self.__state: typing.Optional[_NDArray] = None
+            self.__covariance: _NDArray = numpy.zeros((2, 2))
+            self.__time = 0.0
+            self.measurement_count = 0
+            self.outlier_count = 0
+
+    @property
+    def is_initialized(self) -> bool:
+        return self.__state is not None
+
+    @property
+    def position(self) -> _NDArray:
+        with self.__lock:
+            return numpy.zeros(self.ndim) if self.__state is None else self.__state[:, 0].copy()
+
+    @property
+    def rate(self) -> _NDArray:
+        with self.__lock:
+            return numpy.zeros(self.ndim) if self.__state is None else self.__state[:, 1].copy()
+
+    @property
+    def rate_uncertainty(self) -> float:
+        """Standard deviation of the rate of each axis."""
+        with self.__lock:
+            return numpy.inf if self.__state is None else float(numpy.sqrt(self.__covariance[1, 1]))
+
+    def update(self, time_: float, position: typing.Union[_NDArray, typing.Sequence[float]]) -> bool:
+        """Add the position measured at `time_`. Returns `False` if the measurement was rejected as an outlier."""
+        measurement = numpy.asarray(position, dtype=float)
+        measurement_variance = self.measurement_noise ** 2
+        with self.__lock:
+            if self.__state is None:
+                self.__state = numpy.stack((measurement, numpy.zeros(self.ndim)), axis=-1)
+                # nothing is known about the rate yet
+                self.__covariance = numpy.diag((measurement_variance, 1e6))
+                self.__time = time_
+                self.measurement_count = 1
+                return True
+            dt = time_ - self.__time
+            transition = numpy.array(((1.0, dt), (0.0, 1.0)))
+            process_covariance = self.rate_noise * numpy.array(((dt ** 3 / 3.0, dt ** 2 / 2.0), (dt ** 2 / 2.0, dt)))
+            state = self.__state @ transition.T
+            covariance = transition @ self.__covariance @ transition.T + process_covariance
+            innovation = measurement - state[:, 0]
+            innovation_variance = covariance[0, 0] + measurement_variance
+            if numpy.sum(innovation ** 2) / innovation_variance > self.outlier_threshold ** 2:
+                self.outlier_count += 1
+                return False
+            gain = covariance[:, 0] / innovation_variance
+            self.__state = state + innovation[:, numpy.newaxis] * gain
+            self.__covariance = covariance - numpy.outer(gain, covariance[0, :])
+            self.__time = time_
+            self.measurement_count += 1
+            return True
+
+    def offset_rate(self, offset: typing.Union[_NDArray, typing.Sequence[float]]) -> None:
+        """Add `offset` to the estimated rate, e.g. after the correction was changed by the negative of it."""
+        with self.__lock:
+            if self.__state is not None:
+                self.__state[:, 1] += numpy.asarray(offset, dtype=float)
+
+
+class StreamingDriftMeasurement:
+    """
+    Measures the drift continuously by registering every frame returned by `grab_frame` against a rolling reference
+    frame on a background thread. The positions (in pixels) are fed to `estimator`, which keeps the current drift rate.
+
+    The reference is replaced by the current frame when the frames have moved by more than `max_reference_shift` times
+    the frame size. Frames that correlate worse than `ccorr_threshold` are skipped and after more than
+    `max_consecutive_rejections` rejected frames in a row (e.g. because the sample was moved) the measurement restarts.
+    `rate_updated_event` fires with the rate and its uncertainty (in pixels / s) for each accepted frame.
+    """
+
+    def __init__(self, grab_frame: typing.Callable[[], _NDArray], estimator: DriftRateEstimator, *,
+                 ccorr_threshold: float, max_reference_shift: float=0.125, max_consecutive_rejections: int=3,
+                 clock: typing.Callable[[], float]=time.monotonic):
+        self.__grab_frame = grab_frame
+        self.estimator = estimator
+        self.ccorr_threshold = ccorr_threshold
+        self.max_reference_shift = max_reference_shift
+        self.max_consecutive_rejections = max_consecutive_rejections
+        self.__clock = clock
+        self.rate_updated_event = Event.Event()
+        # the reference frame is kept with its registration terms, which are computed once per reference
+        self.__reference: typing.Optional[Registration.TemplateMatchReference] = None
+        self.__reference_position: _NDArray = numpy.zeros(2)
+        self.__consecutive_rejections = 0
+        self.__thread: typing.Optional[threading.Thread] = None
+        self.__stop_event = threading.Event()
+
+    @property
+    def is_running(self) -> bool:
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self) -> None:
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(target=self.__measurement_loop, daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        self.__stop_event.set()
+        if self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join()
+        self.__thread = None
+
+    def __measurement_loop(self) -> None:
+        while not self.__stop_event.is_set():
+            try:
+                frame = self.__grab_frame()
+                self.process_frame(frame, self.__clock())
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                break
+
+    def process_frame(self, frame: _NDArray, time_: float) -> bool:
+        """Register `frame` taken at `time_` and update the estimate. Returns whether the frame was accepted."""
+        if self.__reference is None:
+            self.__reference = Registration.TemplateMatchReference(frame, frame.shape)
+            self.__reference_position = self.estimator.position
+            return self.estimator.update(time_, self.__reference_position)
+        ccorr_max, ccorr_max_location = self.__reference.register(frame)
+        accepted = False
+        if ccorr_max >= self.ccorr_threshold:
+            accepted = self.estimator.update(time_, self.__reference_position + numpy.array(ccorr_max_location))
+        if not accepted:
+            self.__consecutive_rejections += 1
+            if self.__consecutive_rejections > self.max_consecutive_rejections:
+                self.__consecutive_rejections = 0
+                self.__reference = None
+                self.estimator.reset()
+            return False
+        self.__consecutive_rejections = 0
+        if numpy.amax(numpy.abs(ccorr_max_location)) > self.max_reference_shift * min(frame.shape):
+            # the filtered position is the better estimate for the position of the new reference
+            self.__reference = Registration.TemplateMatchReference(frame, frame.shape)
+            self.__reference_position = self.estimator.position
+        self.rate_updated_event.fire(self.estimator.rate, self.estimator.rate_uncertainty)
+        return True
+
+
+class ControlIO:
+    """
+    Reads and writes AS2 controls through `stem_controller` and caches their last known values.
+
+    `read` fetches all requested controls concurrently, so reading a few controls takes about as long as reading one.
+    Writes are queued and sent in order by a background thread, so setting (and confirming) controls does not block
+    the caller. Queued writes of the same control are combined into one and reading a control with a queued write
+    returns the queued value. Failed writes remove the control from the cache and are reported by `pop_failed_writes`.
+    `write` returns a ticket, with which `wait` waits for that write only and not for writes queued by others later.
+    """
+
+    def __init__(self, stem_controller: typing.Any, max_concurrent_reads: int=4):
+        self.__stem_controller = stem_controller
+        self.__max_concurrent_reads = max_concurrent_reads
+        self.__lock = threading.Lock()
+        self.__values: typing.Dict[str, typing.Any] = dict()
+        # queued writes: name -> (kind, value, tickets), kind is 'set', 'confirm' or 'inform'. combined writes keep the
+        # tickets of all writes they replace.
+        self.__queue: typing.Dict[str, typing.Tuple[str, float, typing.List[int]]] = dict()
+        self.__write_count = 0
+        self.__pending_tickets: typing.Set[int] = set()
+        self.__writing: typing.Optional[str] = None
+        self.__failed_writes: typing.List[str] = list()
+        self.__queue_changed = threading.Condition(self.__lock)
+        self.__closed = False
+        # the reads run every correction step, so they use a persistent pool instead of starting threads each time
+        self.__read_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_reads, thread_name_prefix='ControlIO')
+        self.__thread = threading.Thread(target=self.__write_loop, daemon=True)
+        self.__thread.start()
+
+    def close(self) -> None:
+        with self.__queue_changed:
+            self.__closed = True
+            self.__queue_changed.notify_all()
+        self.__read_executor.shutdown(wait=False)
+
+    def get(self, name: str) -> typing.Tuple[bool, typing.Any]:
+        """Returns the cached value of the control `name` and whether it is known."""
+        with self.__lock:
+            if name in self.__queue:
+                return True, self.__queue[name][1]
+            return name in self.__values, self.__values.get(name)
+
+    def __get_pending_value(self, name: str) -> typing.Optional[typing.Tuple[bool, typing.Any]]:
+        # the value of a control that is queued or being written, which is newer than what reading it would return
+        if name in self.__queue:
+            return True, self.__queue[name][1]
+        if name == self.__writing:
+            return True, self.__values.get(name)
+        return None
+
+    def read(self, names: typing.Sequence[str], cached: bool=False) -> typing.Dict[str, typing.Tuple[bool, typing.Any]]:
+        """
+        Returns the success and value of each control in `names`. Controls with queued writes and, if `cached` is
+        True, controls with known values are taken from the cache. All others are read concurrently.
+        """
+        results: typing.Dict[str, typing.Tuple[bool, typing.Any]] = dict()
+        with self.__lock:
+            for name in names:
+                pending_value = self.__get_pending_value(name)
+                if pending_value is not None:
+                    results[name] = pending_value
+                elif cached and name in self.__values:
+                    results[name] = True, self.__values[name]
+        names_to_read = [name for name in dict.fromkeys(names) if name not in results]
+
+        def read_names(names_: typing.Sequence[str]) -> None:
+            for name in names_:
+                results[name] = self.__stem_controller.TryGetVal(name)
+
+        if len(names_to_read) <= 1 or self.__closed:
+            read_names(names_to_read)
+        else:
+            futures = [self.__read_executor.submit(read_names, names_) for names_ in Parallel.distribute(names_to_read, self.__max_concurrent_reads)]
+            for future in futures:
+                future.result()
+        with self.__lock:
+            for name in names_to_read:
+                success, value = results[name]
+                # a write that was queued while reading is newer than the read value
+                pending_value = self.__get_pending_value(name)
+                if pending_value is not None:
+                    results[name] = pending_value
+                elif success:
+                    self.__values[name] = value
+                else:
+                    self.__values.pop(name, None)
+        return results
+
+    def write(self, name: str, value: float, confirm: bool=False, inform: bool=False) -> int:
+        """
+        Queues setting the control `name` to `value` (and waiting for its confirmation) or informing it. Returns the
+        ticket of the write for `wait`.
+        """
+        kind = 'inform' if inform else 'confirm' if confirm else 'set'
+        with self.__queue_changed:
+            self.__write_count += 1
+            ticket = self.__write_count
+            queued_kind, queued_value, tickets = self.__queue.get(name, ('set', 0.0, list()))
+            if kind == 'set' and queued_kind == 'confirm':
+                kind = 'confirm'
+            self.__queue[name] = (kind, value, tickets + [ticket])
+            self.__pending_tickets.add(ticket)
+            self.__queue_changed.notify_all()
+        return ticket
+
+    def wait(self, tickets: typing.Sequence[int], timeout: typing.Optional[float]=None) -> bool:
+        """
+        Waits until the writes with `tickets` are sent, but not for other writes. Returns False if the timeout expired.
+        """
+        with self.__queue_changed:
+            return self.__queue_changed.wait_for(lambda: self.__closed or self.__pending_tickets.isdisjoint(tickets), timeout)
+
+    def flush(self, timeout: typing.Optional[float]=None) -> bool:
+        """Waits until all queued writes are sent. Returns False if the timeout expired."""
+        with self.__queue_changed:
+            return self.__queue_changed.wait_for(lambda: not self.__queue and self.__writing is None, timeout)
+
+    def pop_failed_writes(self, names: typing.Optional[typing.Sequence[str]]=None) -> typing.List[str]:
+        """Returns the names of the controls (of `names`, if given) that failed to be written since the last call."""
+        with self.__lock:
+            failed_writes = [name for name in self.__failed_writes if names is None or name in names]
+            self.__failed_writes = [name for name in self.__failed_writes if name not in failed_writes]
+        return failed_writes
+
+    def __write_loop(self) -> None:
+        while True:
+            with self.__queue_changed:
+                self.__queue_changed.wait_for(lambda: bool(self.__queue) or self.__closed)
+                if self.__closed:
+                    return
+                name = next(iter(self.__queue))
+                kind, value, tickets = self.__queue.pop(name)
+                self.__writing = name
+                # the value becomes known before it is sent, so that reads while it is sent get the new value
+                self.__values[name] = value
+            try:
+                if kind == 'confirm':
+                    success = self.__stem_controller.SetValAndConfirm(name, value, 1.0, 3000)
+                elif kind == 'inform':
+                    success = self.__stem_controller.InformControl(name, value)
+                else:
+                    success = self.__stem_controller.SetVal(name, value)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                success = False
+            with self.__queue_changed:
+                if not success:
+                    self.__failed_writes.append(name)
+                    if name not in self.__queue:
+                        self.__values.pop(name, None)
+                self.__writing = None
+                self.__pending_tickets.difference_update(tickets)
+                self.__queue_changed.notify_all()
+
+
+class TelemetryRecorder:
+    """
+    Records one entry per drift correction iteration in a ring buffer of `capacity` entries that is allocated once, so
+    that recording an entry costs about a microsecond and the memory stays the same over long acquisitions. When the
+    buffer is full, the oldest entries are overwritten (the default holds about seven hours at 0.1 s per iteration).
+
+    The fields of an entry (see `FIELDS`) are the time (as `time.time()`) at the start of the iteration, the drift
+    vector in m/s and the shifter position read back from AS2 in m, both in the (x, y) order of the current axis, the
+    duration of the iteration without the wait for the next one in s and the time it waited for AS2 to read the
+    controls in s. Values that could not be read are nan. Entries of separate correction runs are separated by an
+    entry that is nan in all fields (see `mark_segment`), so that the line plots break between them.
+    """
+
+    FIELDS = ('time', 'drift_vector_x', 'drift_vector_y', 'shifter_x', 'shifter_y', 'tick_duration', 'control_latency')
+    # the fields shown in each line plot of `create_xdata_list` with their units and scale from SI units.
+    PLOTS = (('Drift rate', ('drift_vector_x', 'drift_vector_y'), 'nm/min', 1e9 * 60),
+             ('Shifter position', ('shifter_x', 'shifter_y'), 'nm', 1e9),
+             ('Iteration timing', ('tick_duration', 'control_latency'), 'ms', 1e3))
+
+    def __init__(self, capacity: int=2**18):
+        self.__data = numpy.empty((capacity, len(self.FIELDS)))
+        self.__lock = threading.Lock()
+        self.__count = 0
+
+    def __len__(self) -> int:
+        return min(self.__count, self.capacity)
+
+    @property
+    def capacity(self) -> int:
+        return self.__data.shape[0]
+
+    @property
+    def total_count(self) -> int:
+        """The number of entries recorded since the last `clear`, including overwritten ones."""
+        return self.__count
+
+    def record(self, time_: float, drift_vector: typing.Union[_NDArray, typing.Sequence[float]], shifter: typing.Sequence[float],
+               tick_duration: float, control_latency: float) -> None:
+        with self.__lock:
+            self.__data[self.__count % self.capacity] = (time_, drift_vector[0], drift_vector[1], shifter[0], shifter[1],
+                                                         tick_duration, control_latency)
+            self.__count += 1
+
+    def mark_segment(self) -> None:
+        """Records an all-nan entry to start a new segment, unless there are no entries or the last one is a mark."""
+        with self.__lock:
+            if self.__count > 0 and not numpy.isnan(self.__data[(self.__count - 1) % self.capacity, 0]):
+                self.__data[self.__count % self.capacity] = numpy.nan
+                self.__count += 1
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__count = 0
+
+    def get_array(self) -> _NDArray:
+        """Returns a copy of the recorded entries, oldest first, with one column per field."""
+        with self.__lock:
+            if self.__count <= self.capacity:
+                return self.__data[:self.__count].copy()
+            index = self.__count % self.capacity
+            return numpy.concatenate((self.__data[index:], self.__data[:index]))
+
+    def get_data(self) -> typing.Dict[str, _NDArray]:
+        array = self.get_array()
+        return {name: array[:, i] for i, name in enumerate(self.FIELDS)}
+
+    def save_npz(self, path: typing.Union[str, os.PathLike[str]]) -> None:
+        numpy.savez(path, **typing.cast(typing.Dict[str, typing.Any], self.get_data()))
+
+    def save_csv(self, path: typing.Union[str, os.PathLike[str]]) -> None:
+        numpy.savetxt(path, self.get_array(), delimiter=',', header=','.join(self.FIELDS), comments='')
+
+    def save(self, path: typing.Union[str, os.PathLike[str]]) -> None:
+        """Saves the entries as csv file if `path` ends with ".csv", otherwise as npz file."""
+        if os.fspath(path).lower().endswith('.csv'):
+            self.save_csv(path)
+        else:
+            self.save_npz(path)
+
+    def create_xdata(self, field_names: typing.Sequence[str], units: str='', scale: float=1.0) -> DataAndMetadata.DataAndMetadata:
+        """
+        Returns the fields in `field_names` multiplied by `scale` as rows of 2d data, which Swift shows with one layer
+        per field when its display type is "line_plot". The x-axis is calibrated with the median time between the
+        entries within a segment, so that the pauses between the segments do not stretch it.
+        """
+        data = self.get_data()
+        intervals = numpy.diff(data['time'])
+        intervals = intervals[numpy.isfinite(intervals)]
+        interval = float(numpy.median(intervals)) if len(intervals) > 0 else 1.0
+        values = numpy.stack([data[name] * scale for name in field_names])
+        return DataAndMetadata.new_data_and_metadata(values, intensity_calibration=Calibration.Calibration(units=units),
+                                                     dimensional_calibrations=[Calibration.Calibration(),
+                                                                               Calibration.Calibration(scale=interval, units='s')])
+
+    def create_xdata_list(self) -> typing.List[typing.Tuple[str, DataAndMetadata.DataAndMetadata]]:
+        """Returns the title and data of the line plots in `PLOTS`."""
+        return [(title, self.create_xdata(field_names, units, scale)) for title, field_names, units, scale in self.PLOTS]
+
+
 class DriftCorrectionSettings:
     _settings_dialog_ui_elements = [
         {'property_name': 'update_interval', 'display_name': 'Shifter update interval (s)', 'ui_element': 'line_edit', 'value_type': 'float',
@@ -143,7 +651,9 @@ class DriftCorrectionSettings:
         {'property_name': 'auto_stop_threshold', 'display_name': 'Auto stop threshold', 'ui_element': 'line_edit', 'value_type': 'float',
          'description': 'Stop drift correction after moving further than this times the maximum shifter range.'},
         {'property_name': 'reset_shifters_to_opposite', 'display_name': 'Reset shifters to opposite', 'ui_element': 'check_box', 'value_type': 'bool',
-         'description': 'Reset shifters to their opposite when clicking "Reset". This will extend the usable range for drift correction by a factor of 2.'}]
+         'description': 'Reset shifters to their opposite when clicking "Reset". This will extend the usable range for drift correction by a factor of 2.'},
+        {'property_name': 'continuous_drift_measurement', 'display_name': 'Continuous drift measurement', 'ui_element': 'check_box', 'value_type': 'bool',
+         'description': 'Measure the drift from every frame instead of two frames. "Measure drift" finishes as soon as the drift rate is known and in auto mode the correction uses the measured drift rate while it is running.'}]
 
     def __init__(self) -> None:
         self.update_interval = 0.1 # in seconds
@@ -155,6 +665,7 @@ class DriftCorrectionSettings:
         self.max_shifter_range = 100e-9
         self.auto_stop_threshold = 2.0 # Stop drift correction after moving further than this times the max_shifter_range
         self.reset_shifters_to_opposite = False # When resetting shifters, set them to the opposite of what they were and compensate with stage (gives more correction range)
+        self.continuous_drift_measurement = False # Register every frame on a background thread and estimate the drift rate recursively
 
     @classmethod
     def from_dict(cls, settings_dict: typing.Mapping[str, typing.Any]) -> 'DriftCorrectionSettings':
@@ -172,7 +683,8 @@ class DriftCorrectionSettings:
                 'drift_time_constant': 'DriftTimeConstant',
                 'max_shifter_range': 'MaxShifterRange',
                 'auto_stop_threshold': 'DiftAutoStopThreshold',
-                'reset_shifters_to_opposite': 'ResetShiftersToOpposite'}
+                'reset_shifters_to_opposite': 'ResetShiftersToOpposite',
+                'continuous_drift_measurement': 'DriftContinuousMeasurement'}
 
     def to_dict(self) -> typing.Mapping[str, typing.Any]:
         return {'update_interval': self.update_interval,
@@ -183,7 +695,8 @@ class DriftCorrectionSettings:
                 'min_patch_radius': self.min_patch_radius,
                 'max_patch_radius': self.max_patch_radius,
                 'auto_stop_threshold': self.auto_stop_threshold,
-                'reset_shifters_to_opposite': self.reset_shifters_to_opposite}
+                'reset_shifters_to_opposite': self.reset_shifters_to_opposite,
+                'continuous_drift_measurement': self.continuous_drift_measurement}
 
     def save_to_as2(self, stem_controller: typing.Any, property_name: str) -> bool:
         as2_name = self._as2_names.get(property_name)
@@ -450,6 +963,37 @@ class DriftCorrectionUIHandler(Declarative.Handler):
     def reset_shifters_clicked(self, widget: Declarative.UIWidget) -> None:
         self.__drift_corrector.reset_shifters()
 
+    def show_telemetry_clicked(self, widget: Declarative.UIWidget) -> None:
+        telemetry = self.__drift_corrector.telemetry
+        if len(telemetry) == 0:
+            self.handle_status_message('No telemetry recorded yet.')
+            return
+        window = self.__api.application.document_windows[0]
+        axis = self.__drift_corrector.axis
+        for title, xdata in telemetry.create_xdata_list():
+            data_item = self.__api.library.create_data_item_from_data_and_metadata(xdata, title=f'Drift correction {title.lower()}')
+            window.display_data_item(data_item)
+            display_item = self.__api.library._document_model.get_display_item_for_data_item(data_item._data_item)
+            assert display_item is not None
+            display_item.display_type = "line_plot"
+            if title != 'Iteration timing':
+                display_item._set_display_layer_properties(0, stroke_color='#F00', stroke_width=2, fill_color=None, label=axis[0])
+                display_item._set_display_layer_properties(1, stroke_color='#1E90FF', stroke_width=2, fill_color=None, label=axis[1])
+            else:
+                display_item._set_display_layer_properties(0, stroke_color='#F00', stroke_width=2, fill_color=None, label='iteration')
+                display_item._set_display_layer_properties(1, stroke_color='#1E90FF', stroke_width=2, fill_color=None, label='AS2 read')
+
+    def export_telemetry_clicked(self, widget: Declarative.UIWidget) -> None:
+        document_controller = self.__api.application.document_controllers[0]._document_controller
+        path, selected_filter, selected_directory = document_controller.get_save_file_path(
+            _('Export Drift Correction Telemetry'), document_controller.ui.get_document_location(),
+            'NumPy files (*.npz);;CSV files (*.csv)')
+        if path:
+            if not os.path.splitext(path)[1]:
+                path += '.csv' if selected_filter.startswith('CSV') else '.npz'
+            self.__drift_corrector.telemetry.save(path)
+            self.handle_status_message(f'Saved telemetry to {path}.')
+
     def help_clicked(self, widget: Declarative.UIWidget) -> None:
         docs_path = os.path.join(os.path.dirname(__file__), 'resources', 'html', 'index.html')
         logging.info(f'Trying to display help from: {docs_path}')
@@ -490,14 +1034,17 @@ class DriftCorrectionUIHandler(Declarative.Handler):
             self.__drift_corrector.end_manual_drift_adjustment()
             return
 
-        def wait_for_edit_finished() -> None:
-            result, message = query(('ui', 'popupedit'))
-            if message or not result.get('Visible'):
-                self.__drift_corrector.end_manual_drift_adjustment()
-            else:
-                self.__event_loop.call_later(0.1, wait_for_edit_finished)
+        async def wait_for_edit_finished() -> None:
+            # poll on a worker thread, so that a slow response does not block the UI
+            client = as2_client.get_client(AS2_PORT)
+            while True:
+                await asyncio.sleep(0.1)
+                result, message = await client.query_async(('ui', 'popupedit'))
+                if message or not result.get('Visible'):
+                    self.__drift_corrector.end_manual_drift_adjustment()
+                    return
 
-        self.__event_loop.call_later(0.1, wait_for_edit_finished)
+        self.__event_loop.create_task(wait_for_edit_finished())
 
 
 class DriftCorrectionUI:
@@ -552,7 +1099,14 @@ class DriftCorrectionUI:
                              ui.create_stretch(),
                              margin=5)
 
-        return ui.create_column(row1, row2, row3, row4, row5, row6, ui.create_stretch(), margin=5)
+        row7 = ui.create_row(ui.create_label(text='Telemetry: '),
+                             ui.create_push_button(text='Show', on_clicked='show_telemetry_clicked'),
+                             ui.create_spacing(10),
+                             ui.create_push_button(text='Export...', on_clicked='export_telemetry_clicked'),
+                             ui.create_stretch(),
+                             margin=5)
+
+        return ui.create_column(row1, row2, row3, row4, row5, row6, row7, ui.create_stretch(), margin=5)
 
 
 class DriftCorrector:
@@ -560,6 +1114,9 @@ class DriftCorrector:
 
     def __init__(self, stem_controller: typing.Any, settings: DriftCorrectionSettings):
         self.__stem_controller = stem_controller
+        self.__control_io = ControlIO(stem_controller)
+        self.__aperture_tracker = ApertureTracker()
+        self.telemetry = TelemetryRecorder()
         self.__settings = settings
         self.__lock = threading.Lock()
         self.__queue: typing.Dict[str, typing.Any] = dict()
@@ -583,12 +1140,25 @@ class DriftCorrector:
         self.__thread: typing.Optional[threading.Thread] = None
         self.__stop_event = threading.Event()
 
+        # continuous drift measurement used by the correction loop. it is created, started and stopped on worker
+        # threads, because grabbing the first frame and stopping wait for the camera or scan.
+        self.__streaming_lock = threading.Lock()
+        self.__streaming_measurement: typing.Optional[StreamingDriftMeasurement] = None
+        self.__streaming_pixel_size = 0.0
+        self.__streaming_starting = False
+        self.__streaming_start_failed = False
+        self.__streaming_restart_count = 0
+        self.__last_streaming_update = 0.0
+
     def start(self) -> None:
         self.__thread = threading.Thread(target=self.correction_loop, daemon=True)
         self.__thread.start()
 
     def close(self) -> None:
         self.__stop_event.set()
+        # otherwise the correction loop closes it when it ends
+        if self.__thread is None:
+            self.__control_io.close()
 
     @property
     def settings(self) -> DriftCorrectionSettings:
@@ -601,15 +1171,21 @@ class DriftCorrector:
     @enabled.setter
     def enabled(self, enabled: bool) -> None:
         self.settings.update_from_as2(self.__stem_controller)
+        with self.__streaming_lock:
+            self.__streaming_start_failed = False
+            self.__streaming_restart_count = 0
         if enabled:
             self.status_updated_event.fire('Enabled')
             self.drift_corrector_state_changed_event.fire({'state': 'running'})
             self.__last_update = time.time()
+            self.telemetry.mark_segment()
         else:
             self.status_updated_event.fire('Disabled')
             self.drift_corrector_state_changed_event.fire({'state': 'disabled'})
         self.__enabled = enabled
         self.property_changed_event.fire('enabled')
+        if self.__thread is not None:
+            self.__start_or_stop_streaming_measurement()
 
     @property
     def drift_vector(self) -> _NDArray:
@@ -624,45 +1200,54 @@ class DriftCorrector:
         self.__decrease_drift_rate = decrease
         self.property_changed_event.fire('decrease_drift_rate')
 
-    def get_vector(self, control_name: str, axis: typing.Optional[typing.Tuple[str, str]]=None) -> typing.Tuple[bool, _NDArray]:
+    def get_vector(self, control_name: str, axis: typing.Optional[typing.Tuple[str, str]]=None, cached: bool=False) -> typing.Tuple[bool, _NDArray]:
         if axis is None:
             axis = self.axis
-        success_a, vector_a = self.__stem_controller.TryGetVal(control_name + '.' + axis[0])
-        success_b, vector_b = self.__stem_controller.TryGetVal(control_name + '.' + axis[1])
+        names = [control_name + '.' + axis[0], control_name + '.' + axis[1]]
+        values = self.__control_io.read(names, cached=cached)
+        success_a, vector_a = values[names[0]]
+        success_b, vector_b = values[names[1]]
         return success_a & success_b, numpy.array((vector_a, vector_b))
 
-    def set_vector(self, control_name: str, value: typing.Union[_NDArray, typing.Tuple[float, float]], axis: typing.Optional[typing.Tuple[str, str]]=None, confirm: bool=False) -> bool:
+    def __wait_for_writes(self, names: typing.Sequence[str], tickets: typing.Sequence[int]) -> bool:
+        # only wait for these writes, the correction loop keeps queueing writes while it is running
+        self.__control_io.wait(tickets)
+        return not self.__control_io.pop_failed_writes(names)
+
+    def set_vector(self, control_name: str, value: typing.Union[_NDArray, typing.Tuple[float, float]], axis: typing.Optional[typing.Tuple[str, str]]=None, confirm: bool=False, wait: bool=True) -> bool:
+        """
+        Sets the vector control `control_name`. If `wait` is False, the control is set in the background and failures
+        are reported by the correction loop.
+        """
         if axis is None:
             axis = self.axis
-        if confirm:
-            # We only need to confirm the second direction because commands get sent out one after the other.
-            success_a = self.__stem_controller.SetVal(control_name + '.' + axis[0], float(value[0]))
-            success_b = self.__stem_controller.SetValAndConfirm(control_name + '.' + axis[1], float(value[1]), 1.0, 3000)
-        else:
-            success_a = self.__stem_controller.SetVal(control_name + '.' + axis[0], float(value[0]))
-            success_b = self.__stem_controller.SetVal(control_name + '.' + axis[1], float(value[1]))
-        return bool(success_a & success_b)
+        names = [control_name + '.' + axis[0], control_name + '.' + axis[1]]
+        # We only need to confirm the second direction because commands get sent out one after the other.
+        tickets = [self.__control_io.write(names[0], float(value[0])),
+                   self.__control_io.write(names[1], float(value[1]), confirm=confirm)]
+        return self.__wait_for_writes(names, tickets) if wait else True
 
-    def update_vector(self, control_name: str, value: _NDArray, axis: typing.Optional[typing.Tuple[str, str]]=None, confirm: bool=False) -> bool:
+    def update_vector(self, control_name: str, value: _NDArray, axis: typing.Optional[typing.Tuple[str, str]]=None, confirm: bool=False, wait: bool=True, cached: bool=False) -> bool:
         if axis is None:
             axis = self.axis
-        success, current = self.get_vector(control_name, axis=axis)
+        success, current = self.get_vector(control_name, axis=axis, cached=cached)
         if success:
-            success = self.set_vector(control_name, current + value, axis=axis, confirm=confirm)
+            success = self.set_vector(control_name, current + value, axis=axis, confirm=confirm, wait=wait)
         return success
 
     def inform_vector(self, control_name: str, value: _NDArray, axis: typing.Optional[typing.Tuple[str, str]]=None) -> bool:
         if axis is None:
             axis = self.axis
-        success_a = self.__stem_controller.InformControl(control_name + '.' + axis[0], float(value[0]))
-        success_b = self.__stem_controller.InformControl(control_name + '.' + axis[1], float(value[1]))
-        return bool(success_a & success_b)
+        names = [control_name + '.' + axis[0], control_name + '.' + axis[1]]
+        tickets = [self.__control_io.write(names[0], float(value[0]), inform=True),
+                   self.__control_io.write(names[1], float(value[1]), inform=True)]
+        return self.__wait_for_writes(names, tickets)
 
-    def update_from_as2(self) -> bool:
+    def update_from_as2(self, cached: bool=False) -> bool:
         success = True
         now = time.time()
         if now - self.__last_as2_update > AS2_UPDATE_INTERVAL:
-            success, drift_vector = self.get_vector(DRIFT_VECTOR_CONTROL)
+            success, drift_vector = self.get_vector(DRIFT_VECTOR_CONTROL, cached=cached)
             if success:
                 self.__drift_vector = drift_vector
                 self.property_changed_event.fire('drift_vector')
@@ -726,8 +1311,8 @@ class DriftCorrector:
         with self.__lock:
             self.__queue['end_manual'] = do_update
 
-    def update_progress(self) -> None:
-        success, value = self.get_vector(SHIFTER_CONTROL)
+    def update_progress(self, cached: bool=False) -> None:
+        success, value = self.get_vector(SHIFTER_CONTROL, cached=cached)
         if success:
             progress = numpy.amax(numpy.abs(value)) / self.settings.max_shifter_range * 100.0
             remaining_shifter_range = self.settings.max_shifter_range - numpy.abs(value)
@@ -768,30 +1353,129 @@ class DriftCorrector:
         with self.__lock:
             self.__queue['reset_shifters'] = do_update
 
+    def __start_or_stop_streaming_measurement(self) -> None:
+        """
+        Starts or stops the continuous drift measurement on a worker thread, depending on the settings. A measurement
+        that ended because grabbing or registering a frame failed is restarted a few times.
+        """
+        wanted = self.enabled and self.mode == 'auto' and self.settings.continuous_drift_measurement and not self.__stop_event.is_set()
+        stopped_measurement: typing.Optional[StreamingDriftMeasurement] = None
+        start = False
+        message: typing.Optional[str] = None
+        with self.__streaming_lock:
+            measurement = self.__streaming_measurement
+            if measurement is not None and not measurement.is_running:
+                self.__streaming_measurement = None
+                if wanted:
+                    self.__streaming_restart_count += 1
+                    if self.__streaming_restart_count > MAX_STREAMING_RESTARTS:
+                        self.__streaming_start_failed = True
+                        message = 'Continuous drift measurement failed.'
+                    else:
+                        message = 'Continuous drift measurement failed. Restarting.'
+            elif measurement is not None and not wanted:
+                self.__streaming_measurement = None
+                stopped_measurement = measurement
+            if wanted and self.__streaming_measurement is None and not self.__streaming_starting and not self.__streaming_start_failed:
+                self.__streaming_starting = True
+                start = True
+        if message is not None:
+            self.status_updated_event.fire(message)
+        if stopped_measurement is not None:
+            threading.Thread(target=stopped_measurement.stop, daemon=True).start()
+        if start:
+            threading.Thread(target=self.__start_streaming_measurement, daemon=True).start()
+
+    def __start_streaming_measurement(self) -> None:
+        try:
+            streaming_measurement = self.create_streaming_measurement()
+        except Exception as e:
+            self.status_updated_event.fire(f'Failed to start continuous drift measurement ({e}).')
+            with self.__streaming_lock:
+                self.__streaming_starting = False
+                self.__streaming_restart_count += 1
+                self.__streaming_start_failed = self.__streaming_restart_count > MAX_STREAMING_RESTARTS
+                start_failed = self.__streaming_start_failed
+            if start_failed:
+                self.status_updated_event.fire('Continuous drift measurement failed.')
+            return
+        with self.__streaming_lock:
+            self.__streaming_starting = False
+            if streaming_measurement is None:
+                self.__streaming_start_failed = True
+                return
+            if self.__stop_event.is_set():
+                return
+            self.__streaming_measurement, self.__streaming_pixel_size = streaming_measurement
+            self.__streaming_measurement.start()
+            self.__last_streaming_update = time.monotonic()
+
+    def __update_streaming_measurement(self) -> None:
+        """
+        Adds the drift rate measured by the continuous drift measurement to the drift vector. Because the drift
+        correction is running, the measured drift rate is the residual drift. This only polls the measurement.
+        """
+        self.__start_or_stop_streaming_measurement()
+        with self.__streaming_lock:
+            measurement = self.__streaming_measurement
+            pixel_size = self.__streaming_pixel_size
+        if measurement is None:
+            return
+        estimator = measurement.estimator
+        now = time.monotonic()
+        if estimator.measurement_count >= 3 and now - self.__last_streaming_update > AS2_UPDATE_INTERVAL:
+            # the measurement works again, so it can be restarted again when it fails later
+            self.__streaming_restart_count = 0
+            rate = estimator.rate
+            if numpy.amax(numpy.abs(rate)) > 2.0 * estimator.rate_uncertainty:
+                # the drift vector compensates the drift, so subtracting the residual drift from it removes the
+                # residual drift
+                estimator.offset_rate(-1.0 * rate)
+                compensation = -1.0 * rate[::-1] * pixel_size
+                self.__drift_vector = self.__drift_vector + compensation
+                self.update_vector(DRIFT_VECTOR_CONTROL, compensation, wait=False, cached=True)
+                self.__last_as2_update = 0.0
+                self.property_changed_event.fire('drift_vector')
+            self.__last_streaming_update = now
+
     def correction_loop(self) -> None:
         while not self.__stop_event.is_set():
             start_time = time.time()
+            control_values: typing.Optional[typing.Mapping[str, typing.Tuple[bool, typing.Any]]] = None
+            self.__update_streaming_measurement()
             if self.enabled:
                 # If as2_upadate_rate_backup is not None we are adjusting the drift rate via an AS2 popup. In this case
                 # we also need to update from AS2 to make the changed drift rate apply live
-                if self.mode == 'auto' or self.__as2_update_rate_backup is not None:
-                    success = self.update_from_as2()
+                use_as2_drift_vector = self.mode == 'auto' or self.__as2_update_rate_backup is not None
+                # read all controls needed in this iteration at once. everything below uses the cached values and
+                # writes in the background, so that a slow controller does not slow down the correction.
+                shifter_names = [SHIFTER_CONTROL + '.' + self.axis[0], SHIFTER_CONTROL + '.' + self.axis[1]]
+                control_names = list(shifter_names)
+                if use_as2_drift_vector and time.time() - self.__last_as2_update > AS2_UPDATE_INTERVAL:
+                    control_names += [DRIFT_VECTOR_CONTROL + '.' + self.axis[0], DRIFT_VECTOR_CONTROL + '.' + self.axis[1]]
+                read_start_time = time.perf_counter()
+                control_values = self.__control_io.read(control_names)
+                control_latency = time.perf_counter() - read_start_time
+                if self.__control_io.pop_failed_writes(shifter_names):
+                    self.status_updated_event.fire(f'Failed to set shifters ({SHIFTER_CONTROL})')
+                if use_as2_drift_vector:
+                    success = self.update_from_as2(cached=True)
                 else:
                     success = True
                 now = time.time()
                 time_difference = now - self.__last_update
                 if success:
                     correction_vector: _NDArray = time_difference * self.__drift_vector
-                    correction_success = self.update_vector(SHIFTER_CONTROL, correction_vector, confirm=True)
+                    correction_success = self.update_vector(SHIFTER_CONTROL, correction_vector, confirm=True, wait=False, cached=True)
                     if correction_success:
-                        self.update_progress()
+                        self.update_progress(cached=True)
                     else:
-                        self.status_updated_event.fire(f'Failed to set shifters ({SHIFTER_CONTROL})')
+                        self.status_updated_event.fire(f'Failed to get shifters ({SHIFTER_CONTROL})')
                 if self.decrease_drift_rate:
                     self.__drift_vector = self.__drift_vector * (1 - time_difference / self.settings.drift_time_constant)
                     self.property_changed_event.fire('drift_vector')
                 if self.mode == 'auto' and self.decrease_drift_rate:
-                    self.set_vector(DRIFT_VECTOR_CONTROL, self.__drift_vector)
+                    self.set_vector(DRIFT_VECTOR_CONTROL, self.__drift_vector, wait=False)
                 self.__last_update = now
 
             with self.__lock:
@@ -806,8 +1490,89 @@ class DriftCorrector:
                     traceback.print_exc()
 
             now = time.time()
+            if control_values is not None:
+                shifter = [control_values[name][1] if control_values[name][0] else numpy.nan for name in shifter_names]
+                self.telemetry.record(start_time, self.__drift_vector, shifter, now - start_time, control_latency)
             time.sleep(max(0.0, self.settings.update_interval - (now - start_time)))
 
+        self.__start_or_stop_streaming_measurement()
+        self.__control_io.flush()
+        self.__control_io.close()
+
+    def get_aperture_patch_slices(self, image: _NDArray) -> typing.Tuple[slice, slice]:
+        """Returns the slices of the patch inside the (ronchigram) aperture that is used for registration."""
+        sum_, center_y, center_x, a, b, angle = self.__aperture_tracker.locate(image)
+        patch_size = max(min(0.8*b, self.settings.max_patch_radius), self.settings.min_patch_radius)
+        return (slice(int(round(center_y - patch_size)), int(round(center_y + patch_size))),
+                slice(int(round(center_x - patch_size)), int(round(center_x + patch_size))))
+
+    def create_streaming_measurement(self) -> typing.Optional[typing.Tuple[StreamingDriftMeasurement, float]]:
+        """
+        Returns a (not yet started) continuous drift measurement for the current axis and its pixel size in m, or
+        `None` if it cannot be created.
+        """
+        if self.axis == ('x', 'y'):
+            success, defocus = self.__stem_controller.TryGetVal('C10')
+            if not success:
+                self.status_updated_event.fire('Failed to get defocus from AS2.')
+                return None
+            camera = self.__stem_controller.ronchigram_camera
+            start_image = camera.grab_next_to_start()[0]
+            patch_slice_tuple = self.get_aperture_patch_slices(start_image.data)
+            pixel_size = float(start_image.dimensional_calibrations[0].scale * defocus)
+            grab_frame = lambda: numpy.asarray(camera.grab_next_to_finish()[0].data[patch_slice_tuple])
+        elif self.axis == ('u', 'v'):
+            scan = self.__stem_controller.scan_controller
+            start_image = scan.grab_next_to_start()[0]
+            pixel_size = float(start_image.dimensional_calibrations[0].scale * 1e-9)
+            grab_frame = lambda: numpy.asarray(scan.grab_next_to_finish()[0].data)
+        else:
+            self.status_updated_event.fire(f'Axis {self.axis} is not supported for drift measurement.')
+            return None
+        return StreamingDriftMeasurement(grab_frame, DriftRateEstimator(), ccorr_threshold=self.settings.ccorr_threshold), pixel_size
+
+    def measure_drift_streaming(self) -> None:
+        """
+        Measures the drift from every frame until the error of the drift rate is less than half a pixel over the
+        measure drift wait time (the accuracy of a two frame measurement), but for at most the wait time.
+        """
+        streaming_measurement = self.create_streaming_measurement()
+        if streaming_measurement is None:
+            return
+        measurement, pixel_size = streaming_measurement
+        estimator = measurement.estimator
+        rate_tolerance = 0.5 / self.settings.measure_sleep_time
+        self.status_updated_event.fire(f'Measuring drift for up to {self.settings.measure_sleep_time} s.')
+        measurement.start()
+        end_time = time.monotonic() + self.settings.measure_sleep_time
+        try:
+            while time.monotonic() < end_time and measurement.is_running:
+                if estimator.measurement_count >= 3 and estimator.rate_uncertainty < rate_tolerance:
+                    break
+                time.sleep(0.05)
+        finally:
+            measurement.stop()
+        if estimator.measurement_count < 3:
+            self.status_updated_event.fire(f'Poor correlation (less than 3 frames with correlation > {self.settings.ccorr_threshold}).')
+            return
+        drift_vector = estimator.rate * pixel_size
+        self.status_updated_event.fire(f'Measured drift ({self.axis[0]}, {self.axis[1]}): ({drift_vector[1]:.3g}, {drift_vector[0]:.3g}) m/s.')
+        if not self.enabled:
+            self.set_vector(DRIFT_VECTOR_CONTROL, (0.0, 0.0))
+        self.inform_vector(DRIFT_RATE_CONTROL, drift_vector[::-1])
+
+    def register_drift(self, start_image: _NDArray, end_image: _NDArray) -> typing.Optional[Registration.PatchRegistrationResult]:
+        """
+        Returns the shift (in pixels) of `end_image` relative to `start_image` from several patches that are registered
+        in parallel, or `None` if no patch correlates better than the threshold.
+        """
+        registration = Registration.register_patches(start_image, end_image, ccorr_threshold=self.settings.ccorr_threshold,
+                                                     num_workers=os.cpu_count() or 1)
+        if not registration.is_valid:
+            self.status_updated_event.fire(f'Poor correlation ({registration.ccorr:.2f} < {self.settings.ccorr_threshold}).')
+            return None
+        return registration
+
     def measure_drift_camera(self) -> None:
         success, defocus = self.__stem_controller.TryGetVal('C10')
         if not success:
@@ -820,22 +1585,16 @@ class DriftCorrector:
         time.sleep(self.settings.measure_sleep_time)
         end_image = camera.grab_next_to_start()[0]
         end_time = time.time()
-        aperture_mask = make_binary_image(start_image.data)
-        sum_, center_y, center_x, a, b, angle = calculate_image_moments(aperture_mask)
-        patch_size = max(min(0.8*b, self.settings.max_patch_radius), self.settings.min_patch_radius)
-        patch_slice_tuple = (slice(int(round(center_y - patch_size)), int(round(center_y + patch_size))),
-                             slice(int(round(center_x - patch_size)), int(round(center_x + patch_size))))
+        patch_slice_tuple = self.get_aperture_patch_slices(start_image.data)
         cropped_start_image = start_image.data[patch_slice_tuple]
         cropped_end_image = end_image.data[patch_slice_tuple]
-        ccorr_max, ccorr_max_location = xd.register_template(cropped_start_image, cropped_end_image)
-        # ccorr_image = xd.crosscorrelate(cropped_start_image, cropped_end_image).data
-        # ccorr_max_location = numpy.unravel_index(numpy.argmax(ccorr_image), ccorr_image.shape)
-        # ccorr_max = ccorr_image[ccorr_max_location]
-        if  ccorr_max < self.settings.ccorr_threshold:
-            self.status_updated_event.fire(f'Poor correlation ({ccorr_max:.2f} < {self.settings.ccorr_threshold}).')
+        registration = self.register_drift(cropped_start_image, cropped_end_image)
+        if registration is None:
             return
-        drift_vector = numpy.array(ccorr_max_location) * start_image.dimensional_calibrations[0].scale * defocus / (end_time - start_time)
-        self.status_updated_event.fire(f'Measured drift (x, y): ({drift_vector[1]:.3g}, {drift_vector[0]:.3g}) m/s.')
+        scale = start_image.dimensional_calibrations[0].scale * defocus / (end_time - start_time)
+        drift_vector = registration.shift * scale
+        uncertainty = registration.uncertainty * scale
+        self.status_updated_event.fire(f'Measured drift (x, y): ({drift_vector[1]:.3g} ± {uncertainty[1]:.2g}, {drift_vector[0]:.3g} ± {uncertainty[0]:.2g}) m/s.')
         if not self.enabled:
             self.set_vector(DRIFT_VECTOR_CONTROL, (0.0, 0.0))
         self.inform_vector(DRIFT_RATE_CONTROL, drift_vector[::-1])
@@ -848,18 +1607,21 @@ class DriftCorrector:
         time.sleep(self.settings.measure_sleep_time)
         end_image = scan.grab_next_to_start()[0]
         end_time = time.time()
-        ccorr_max, ccorr_max_location = xd.register_template(start_image, end_image)
-        if  ccorr_max < self.settings.ccorr_threshold:
-            self.status_updated_event.fire(f'Poor correlation ({ccorr_max:.2f} < {self.settings.ccorr_threshold}).')
+        registration = self.register_drift(start_image.data, end_image.data)
+        if registration is None:
             return
-        drift_vector = numpy.array(ccorr_max_location) * start_image.dimensional_calibrations[0].scale * 1e-9/ (end_time - start_time)
-        self.status_updated_event.fire(f'Measured drift (u, v): ({drift_vector[1]:.3g}, {drift_vector[0]:.3g}) m/s.')
+        scale = start_image.dimensional_calibrations[0].scale * 1e-9 / (end_time - start_time)
+        drift_vector = registration.shift * scale
+        uncertainty = registration.uncertainty * scale
+        self.status_updated_event.fire(f'Measured drift (u, v): ({drift_vector[1]:.3g} ± {uncertainty[1]:.2g}, {drift_vector[0]:.3g} ± {uncertainty[0]:.2g}) m/s.')
         if not self.enabled:
             self.set_vector(DRIFT_VECTOR_CONTROL, (0.0, 0.0))
         self.inform_vector(DRIFT_RATE_CONTROL, drift_vector[::-1])
 
     def measure_drift(self) -> None:
-        if self.axis == ('x', 'y'):
+        if self.settings.continuous_drift_measurement:
+            self.measure_drift_streaming()
+        elif self.axis == ('x', 'y'):
             self.measure_drift_camera()
         elif self.axis == ('u', 'v'):
             self.measure_drift_scan()
@@ -879,42 +1641,13 @@ def run() -> None:
 
 
 def _find_correct_port() -> typing.Optional[int]:
-    for port in [41532, 8090]:
-        result, message = query([], timeout=1.0, port=port)
-        if not message:
-            return port
-    return None
+    return as2_client.find_port(timeout=1.0)
 
 def get_url(*args: typing.Any, port: typing.Optional[int]=None) -> str:
     if port is None:
-        port = 41532
-    url = f'http://localhost:{port}/AS2'
-    for arg in args:
-        url += '/' + arg
-    return url
+        port = as2_client.DEFAULT_PORT
+    return f'http://localhost:{port}' + as2_client.get_path(*args)
 
 def query(path_components: typing.Iterable[str], value: typing.Optional[typing.Mapping[str, typing.Any]]=None, timeout: float=5.0, port: typing.Optional[int]=None) -> typing.Tuple[typing.Mapping[str, typing.Any], str]:
-        url = get_url(*path_components)
-        data = None
-        method = 'GET'
-        headers = dict()
-        result = dict()
-        message = ''
-        if value is not None:
-            data_dict: typing.Dict[str, typing.Any] = dict()
-            data_dict.update(value)
-            data = json.dumps(data_dict).encode('utf-8')
-            method = 'PUT'
-            headers['Content-Type'] = 'application/json'
-        req = urllib.request.Request(url=url, data=data, method=method, headers=headers)
-        try:
-            with urllib.request.urlopen(req, timeout=timeout) as response:
-                bytes_ = response.read()
-                if bytes_:
-                    result = json.loads(bytes_.decode('utf-8'))
-        except urllib.error.HTTPError as e:
-            message += 'Query failed with error {}'.format(str(e))
-        else:
-            if (method == 'GET' and response.status != 200) or (method == 'PUT' and response.status != 204):
-                message += 'Query failed with error code {:.0f}. Reason: {}'.format(response.status, response.reason)
-        return result, message
+    """Sends a request to AS2 on `port` (`AS2_PORT` if `None`) over a persistent connection, see `AS2Client.query`."""
+    return as2_client.get_client(port if port is not None else AS2_PORT).query(path_components, value=value, timeout=timeout)
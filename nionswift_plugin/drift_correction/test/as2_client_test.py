@@ -0,0 +1,137 @@
+import asyncio
+import http.server
+import json
+import socket
+import threading
+import typing
+import unittest
+
+from .. import as2_client
+from .. import drift_correction
+
+
+class AS2RequestHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for the AS2 REST interface that stores the values put to a path and counts the connections."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self) -> None:
+        super().setup()
+        typing.cast(AS2Server, self.server).connection_count += 1
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        pass
+
+    def __send(self, status: int, value: typing.Optional[typing.Mapping[str, typing.Any]]=None) -> None:
+        body = json.dumps(value).encode('utf-8') if value is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        if typing.cast(AS2Server, self.server).close_connections:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        values = typing.cast(AS2Server, self.server).values
+        if self.path == '/AS2':
+            self.__send(200, {'Version': 'test'})
+        elif self.path in values:
+            self.__send(200, values[self.path])
+        else:
+            self.__send(404)
+
+    def do_PUT(self) -> None:
+        length = int(self.headers.get('Content-Length', 0))
+        typing.cast(AS2Server, self.server).values[self.path] = json.loads(self.rfile.read(length))
+        self.__send(204)
+
+
+class AS2Server(http.server.ThreadingHTTPServer):
+
+    def __init__(self) -> None:
+        super().__init__(('localhost', 0), AS2RequestHandler)
+        self.daemon_threads = True
+        self.values: typing.Dict[str, typing.Any] = dict()
+        self.connection_count = 0
+        self.close_connections = False
+
+
+def get_unused_port() -> int:
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return int(s.getsockname()[1])
+
+
+class TestAS2Client(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.server = AS2Server()
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_queries_reuse_one_connection(self) -> None:
+        client = as2_client.AS2Client(self.port)
+        try:
+            self.assertEqual(({}, ''), client.query(('ui', 'popupedit'), value={'Visible': True}))
+            for _ in range(10):
+                self.assertEqual(({'Visible': True}, ''), client.query(('ui', 'popupedit')))
+            self.assertEqual(1, self.server.connection_count)
+            result, message = client.query(('missing',))
+            self.assertIn('404', message)
+        finally:
+            client.close()
+
+    def test_query_reconnects_when_server_closes_connection(self) -> None:
+        self.server.close_connections = True
+        client = as2_client.AS2Client(self.port)
+        try:
+            for _ in range(3):
+                self.assertEqual({'Version': 'test'}, client.query([])[0])
+            self.assertEqual(3, self.server.connection_count)
+        finally:
+            client.close()
+
+    def test_batch_returns_results_in_order(self) -> None:
+        for i in range(8):
+            self.server.values[f'/AS2/controls/c{i}'] = {'Value': i}
+        client = as2_client.AS2Client(self.port, max_connections=3)
+        try:
+            results = client.batch([(('controls', f'c{i}'), None) for i in range(8)] + [(('controls', 'c0'), {'Value': -1})])
+            self.assertEqual([({'Value': i}, '') for i in range(8)] + [({}, '')], results)
+            self.assertLessEqual(self.server.connection_count, 3)
+            self.assertEqual({'Value': -1}, self.server.values['/AS2/controls/c0'])
+        finally:
+            client.close()
+
+    def test_async_query_and_batch(self) -> None:
+        client = as2_client.AS2Client(self.port)
+
+        async def run() -> typing.Tuple[typing.Any, typing.Any]:
+            put_result = await client.query_async(('ui', 'popupedit'), value={'Visible': False})
+            return put_result, await client.batch_async([(('ui', 'popupedit'), None), ([], None)])
+
+        try:
+            put_result, batch_results = asyncio.run(run())
+            self.assertEqual(({}, ''), put_result)
+            self.assertEqual([({'Visible': False}, ''), ({'Version': 'test'}, '')], batch_results)
+        finally:
+            client.close()
+
+    def test_connection_failure_returns_message(self) -> None:
+        client = as2_client.AS2Client(get_unused_port())
+        result, message = client.query([], timeout=1.0)
+        self.assertEqual({}, result)
+        self.assertTrue(message)
+
+    def test_find_port_and_query_use_the_given_port(self) -> None:
+        port = as2_client.find_port([get_unused_port(), self.port])
+        self.assertEqual(self.port, port)
+        # the found port is remembered
+        self.assertEqual(self.port, as2_client.find_port([get_unused_port(), self.port]))
+        self.assertEqual(({'Version': 'test'}, ''), drift_correction.query([], port=self.port))
+        self.assertEqual(f'http://localhost:{self.port}/AS2/ui/popupedit', drift_correction.get_url('ui', 'popupedit', port=self.port))
@@ -0,0 +1,471 @@
+import collections
+import os
+import tempfile
+import threading
+import time
+import typing
+import unittest
+
+import numpy
+import numpy.typing
+import scipy.ndimage
+
+from nion.data import Calibration
+from nion.data import DataAndMetadata
+
+from .. import drift_correction
+
+
+class SimulatedStemController:
+    """
+    Stand-in for the stem controller that keeps the AS2 controls in a dict and has a drifting scan. Each call takes
+    `latency` seconds and is counted in `calls`. Writing the controls in `failing_controls` fails.
+    """
+
+    def __init__(self, drift_rate: typing.Tuple[float, float]=(0.0, 0.0), pixel_size_nm: float=0.1,
+                 frame_time: float=0.0, clock: typing.Callable[[], float]=time.monotonic, latency: float=0.0):
+        self.values: typing.Dict[str, float] = {'DriftCompensation.u': 0.0, 'DriftCompensation.v': 0.0,
+                                                'CSH.u': 0.0, 'CSH.v': 0.0}
+        self.scan_controller = SimulatedScan(self, drift_rate, pixel_size_nm, frame_time, clock)
+        self.latency = latency
+        self.calls: typing.Counter[typing.Tuple[str, str]] = collections.Counter()
+        self.writes: typing.List[typing.Tuple[str, float]] = list()
+        self.failing_controls: typing.Set[str] = set()
+        self.__lock = threading.Lock()
+
+    def __call(self, method: str, name: str) -> None:
+        time.sleep(self.latency)
+        with self.__lock:
+            self.calls[(method, name)] += 1
+
+    def TryGetVal(self, name: str) -> typing.Tuple[bool, typing.Optional[float]]:
+        self.__call('TryGetVal', name)
+        return name in self.values, self.values.get(name)
+
+    def SetVal(self, name: str, value: float) -> bool:
+        self.__call('SetVal', name)
+        if name in self.failing_controls:
+            return False
+        self.values[name] = value
+        with self.__lock:
+            self.writes.append((name, value))
+        return True
+
+    def SetValAndConfirm(self, name: str, value: float, tolerance: float, timeout: int) -> bool:
+        return self.SetVal(name, value)
+
+    def InformControl(self, name: str, value: float) -> bool:
+        return self.SetVal(name, value)
+
+
+class SimulatedScan:
+    """
+    Scans a static random sample that drifts with `drift_rate` (m/s in y, x order) plus the probe shifter, i.e. the
+    drift compensation is the negative drift rate. The sample moves by the negative drift, so that the registration
+    measures the drift itself. Grabbing the frames in `failing_frames` raises an error.
+    """
+
+    def __init__(self, stem_controller: SimulatedStemController, drift_rate: typing.Tuple[float, float],
+                 pixel_size_nm: float, frame_time: float, clock: typing.Callable[[], float]):
+        self.__stem_controller = stem_controller
+        self.drift_rate = numpy.array(drift_rate)
+        self.pixel_size_nm = pixel_size_nm
+        self.frame_time = frame_time
+        self.__clock = clock
+        self.__start_time = clock()
+        self.__sample = scipy.ndimage.gaussian_filter(numpy.random.default_rng(0).random((128, 128)), 2.0)
+        self.bad_frames: typing.Set[int] = set()
+        self.failing_frames: typing.Set[int] = set()
+        self.frame_count = 0
+        self.__lock = threading.Lock()
+
+    def grab_next_to_start(self) -> typing.List[DataAndMetadata.DataAndMetadata]:
+        with self.__lock:
+            time.sleep(self.frame_time)
+            if self.frame_count in self.failing_frames:
+                self.frame_count += 1
+                raise RuntimeError('Failed to grab frame.')
+            values = self.__stem_controller.values
+            shifter = numpy.array((values['CSH.v'], values['CSH.u']))
+            position = self.drift_rate * (self.__clock() - self.__start_time) + shifter
+            frame = scipy.ndimage.shift(self.__sample, -position / (self.pixel_size_nm * 1e-9), order=1, mode='wrap')[32:96, 32:96]
+            if self.frame_count in self.bad_frames:
+                frame = numpy.random.default_rng(self.frame_count).random(frame.shape)
+            self.frame_count += 1
+        calibration = Calibration.Calibration(scale=self.pixel_size_nm, units='nm')
+        return [DataAndMetadata.new_data_and_metadata(frame, dimensional_calibrations=[calibration, calibration])]
+
+    def grab_next_to_finish(self) -> typing.List[DataAndMetadata.DataAndMetadata]:
+        return self.grab_next_to_start()
+
+
+class FakeClock:
+
+    def __init__(self) -> None:
+        self.time = 0.0
+
+    def __call__(self) -> float:
+        return self.time
+
+
+def make_aperture_image(shape: typing.Tuple[int, int], center: typing.Tuple[float, float],
+                        half_axes: typing.Tuple[float, float], seed: int=0) -> numpy.typing.NDArray[numpy.float32]:
+    y, x = numpy.mgrid[:shape[0], :shape[1]]
+    aperture = ((y - center[0]) / half_axes[0])**2 + ((x - center[1]) / half_axes[1])**2 < 1
+    return (aperture * 100.0 + numpy.random.default_rng(seed).normal(0.0, 10.0, shape)).astype(numpy.float32)
+
+
+class TestDriftCorrection(unittest.TestCase):
+
+    def test_aperture_tracker_matches_full_resolution_and_reuses_geometry(self) -> None:
+        image = make_aperture_image((1100, 1000), (560.0, 470.0), (330.0, 250.0))
+        expected = drift_correction.calculate_image_moments(drift_correction.make_binary_image(image))
+        tracker = drift_correction.ApertureTracker(max_binned_size=256)
+        moments = tracker.locate(image)
+        self.assertEqual(1, tracker.detection_count)
+        self.assertAlmostEqual(expected[1], moments[1], delta=1.0)
+        self.assertAlmostEqual(expected[2], moments[2], delta=1.0)
+        self.assertAlmostEqual(expected[3], moments[3], delta=0.01 * expected[3])
+        self.assertAlmostEqual(expected[4], moments[4], delta=0.01 * expected[4])
+        # another frame of the same aperture is not detected again
+        self.assertEqual(moments, tracker.locate(make_aperture_image((1100, 1000), (560.0, 470.0), (330.0, 250.0), seed=1)))
+        self.assertEqual(1, tracker.detection_count)
+        # but a moved aperture is
+        moments = tracker.locate(make_aperture_image((1100, 1000), (500.0, 530.0), (330.0, 250.0)))
+        self.assertEqual(2, tracker.detection_count)
+        self.assertAlmostEqual(500.0, moments[1], delta=1.0)
+        self.assertAlmostEqual(530.0, moments[2], delta=1.0)
+
+    def test_aperture_tracker_blurs_edge_like_full_resolution(self) -> None:
+        # the aperture is cut by the left image border
+        for center in ((560.0, 470.0), (560.0, 150.0)):
+            with self.subTest(center=center):
+                image = make_aperture_image((1100, 1000), center, (330.0, 250.0))
+                expected = drift_correction.calculate_image_moments(drift_correction.make_binary_image(image))
+                moments = drift_correction.ApertureTracker(max_binned_size=256).locate(image)
+                for i in range(1, 5):
+                    self.assertAlmostEqual(expected[i], moments[i], delta=0.5)
+
+    def test_aperture_tracker_can_be_used_from_several_threads(self) -> None:
+        image = make_aperture_image((1100, 1000), (560.0, 470.0), (330.0, 250.0))
+        tracker = drift_correction.ApertureTracker(max_binned_size=256)
+        results = list()
+        threads = [threading.Thread(target=lambda: results.append(tracker.locate(image))) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, tracker.detection_count)
+        self.assertEqual(4, len(results))
+        self.assertEqual(1, len(set(results)))
+
+    def test_drift_rate_estimator_converges_and_rejects_outliers(self) -> None:
+        estimator = drift_correction.DriftRateEstimator(measurement_noise=0.25)
+        rng = numpy.random.default_rng(1)
+        rate = numpy.array((1.5, -0.5))
+        for i in range(40):
+            position = rate * i * 0.5 + rng.normal(0.0, 0.25, 2)
+            if i == 20:
+                position += 50.0
+            self.assertEqual(i != 20, estimator.update(i * 0.5, position))
+        self.assertEqual(1, estimator.outlier_count)
+        self.assertEqual(39, estimator.measurement_count)
+        self.assertTrue(numpy.allclose(rate, estimator.rate, atol=0.1))
+        self.assertLess(estimator.rate_uncertainty, 0.1)
+        estimator.offset_rate(-1.0 * rate)
+        self.assertTrue(numpy.allclose(0.0, estimator.rate, atol=0.1))
+
+    def test_streaming_measurement_follows_simulated_drift_over_reference_changes(self) -> None:
+        clock = FakeClock()
+        # 20 px/s in y and -10 px/s in x
+        stem_controller = SimulatedStemController((2e-9, -1e-9), clock=clock)
+        scan = stem_controller.scan_controller
+        scan.bad_frames = {10, 25}
+        measurement = drift_correction.StreamingDriftMeasurement(lambda: scan.grab_next_to_finish()[0].data,
+                                                                 drift_correction.DriftRateEstimator(), ccorr_threshold=0.4)
+        rates = list()
+        listener = measurement.rate_updated_event.listen(lambda rate, uncertainty: rates.append(rate))
+        accepted = list()
+        for i in range(40):
+            clock.time = i * 0.1
+            accepted.append(measurement.process_frame(scan.grab_next_to_finish()[0].data, clock.time))
+        self.assertEqual([10, 25], [i for i, frame_accepted in enumerate(accepted) if not frame_accepted])
+        # the frames moved by 80 px, so the reference was replaced several times
+        self.assertTrue(numpy.allclose((20.0, -10.0), measurement.estimator.rate, atol=1.0))
+        self.assertEqual(37, len(rates))
+        listener.close()
+
+    def test_measure_drift_streaming_informs_drift_rate(self) -> None:
+        stem_controller = SimulatedStemController((2e-9, -1e-9), frame_time=0.02)
+        settings = drift_correction.DriftCorrectionSettings()
+        settings.continuous_drift_measurement = True
+        settings.measure_sleep_time = 5
+        drift_corrector = drift_correction.DriftCorrector(stem_controller, settings)
+        drift_corrector.axis = ('u', 'v')
+        start_time = time.monotonic()
+        drift_corrector.measure_drift()
+        self.assertLess(time.monotonic() - start_time, settings.measure_sleep_time)
+        # drift rate is set in u (x), v (y) order
+        self.assertAlmostEqual(-1e-9, stem_controller.values['DriftRate.u'], delta=1e-10)
+        self.assertAlmostEqual(2e-9, stem_controller.values['DriftRate.v'], delta=1e-10)
+
+    def test_measure_drift_scan_registers_patches(self) -> None:
+        stem_controller = SimulatedStemController((2e-9, -1e-9))
+        settings = drift_correction.DriftCorrectionSettings()
+        settings.measure_sleep_time = 0.5
+        drift_corrector = drift_correction.DriftCorrector(stem_controller, settings)
+        drift_corrector.axis = ('u', 'v')
+        messages = list()
+        listener = drift_corrector.status_updated_event.listen(messages.append)
+        drift_corrector.measure_drift()
+        self.assertIn('±', messages[-1])
+        # drift rate is set in u (x), v (y) order
+        self.assertAlmostEqual(-1e-9, stem_controller.values['DriftRate.u'], delta=1e-10)
+        self.assertAlmostEqual(2e-9, stem_controller.values['DriftRate.v'], delta=1e-10)
+        # frames that do not correlate are rejected
+        stem_controller.scan_controller.bad_frames = {2}
+        drift_corrector.measure_drift()
+        self.assertTrue(messages[-1].startswith('Poor correlation'))
+        listener.close()
+
+    def test_measure_drift_while_correcting_on_slow_controller(self) -> None:
+        # the correction loop keeps queueing writes, measuring only waits for its own
+        stem_controller = SimulatedStemController((2e-9, -1e-9), latency=0.05)
+        settings = drift_correction.DriftCorrectionSettings()
+        settings.measure_sleep_time = 0.5
+        drift_corrector = drift_correction.DriftCorrector(stem_controller, settings)
+        drift_corrector.axis = ('u', 'v')
+        drift_corrector.start()
+        try:
+            drift_corrector.enabled = True
+            time.sleep(0.3)
+            start_time = time.monotonic()
+            drift_corrector.measure_drift()
+            self.assertLess(time.monotonic() - start_time, settings.measure_sleep_time + 3.0)
+            self.assertAlmostEqual(-1e-9, stem_controller.values['DriftRate.u'], delta=1e-10)
+            self.assertAlmostEqual(2e-9, stem_controller.values['DriftRate.v'], delta=1e-10)
+        finally:
+            drift_corrector.enabled = False
+            drift_corrector.close()
+
+    def test_correction_loop_uses_continuously_measured_drift_rate(self) -> None:
+        stem_controller = SimulatedStemController((2e-9, -1e-9), frame_time=0.02)
+        settings = drift_correction.DriftCorrectionSettings()
+        settings.continuous_drift_measurement = True
+        drift_corrector = drift_correction.DriftCorrector(stem_controller, settings)
+        drift_corrector.axis = ('u', 'v')
+        drift_corrector.start()
+        try:
+            drift_corrector.enabled = True
+            end_time = time.monotonic() + 10.0
+            while time.monotonic() < end_time:
+                drift_vector = numpy.array((stem_controller.values['DriftCompensation.u'], stem_controller.values['DriftCompensation.v']))
+                if numpy.allclose((1e-9, -2e-9), drift_vector, atol=2e-10):
+                    break
+                time.sleep(0.1)
+            # the drift compensation is the negative drift rate in u (x), v (y) order
+            self.assertTrue(numpy.allclose((1e-9, -2e-9), drift_vector, atol=2e-10))
+        finally:
+            drift_corrector.enabled = False
+            drift_corrector.close()
+
+    def test_correction_loop_restarts_failed_streaming_measurement(self) -> None:
+        stem_controller = SimulatedStemController((2e-9, -1e-9), frame_time=0.02)
+        stem_controller.scan_controller.failing_frames = {5}
+        settings = drift_correction.DriftCorrectionSettings()
+        settings.continuous_drift_measurement = True
+        drift_corrector = drift_correction.DriftCorrector(stem_controller, settings)
+        drift_corrector.axis = ('u', 'v')
+        messages = list()
+        listener = drift_corrector.status_updated_event.listen(lambda message, **kwargs: messages.append(message))
+        drift_corrector.start()
+        try:
+            drift_corrector.enabled = True
+            end_time = time.monotonic() + 10.0
+            while time.monotonic() < end_time:
+                drift_vector = numpy.array((stem_controller.values['DriftCompensation.u'], stem_controller.values['DriftCompensation.v']))
+                if numpy.allclose((1e-9, -2e-9), drift_vector, atol=2e-10):
+                    break
+                time.sleep(0.1)
+            self.assertIn('Continuous drift measurement failed. Restarting.', messages)
+            self.assertTrue(numpy.allclose((1e-9, -2e-9), drift_vector, atol=2e-10))
+            # a measurement that keeps failing is given up
+            scan = stem_controller.scan_controller
+            scan.failing_frames = set(range(100000))
+            end_time = time.monotonic() + 10.0
+            while time.monotonic() < end_time and 'Continuous drift measurement failed.' not in messages:
+                time.sleep(0.1)
+            self.assertIn('Continuous drift measurement failed.', messages)
+            frame_count = scan.frame_count
+            time.sleep(0.5)
+            self.assertEqual(frame_count, scan.frame_count)
+        finally:
+            drift_corrector.enabled = False
+            drift_corrector.close()
+            listener.close()
+
+    def test_correction_loop_does_not_wait_for_streaming_measurement_frames(self) -> None:
+        stem_controller = SimulatedStemController(frame_time=0.5)
+        settings = drift_correction.DriftCorrectionSettings()
+        settings.continuous_drift_measurement = True
+        drift_corrector = drift_correction.DriftCorrector(stem_controller, settings)
+        drift_corrector.axis = ('u', 'v')
+        drift_corrector.start()
+        try:
+            start_time = time.monotonic()
+            drift_corrector.enabled = True
+            time.sleep(2.0)
+            # switching the mode stops the measurement, which waits for the current frame
+            drift_corrector.mode = 'manual'
+            time.sleep(1.0)
+            self.assertLess(time.monotonic() - start_time, 3.2)
+        finally:
+            drift_corrector.enabled = False
+            drift_corrector.close()
+        # the loop keeps its update interval of 0.1 s while the frames take 0.5 s each
+        self.assertGreater(len(drift_corrector.telemetry), 25)
+
+    def test_control_io_reads_concurrently_and_writes_in_background(self) -> None:
+        stem_controller = SimulatedStemController(latency=0.05)
+        stem_controller.failing_controls = {'Failing'}
+        control_io = drift_correction.ControlIO(stem_controller)
+        try:
+            start_time = time.monotonic()
+            values = control_io.read(['DriftCompensation.u', 'DriftCompensation.v', 'CSH.u', 'CSH.v', 'Missing'])
+            self.assertLess(time.monotonic() - start_time, 0.2)
+            self.assertEqual((True, 0.0), values['CSH.u'])
+            self.assertFalse(values['Missing'][0])
+            start_time = time.monotonic()
+            for i in range(5):
+                control_io.write('CSH.u', float(i))
+            control_io.write('CSH.v', 1.0, confirm=True)
+            control_io.write('Failing', 1.0)
+            self.assertLess(time.monotonic() - start_time, 0.05)
+            # queued values are returned without reading them
+            self.assertEqual((True, 4.0), control_io.read(['CSH.u'])['CSH.u'])
+            self.assertEqual((True, 4.0), control_io.get('CSH.u'))
+            self.assertTrue(control_io.flush(5.0))
+            # the writes are sent in order and queued writes of the same control are combined
+            self.assertEqual(('CSH.u', 4.0), stem_controller.writes[-2])
+            self.assertEqual(('CSH.v', 1.0), stem_controller.writes[-1])
+            self.assertLess(len(stem_controller.writes), 6)
+            self.assertEqual(1, stem_controller.calls[('TryGetVal', 'CSH.u')])
+            self.assertEqual(['Failing'], control_io.pop_failed_writes())
+            self.assertEqual([], control_io.pop_failed_writes())
+            self.assertFalse(control_io.get('Failing')[0])
+        finally:
+            control_io.close()
+
+    def test_control_io_reuses_its_read_threads(self) -> None:
+        stem_controller = SimulatedStemController(latency=0.01)
+        thread_ids = set()
+        try_get_val = stem_controller.TryGetVal
+
+        def recording_try_get_val(name: str) -> typing.Tuple[bool, typing.Optional[float]]:
+            thread_ids.add(threading.get_ident())
+            return try_get_val(name)
+
+        stem_controller.TryGetVal = recording_try_get_val  # type: ignore
+        control_io = drift_correction.ControlIO(stem_controller, max_concurrent_reads=2)
+        try:
+            for i in range(10):
+                control_io.read(['DriftCompensation.u', 'DriftCompensation.v', 'CSH.u', 'CSH.v'])
+            self.assertLessEqual(len(thread_ids), 2)
+        finally:
+            control_io.close()
+
+    def test_correction_loop_holds_update_interval_with_slow_controller(self) -> None:
+        stem_controller = SimulatedStemController(latency=0.02)
+        stem_controller.values['DriftCompensation.u'] = 1e-9
+        settings = drift_correction.DriftCorrectionSettings()
+        drift_corrector = drift_correction.DriftCorrector(stem_controller, settings)
+        drift_corrector.axis = ('u', 'v')
+        # the drift vector changes once per iteration, which should run every 0.1 s, and when it is read from AS2 (every 1 s)
+        iterations = list()
+        listener = drift_corrector.property_changed_event.listen(lambda name: iterations.append(name) if name == 'drift_vector' else None)
+        drift_corrector.start()
+        try:
+            drift_corrector.enabled = True
+            time.sleep(2.0)
+        finally:
+            drift_corrector.enabled = False
+            drift_corrector.close()
+            listener.close()
+        self.assertGreater(len(iterations), 18)
+        self.assertAlmostEqual(2e-9, stem_controller.values['CSH.u'], delta=0.5e-9)
+
+    def test_telemetry_recorder_keeps_latest_entries_and_exports_them(self) -> None:
+        telemetry = drift_correction.TelemetryRecorder(capacity=5)
+        for i in range(8):
+            telemetry.record(100.0 + 0.1 * i, numpy.array((i * 1e-9, -i * 1e-9)), (i * 1e-8, numpy.nan), 0.01, 0.002)
+        self.assertEqual(5, len(telemetry))
+        self.assertEqual(8, telemetry.total_count)
+        data = telemetry.get_data()
+        self.assertTrue(numpy.allclose(100.0 + 0.1 * numpy.arange(3, 8), data['time']))
+        self.assertTrue(numpy.allclose(numpy.arange(3, 8) * -1e-9, data['drift_vector_y']))
+        self.assertTrue(numpy.all(numpy.isnan(data['shifter_y'])))
+        xdata = telemetry.create_xdata(('shifter_x', 'drift_vector_x'), units='nm', scale=1e9)
+        self.assertEqual((2, 5), xdata.data_shape)
+        self.assertAlmostEqual(0.1, xdata.dimensional_calibrations[1].scale)
+        self.assertTrue(numpy.allclose(numpy.arange(3, 8) * 10.0, xdata.data[0]))
+        self.assertEqual(len(drift_correction.TelemetryRecorder.PLOTS), len(telemetry.create_xdata_list()))
+        with tempfile.TemporaryDirectory() as directory:
+            telemetry.save(os.path.join(directory, 'telemetry.npz'))
+            with numpy.load(os.path.join(directory, 'telemetry.npz')) as npz:
+                self.assertEqual(set(drift_correction.TelemetryRecorder.FIELDS), set(npz.keys()))
+                self.assertTrue(numpy.array_equal(data['time'], npz['time']))
+            telemetry.save(os.path.join(directory, 'telemetry.csv'))
+            csv = numpy.genfromtxt(os.path.join(directory, 'telemetry.csv'), delimiter=',', names=True)
+            self.assertEqual(drift_correction.TelemetryRecorder.FIELDS, csv.dtype.names)
+            self.assertTrue(numpy.allclose(data['shifter_x'], csv['shifter_x']))
+        telemetry.clear()
+        self.assertEqual(0, len(telemetry))
+        # recording has to be cheap enough to not matter for the correction loop
+        start_time = time.perf_counter()
+        for i in range(10000):
+            telemetry.record(float(i), numpy.zeros(2), (0.0, 0.0), 0.0, 0.0)
+        self.assertLess((time.perf_counter() - start_time) / 10000, 50e-6)
+
+    def test_telemetry_separates_correction_runs(self) -> None:
+        stem_controller = SimulatedStemController()
+        drift_corrector = drift_correction.DriftCorrector(stem_controller, drift_correction.DriftCorrectionSettings())
+        telemetry = drift_corrector.telemetry
+        drift_corrector.enabled = True
+        self.assertEqual(0, len(telemetry))
+        for i in range(3):
+            telemetry.record(100.0 + 0.1 * i, numpy.array((1e-9, 0.0)), (0.0, 0.0), 0.01, 0.002)
+        drift_corrector.enabled = False
+        drift_corrector.enabled = True
+        drift_corrector.enabled = True
+        for i in range(3):
+            telemetry.record(160.0 + 0.1 * i, numpy.array((2e-9, 0.0)), (0.0, 0.0), 0.01, 0.002)
+        # one mark between the runs, which breaks the line plots
+        self.assertEqual(7, len(telemetry))
+        xdata = telemetry.create_xdata(('drift_vector_x',), scale=1e9)
+        self.assertTrue(numpy.array_equal([False, False, False, True, False, False, False], numpy.isnan(xdata.data[0])))
+        # the pause does not stretch the time axis
+        self.assertAlmostEqual(0.1, xdata.dimensional_calibrations[1].scale)
+        drift_corrector.enabled = False
+        drift_corrector.close()
+
+    def test_correction_loop_records_telemetry(self) -> None:
+        stem_controller = SimulatedStemController(latency=0.02)
+        stem_controller.values['DriftCompensation.u'] = 1e-9
+        settings = drift_correction.DriftCorrectionSettings()
+        drift_corrector = drift_correction.DriftCorrector(stem_controller, settings)
+        drift_corrector.axis = ('u', 'v')
+        drift_corrector.start()
+        try:
+            drift_corrector.enabled = True
+            time.sleep(1.0)
+        finally:
+            drift_corrector.enabled = False
+            drift_corrector.close()
+        data = drift_corrector.telemetry.get_data()
+        self.assertGreater(len(drift_corrector.telemetry), 5)
+        self.assertTrue(numpy.all(numpy.diff(data['time']) > 0))
+        self.assertTrue(numpy.allclose(1e-9, data['drift_vector_x'], rtol=0.01))
+        # the shifter moves with the drift vector
+        self.assertTrue(numpy.all(numpy.diff(data['shifter_x']) > 0))
+        self.assertTrue(numpy.all(data['control_latency'] >= 0.02))
+        self.assertTrue(numpy.all(data['tick_duration'] >= data['control_latency']))
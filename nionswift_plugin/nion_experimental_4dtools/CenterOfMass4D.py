@@ -16,6 +16,8 @@ from nion.swift.model import Graphics
 from nion.swift.model import Symbolic
 from nion.ui import UserInterface
 
+from . import MaskedReduction
+
 _ = gettext.gettext
 
 _DataArrayType = np.typing.NDArray[typing.Any]
@@ -41,6 +43,13 @@ class CenterOfMass4D:
                 for graphic in graphics:
                     self.computation._computation.insert_item_into_objects('map_regions', 0, Symbolic.make_item(graphic._graphic))
 
+            def second_moments_changed(check_state: str) -> None:
+                second_moments_variable = self.computation._computation._get_variable('second_moments')
+                second_moments = check_state == 'checked'
+                if second_moments_variable:
+                    if second_moments_variable.value != second_moments:
+                        second_moments_variable.value = second_moments
+
             column = ui.create_column_widget()
             row = ui.create_row_widget()
 
@@ -52,6 +61,20 @@ class CenterOfMass4D:
 
             column.add_spacing(10)
             column.add(row)
+
+            # computations created by older versions do not have the second moments variable
+            second_moments_variable = self.computation._computation._get_variable('second_moments')
+            if second_moments_variable:
+                second_moments_row = ui.create_row_widget()
+                second_moments_check_box = ui.create_check_box_widget('Calculate beam width (second moments)')
+                second_moments_check_box.checked = second_moments_variable.value
+                second_moments_check_box.on_check_state_changed = second_moments_changed
+                second_moments_row.add_spacing(10)
+                second_moments_row.add(second_moments_check_box)
+                second_moments_row.add_stretch()
+                column.add_spacing(5)
+                column.add(second_moments_row)
+
             column.add_spacing(10)
             column.add_stretch()
 
@@ -61,31 +84,18 @@ class CenterOfMass4D:
 
         typing.cast(typing.Any, self.computation._computation).create_panel_widget = create_panel_widget
 
-    def execute(self, src: Facade.DataSource | None = None, map_regions: typing.Sequence[Graphics.Graphic] | None = None, **kwargs: typing.Any) -> None:
+    def execute(self, src: Facade.DataSource | None = None, map_regions: typing.Sequence[Graphics.Graphic] | None = None, second_moments: bool = False, **kwargs: typing.Any) -> None:
         assert src is not None
         assert map_regions is not None
         src_xdata = src.xdata
         assert src_xdata is not None
-        src_data = np.reshape(src_xdata.data, src_xdata.data_shape[:2] + (-1,))  # flatten the last two dimensions
         mask_data = np.zeros(src_xdata.data_shape[2:], dtype=np.bool_)
         for region in map_regions:
             mask_data = np.logical_or(mask_data, region.get_mask(src_xdata.data_shape[2:]))
-        grid_y, grid_x = np.mgrid[:mask_data.shape[0], :mask_data.shape[1]]
-        if mask_data.any():
-            ind = np.arange(mask_data.size)[mask_data.ravel()]
-            selected_data = src_data[..., ind]
-            selected_data_sum = np.sum(selected_data, axis=-1)
-            com_y = (grid_y[mask_data]).ravel()
-            com_x = (grid_x[mask_data]).ravel()
-            new_data = np.array((np.sum(com_y * selected_data, axis=-1) / selected_data_sum,
-                                 np.sum(com_x * selected_data, axis=-1) / selected_data_sum), dtype=np.float32)
-            # y = np.unique(np.indices(mask_data.shape)[0][mask_data])
-            # x = np.unique(np.indices(mask_data.shape)[1][mask_data])
-            # new_data = np.sum(xdata.src_data[..., x][..., y, :], axis=(-2, -1))
-        else:
-            data_sum = np.sum(src_data, axis=-1)
-            new_data = np.array((np.sum(src_data * grid_y.ravel(), axis=-1) / data_sum,
-                                 np.sum(src_data * grid_x.ravel(), axis=-1)) / data_sum, dtype=np.float32)
+        if not mask_data.any():
+            # without a mask, use the whole frames
+            mask_data = np.ones(src_xdata.data_shape[2:], dtype=np.bool_)
+        new_data = MaskedReduction.center_of_mass(src_xdata.data, mask_data, second_moments=second_moments).astype(np.float32)
         data_descriptor = DataAndMetadata.DataDescriptor(True, 0, 2)
         empty_calibration = Calibration.Calibration()
         intensity_calibration = Calibration.Calibration(units='px')
@@ -155,7 +165,7 @@ class CenterOfMass4DMenuItem:
                 self.__show_tool_tips(str(e))
 
 
-def center_of_mass_4D(api: Facade.API_1, window: Facade.DocumentWindow, display_item: Facade.Display, map_regions: typing.Sequence[Facade.Graphic]) -> Facade.DataItem:
+def center_of_mass_4D(api: Facade.API_1, window: Facade.DocumentWindow, display_item: Facade.Display, map_regions: typing.Sequence[Facade.Graphic], second_moments: bool = False) -> Facade.DataItem:
     display_data_channel = display_item._display_item.display_data_channel
     if not display_data_channel:
         raise ValueError("Display item must have a single display.")
@@ -169,6 +179,7 @@ def center_of_mass_4D(api: Facade.API_1, window: Facade.DocumentWindow, display_
     computation = document_model.create_computation()
     computation.create_input_item("src", Symbolic.make_item(display_data_channel))
     computation.create_input_item("map_regions", Symbolic.make_item_list([map_region._graphic for map_region in map_regions]))
+    computation.create_variable("second_moments", value_type="boolean", value=second_moments)
     computation.processing_id = "nion.center_of_mass_4d.2"
     document_model.set_data_item_computation(map_data_item._data_item, computation)
     map_display_item = document_model.get_display_item_for_data_item(map_data_item._data_item)
@@ -203,7 +214,8 @@ DocumentModel.DocumentModel.register_processing_descriptions({
         "title": _("Center of Mass Map"),
         "sources": [
             {"name": "src", "label": _("Source data item"), "data_type": "xdata"},
-            {"name": "map_regions", "label": _("Map graphics")}
+            {"name": "map_regions", "label": _("Map graphics")},
+            {"name": "second_moments", "label": _("Calculate beam width (second moments)")},
         ]
     }
 })
@@ -6,6 +6,8 @@ import uuid
 
 import numpy as np
 
+from nion.data import Calibration
+from nion.data import DataAndMetadata
 from nion.data import xdata_1_0 as xd
 from nion.swift import Facade
 from nion.swift.ComputationPanel import make_image_chooser
@@ -17,6 +19,48 @@ from nion.ui import UserInterface
 
 _ = gettext.gettext
 
+_DataArrayType = np.typing.NDArray[typing.Any]
+
+
+def calculate_dark_image(data: typing.Any, dark_area_slices: typing.Tuple[slice, slice], crop_slices: typing.Tuple[slice, slice]) -> _DataArrayType:
+    """Return the mean of the cropped frames in the dark area of 4D "data", reading one scan row at a time."""
+    dark_sum: typing.Optional[_DataArrayType] = None
+    row_range = range(data.shape[0])[dark_area_slices[0]]
+    column_count = len(range(data.shape[1])[dark_area_slices[1]])
+    for row in row_range:
+        row_sum = np.sum(np.asarray(data[(row, dark_area_slices[1]) + crop_slices]), axis=0)
+        dark_sum = row_sum if dark_sum is None else dark_sum + row_sum
+    assert dark_sum is not None
+    return typing.cast(_DataArrayType, dark_sum / (len(row_range) * column_count))
+
+
+def get_dark_correction_4D_result_shape(data_shape: DataAndMetadata.ShapeType, crop_slices: typing.Tuple[slice, slice], bin_spectrum: bool) -> DataAndMetadata.ShapeType:
+    cropped_shape = tuple(len(range(length)[crop_slice]) for length, crop_slice in zip(data_shape[2:], crop_slices))
+    return tuple(data_shape[:2]) + (cropped_shape[1:] if bin_spectrum else cropped_shape)
+
+
+def function_dark_correction_4D(data: typing.Any, dark_image: _DataArrayType, crop_slices: typing.Tuple[slice, slice],
+                                gain_factor: typing.Optional[_DataArrayType] = None, bin_spectrum: bool = False,
+                                out: typing.Optional[typing.Any] = None) -> typing.Any:
+    """Crop, dark subtract and gain correct 4D "data" one scan row at a time.
+
+    "dark_image" and "gain_factor" have the shape of the cropped frames. If "bin_spectrum" is set, the corrected frames
+    are summed along their first axis. The result is written into "out" (which can be an h5py dataset) if it is given,
+    otherwise a new array is returned.
+    """
+    result_shape = get_dark_correction_4D_result_shape(data.shape, crop_slices, bin_spectrum)
+    result_dtype = np.result_type(dark_image.dtype, gain_factor.dtype if gain_factor is not None else dark_image.dtype)
+    if out is None:
+        out = np.empty(result_shape, dtype=result_dtype)
+    assert tuple(out.shape) == result_shape
+    buffer = np.empty((data.shape[1],) + dark_image.shape, dtype=result_dtype)
+    for row in range(data.shape[0]):
+        np.subtract(np.asarray(data[(row, slice(None)) + crop_slices]), dark_image, out=buffer)
+        if gain_factor is not None:
+            buffer *= gain_factor
+        out[row] = np.sum(buffer, axis=-2) if bin_spectrum else buffer
+    return out
+
 
 class TotalBin4D:
     label = _("Total Bin 4D")
@@ -141,14 +185,13 @@ class DarkCorrection4D:
         data_shape = np.array(src1_xdata.data.shape)
         dark_area = np.rint(np.array(dark_area_region.bounds) * np.array((data_shape[:2], data_shape[:2]))).astype(np.int_)
         crop_area = np.rint(np.array(crop_region.bounds) * np.array((data_shape[2:], data_shape[2:]))).astype(np.int_)
+        dark_area_slices = (slice(dark_area[0, 0], dark_area[0, 0] + dark_area[1, 0]), slice(dark_area[0, 1], dark_area[0, 1] + dark_area[1, 1]))
+        crop_slices = (slice(crop_area[0, 0], crop_area[0, 0] + crop_area[1, 0]), slice(crop_area[0, 1], crop_area[0, 1] + crop_area[1, 1]))
 
-        dark_image = xd.sum(src1_xdata[dark_area[0, 0]:dark_area[0, 0]+dark_area[1, 0],
-                                  dark_area[0, 1]:dark_area[0, 1]+dark_area[1, 1],
-                                  crop_area[0, 0]:crop_area[0, 0]+crop_area[1, 0],
-                                  crop_area[0, 1]:crop_area[0, 1]+crop_area[1, 1]], axis=(0, 1))/(dark_area[1,0]*dark_area[1,1])
+        dark_image = calculate_dark_image(data, dark_area_slices, crop_slices)
 
-        self.__new_xdata = src1_xdata[..., crop_area[0, 0]:crop_area[0, 0]+crop_area[1, 0],
-                                      crop_area[0, 1]:crop_area[0, 1]+crop_area[1, 1]] - dark_image
+        # combine undoing the gain correction of the camera and applying the new gain into a single factor
+        gain_factor: typing.Optional[_DataArrayType] = None
 
         current_gain_image_uuid = metadata.get('hardware_source', {}).get('current_gain_image')
         current_gain_image: typing.Optional[Facade.DataItem] = None
@@ -158,8 +201,7 @@ class DarkCorrection4D:
             if gain_mode in ('custom', 'off') and current_gain_image:
                 assert current_gain_image.xdata
                 if current_gain_image.xdata.data_shape == src1_xdata.data_shape[2:]:
-                    self.__new_xdata /= current_gain_image.xdata[crop_area[0, 0]:crop_area[0, 0]+crop_area[1, 0],
-                                                                 crop_area[0, 1]:crop_area[0, 1]+crop_area[1, 1]]
+                    gain_factor = 1 / np.asarray(current_gain_image.xdata.data)[crop_slices]
 
         if ((gain_mode == 'auto' and not metadata.get('hardware_source', {}).get('is_gain_corrected') and current_gain_image) or
             (gain_mode == 'custom' and gain_image)):
@@ -168,17 +210,36 @@ class DarkCorrection4D:
 
             gain_xdata = gain_image[0].xdata if gain_mode == 'custom' else current_gain_image.xdata
 
-            if gain_xdata.data_shape == self.__new_xdata.data_shape[2:]:
-                self.__new_xdata *= gain_xdata
+            if gain_xdata.data_shape == dark_image.shape:
+                gain_data = np.asarray(gain_xdata.data)
             elif gain_xdata.data_shape == src1_xdata.data_shape[2:]:
-                self.__new_xdata *= gain_xdata[crop_area[0, 0]:crop_area[0, 0]+crop_area[1, 0],
-                                               crop_area[0, 1]:crop_area[0, 1]+crop_area[1, 1]]
+                gain_data = np.asarray(gain_xdata.data)[crop_slices]
             else:
                 raise ValueError('Shape of gain image has to match last two dimensions of input data.')
+            gain_factor = gain_factor * gain_data if gain_factor is not None else gain_data
             del gain_xdata
 
+        result_shape = get_dark_correction_4D_result_shape(src1_xdata.data_shape, crop_slices, bin_spectrum)
+        result_dtype = np.result_type(dark_image.dtype, gain_factor.dtype if gain_factor is not None else dark_image.dtype)
+        # write directly into the result data item if it has the right shape, so that the corrected data does not have
+        # to be kept in memory.
+        result_data_item = self.computation.get_result('target')
+        result_xdata = result_data_item.xdata if result_data_item else None
+        out = result_xdata.data if result_xdata and result_xdata.data_shape == result_shape and result_xdata.data_dtype == result_dtype else None
+        new_data = function_dark_correction_4D(data, dark_image, crop_slices, gain_factor, bin_spectrum, out=out)
+
+        dimensional_calibrations = list(src1_xdata.dimensional_calibrations[:2])
+        for calibration, crop_slice in zip(src1_xdata.dimensional_calibrations[2:], crop_slices):
+            dimensional_calibrations.append(Calibration.Calibration(calibration.offset + crop_slice.start * calibration.scale, calibration.scale, calibration.units))
+        data_descriptor = src1_xdata.data_descriptor
         if bin_spectrum:
-            self.__new_xdata = xd.sum(self.__new_xdata, axis=2)
+            dimensional_calibrations.pop(2)
+            data_descriptor = DataAndMetadata.DataDescriptor(data_descriptor.is_sequence, data_descriptor.collection_dimension_count, data_descriptor.datum_dimension_count - 1)
+        self.__new_xdata = DataAndMetadata.new_data_and_metadata(new_data,
+                                                                 intensity_calibration=src1_xdata.intensity_calibration,
+                                                                 dimensional_calibrations=dimensional_calibrations,
+                                                                 metadata=metadata,
+                                                                 data_descriptor=data_descriptor)
 
     def commit(self) -> None:
         self.computation.set_referenced_xdata('target', self.__new_xdata)
@@ -264,6 +325,16 @@ def dark_correction_4D(api: Facade.API_1, window: Facade.DocumentWindow, data_it
     dark_corrected_data_item = Facade.DataItem(DataItem.DataItem(large_format=True))
     dark_corrected_data_item._data_item.session_id = document_model.session_id
     document_model.append_data_item(dark_corrected_data_item._data_item)
+    # reserve the result (the crop region covers the whole frames initially), so that the computation can write
+    # directly into it.
+    src_xdata = data_item.xdata
+    data_descriptor = src_xdata.data_descriptor
+    if is_binned:
+        data_descriptor = DataAndMetadata.DataDescriptor(data_descriptor.is_sequence, data_descriptor.collection_dimension_count, data_descriptor.datum_dimension_count - 1)
+    result_shape = get_dark_correction_4D_result_shape(src_xdata.data_shape, (slice(None), slice(None)), is_binned)
+    # the dark image is the mean of some frames, so the result has the dtype of that mean
+    result_dtype = (np.sum(np.zeros((1,) + src_xdata.data_shape[3:], dtype=src_xdata.data_dtype), axis=0) / 1).dtype
+    dark_corrected_data_item._data_item.reserve_data(data_shape=result_shape, data_dtype=result_dtype, data_descriptor=data_descriptor)
     api.library.create_computation('nion.dark_correction_4d',
                                    inputs={'src1': data_item,
                                            'src2': total_bin_data_item,
@@ -1,7 +1,8 @@
+import dataclasses
+import datetime
 import threading
 import time
 import typing
-import uuid
 
 import numpy as np
 
@@ -9,38 +10,83 @@ from nion.swift import Facade
 
 _DataArrayType = np.typing.NDArray[typing.Any]
 
+# default size limit in bytes for all cached arrays together.
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+
+@dataclasses.dataclass
+class _CacheEntry:
+    data_modified: typing.Optional[datetime.datetime]
+    data: _DataArrayType
+    nbytes: int
+    last_requested: float
+
 
 class DataCache:
+    """Cache the (modified) data of several data items.
+
+    Entries are kept in least-recently-used order. Entries that have not been requested for "lifetime" seconds and
+    least recently used entries that exceed "max_bytes" are evicted when the cache is accessed. An entry is only used
+    while the data of its data item has not been modified since it was cached.
+    """
+
     def __init__(self, lifetime: float = 30.0,
-                 modify_data_fn: typing.Optional[typing.Callable[[_DataArrayType], _DataArrayType]] = None) -> None:
-        self.__cached_data: typing.Optional[_DataArrayType] = None
-        self.__cached_uuid: typing.Optional[str] = None
-        self.__last_requested = time.time()
+                 modify_data_fn: typing.Optional[typing.Callable[[_DataArrayType], _DataArrayType]] = None,
+                 max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.__entries: typing.Dict[str, _CacheEntry] = dict()
+        self.__lock = threading.Lock()
 
         self.lifetime = lifetime
+        self.max_bytes = max_bytes
         self.modify_data_fn = modify_data_fn if callable(modify_data_fn) else typing.cast(typing.Callable[[_DataArrayType], _DataArrayType], np.array)
 
-        self.__thread = threading.Thread(target=self.__cache_loop, daemon=True)
-        self.__lock = threading.Lock()
-        self.__thread.start()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__entries)
+
+    @property
+    def nbytes(self) -> int:
+        with self.__lock:
+            return sum(entry.nbytes for entry in self.__entries.values())
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
 
-    def __cache_loop(self) -> None:
-        while True:
-            with self.__lock:
-                now = time.time()
-                if now - self.__last_requested > self.lifetime:
-                    self.__cached_data = None
-                    self.__cached_uuid = None
-            time.sleep(0.5)
+    def __evict(self, now: float) -> None:
+        for key, entry in list(self.__entries.items()):
+            if now - entry.last_requested > self.lifetime:
+                self.__entries.pop(key)
+                self.evictions += 1
+        total_bytes = sum(entry.nbytes for entry in self.__entries.values())
+        # dicts keep insertion order, so the first entry is the least recently used one
+        while total_bytes > self.max_bytes and self.__entries:
+            total_bytes -= self.__entries.pop(next(iter(self.__entries))).nbytes
+            self.evictions += 1
 
     def get_cached_data(self, data_source: Facade.DataItem) -> typing.Optional[_DataArrayType]:
         uuid = str(data_source.uuid)
+        data_modified = data_source._data_item.data_modified
         with self.__lock:
-            if self.__cached_uuid != uuid:
+            now = time.monotonic()
+            self.__evict(now)
+            entry = self.__entries.pop(uuid, None)
+            if entry is not None and entry.data_modified == data_modified:
+                self.hits += 1
+            else:
                 xdata = data_source.xdata
                 assert xdata and xdata.data is not None
-                self.__cached_uuid = uuid
-                self.__cached_data = self.modify_data_fn(xdata.data)
-                #self.__cached_data = np.reshape(xdata.data, xdata.data.shape[:2] + (-1,))
-            self.__last_requested = time.time()
-            return self.__cached_data
+                data = self.modify_data_fn(xdata.data)
+                entry = _CacheEntry(data_modified, data, int(getattr(data, "nbytes", 0)), now)
+                self.misses += 1
+            entry.last_requested = now
+            # re-inserting moves the entry to the most recently used end. entries larger than the whole budget are
+            # returned but not kept.
+            if entry.nbytes <= self.max_bytes:
+                self.__entries[uuid] = entry
+                self.__evict(now)
+            return entry.data
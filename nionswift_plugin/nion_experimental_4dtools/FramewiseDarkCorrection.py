@@ -20,6 +20,74 @@ from nion.ui import UserInterface
 
 _ = gettext.gettext
 
+_DataArrayType = np.typing.NDArray[typing.Any]
+
+
+def get_area_slices(bounds: typing.Any, frame_shape: DataAndMetadata.ShapeType) -> typing.Tuple[slice, slice]:
+    """Return the slices of a frame of "frame_shape" covered by the rectangle "bounds" (in relative coordinates)."""
+    area = np.rint(np.array(bounds) * np.array(frame_shape)).astype(np.int_)
+    return slice(int(area[0, 0]), int(area[0, 0] + area[1, 0])), slice(int(area[0, 1]), int(area[0, 1] + area[1, 1]))
+
+
+def get_framewise_dark_correction_result_shape(data_shape: DataAndMetadata.ShapeType, spectrum_slices: typing.Tuple[slice, slice], bin_spectrum: bool) -> DataAndMetadata.ShapeType:
+    spectrum_shape = tuple(len(range(length)[area_slice]) for length, area_slice in zip(data_shape[2:], spectrum_slices))
+    return tuple(data_shape[:2]) + (spectrum_shape[1:] if bin_spectrum else spectrum_shape)
+
+
+def get_framewise_dark_correction_result_dtype(data_dtype: typing.Any, undo_gain_factor: typing.Optional[_DataArrayType] = None) -> np.dtype[typing.Any]:
+    # the dark image is the mean of some rows of the (gain un-corrected) data and determines the result dtype
+    dtype = np.mean(np.zeros((1,), dtype=data_dtype)).dtype
+    return np.result_type(dtype, undo_gain_factor.dtype) if undo_gain_factor is not None else dtype
+
+
+def function_framewise_dark_correction(data: typing.Any, spectrum_slices: typing.Tuple[slice, slice], top_dark_rows: slice,
+                                       bottom_dark_rows: slice, cam_center: int,
+                                       undo_gain_factor: typing.Optional[_DataArrayType] = None,
+                                       gain: typing.Optional[_DataArrayType] = None, bin_spectrum: bool = False,
+                                       out: typing.Optional[typing.Any] = None) -> typing.Any:
+    """Subtract the dark level measured in each frame of 4D "data" from the spectrum area, one scan row at a time.
+
+    The rows of the spectrum area above "cam_center" use the mean of the "top_dark_rows", the others use the mean of
+    the "bottom_dark_rows" (both within the columns of the spectrum area). "undo_gain_factor" (full frame shape) is
+    applied before measuring the dark level and "gain" (spectrum area shape) after subtracting it. Both are combined
+    into a single factor for the spectrum area. The result is written into "out" (which can be an h5py dataset) if it is
+    given, otherwise a new array is returned.
+    """
+    spectrum_rows, spectrum_columns = spectrum_slices
+    spectrum_row_range = range(data.shape[2])[spectrum_rows]
+    result_shape = get_framewise_dark_correction_result_shape(data.shape, spectrum_slices, bin_spectrum)
+    result_dtype = get_framewise_dark_correction_result_dtype(data.dtype, undo_gain_factor)
+    if out is None:
+        out = np.empty(result_shape, dtype=result_dtype)
+    assert tuple(out.shape) == result_shape
+    # rows before "split" are corrected with the top dark area, the others with the bottom dark area
+    split = min(max(cam_center - spectrum_row_range.start, 0), len(spectrum_row_range))
+    spectrum_factor: typing.Optional[_DataArrayType] = None
+    if undo_gain_factor is not None:
+        spectrum_factor = undo_gain_factor[spectrum_slices]
+    if gain is not None:
+        spectrum_factor = spectrum_factor * gain if spectrum_factor is not None else gain
+    buffer = np.empty((data.shape[1], len(spectrum_row_range), len(range(data.shape[3])[spectrum_columns])), dtype=result_dtype)
+    for row in range(data.shape[0]):
+        row_data = np.asarray(data[row])
+        np.copyto(buffer, row_data[:, spectrum_rows, spectrum_columns], casting='unsafe')
+        if spectrum_factor is not None:
+            buffer *= spectrum_factor
+        for dark_rows, buffer_rows in ((top_dark_rows, slice(0, split)), (bottom_dark_rows, slice(split, None))):
+            if len(range(buffer.shape[1])[buffer_rows]) == 0:
+                continue
+            dark_data = row_data[:, dark_rows, spectrum_columns]
+            if undo_gain_factor is not None:
+                dark_data = dark_data * undo_gain_factor[dark_rows, spectrum_columns]
+            # subtract the dark level by broadcasting it along the rows
+            dark_image = np.mean(dark_data, axis=-2, keepdims=True)
+            if gain is not None:
+                buffer[:, buffer_rows] -= dark_image * gain[buffer_rows]
+            else:
+                buffer[:, buffer_rows] -= dark_image
+        out[row] = np.sum(buffer, axis=-2) if bin_spectrum else buffer
+    return out
+
 
 class CalculateAverage4D:
     label = _("Frame Average 4D")
@@ -150,48 +218,21 @@ class FramewiseDarkCorrection:
             cam_center = sensor_dimensions['height']/2 - sensor_readout_area['top']
         else:
             cam_center = int(round(data_shape[-2]/2))
-        spectrum_area = np.rint(np.array(spectrum_region.bounds) * data_shape[2:]).astype(np.int_)
-        top_dark_area = np.rint(np.array(top_dark_region.bounds) * data_shape[2:]).astype(np.int_)
-        bottom_dark_area = np.rint(np.array(bottom_dark_region.bounds) * data_shape[2:]).astype(np.int_)
-        spectrum_range_y = np.array((spectrum_area[0,0], spectrum_area[0,0] + spectrum_area[1,0]))
-        spectrum_range_x = np.array((spectrum_area[0,1], spectrum_area[0,1] + spectrum_area[1,1]))
-        top_dark_area_range_y = np.array((top_dark_area[0,0], top_dark_area[0,0] + top_dark_area[1, 0]))
-        bottom_dark_area_range_y = np.array((bottom_dark_area[0,0], bottom_dark_area[0,0] + bottom_dark_area[1, 0]))
+        spectrum_slices = get_area_slices(spectrum_region.bounds, src1_xdata.data_shape[2:])
+        top_dark_slices = get_area_slices(top_dark_region.bounds, src1_xdata.data_shape[2:])
+        bottom_dark_slices = get_area_slices(bottom_dark_region.bounds, src1_xdata.data_shape[2:])
         # undo gain correction if neccessary
         current_gain_image_uuid = metadata.get('hardware_source', {}).get('current_gain_image')
         current_gain_image: typing.Optional[Facade.DataItem] = None
         if current_gain_image_uuid:
             current_gain_image = self.__api.library.get_data_item_by_uuid(uuid.UUID(current_gain_image_uuid))
+        undo_gain_factor: typing.Optional[_DataArrayType] = None
         if metadata.get('hardware_source', {}).get('is_gain_corrected') and current_gain_image:
             assert current_gain_image.xdata
             if current_gain_image.xdata.data_shape == src1_xdata.data_shape[2:]:
-                data = data/current_gain_image.xdata.data
-
-        if (cam_center >= spectrum_range_y).all(): # spectrum is above center
-            dark_image = np.mean(data[..., top_dark_area_range_y[0]:top_dark_area_range_y[1],
-                                      spectrum_range_x[0]:spectrum_range_x[1]], axis=-2, keepdims=True)
-            corrected_image = (data[..., spectrum_range_y[0]:spectrum_range_y[1], spectrum_range_x[0]:spectrum_range_x[1]] -
-                               np.repeat(dark_image, spectrum_range_y[1]-spectrum_range_y[0], axis=-2))
-        elif (cam_center <= spectrum_range_y).all(): # spectrum is below center
-            dark_image = np.mean(data[..., bottom_dark_area_range_y[0]:bottom_dark_area_range_y[1],
-                                      spectrum_range_x[0]:spectrum_range_x[1]], axis=-2, keepdims=True)
-            corrected_image = (data[..., spectrum_range_y[0]:spectrum_range_y[1], spectrum_range_x[0]:spectrum_range_x[1]] -
-                               np.repeat(dark_image, spectrum_range_y[1]-spectrum_range_y[0], axis=-2))
-        else: # spectrum is on top of center
-            dark_image = np.mean(data[..., top_dark_area_range_y[0]:top_dark_area_range_y[1],
-                                      spectrum_range_x[0]:spectrum_range_x[1]], axis=-2, keepdims=True)
-            corrected_image_top = (data[..., spectrum_range_y[0]:cam_center, spectrum_range_x[0]:spectrum_range_x[1]] -
-                                   np.repeat(dark_image, cam_center-spectrum_range_y[0], axis=-2))
-            dark_image = np.mean(data[..., bottom_dark_area_range_y[0]:bottom_dark_area_range_y[1],
-                                      spectrum_range_x[0]:spectrum_range_x[1]], axis=-2, keepdims=True)
-            corrected_image_bot = (data[..., cam_center:spectrum_range_y[1], spectrum_range_x[0]:spectrum_range_x[1]] -
-                                   np.repeat(dark_image, spectrum_range_y[1]-cam_center, axis=-2))
-            corrected_image = np.concatenate((corrected_image_top, corrected_image_bot), axis=-2)
-            del corrected_image_top
-            del corrected_image_bot
-        del data
-        del dark_image # don't hold references to unused objects so that garbage collector can free the memory
+                undo_gain_factor = 1 / np.asarray(current_gain_image.xdata.data)
 
+        gain_data: typing.Optional[_DataArrayType] = None
         if ((gain_mode == 'auto' and current_gain_image) or # apply gain correction if needed
             (gain_mode == 'custom' and gain_image)):
             assert current_gain_image
@@ -199,18 +240,27 @@ class FramewiseDarkCorrection:
             gain_xdata = gain_image[0].xdata if gain_mode == 'custom' else current_gain_image.xdata
             assert gain_xdata
 
-            if gain_xdata.data_shape == corrected_image.shape[2:]:
-                corrected_image *= gain_xdata.data
+            spectrum_shape = tuple(len(range(length)[area_slice]) for length, area_slice in zip(src1_xdata.data_shape[2:], spectrum_slices))
+            if gain_xdata.data_shape == spectrum_shape:
+                gain_data = np.asarray(gain_xdata.data)
             elif gain_xdata.data_shape == src1_xdata.data_shape[2:]:
-                corrected_image *= gain_xdata.data[spectrum_range_y[0]:spectrum_range_y[1],
-                                                   spectrum_range_x[0]:spectrum_range_x[1]]
+                gain_data = np.asarray(gain_xdata.data)[spectrum_slices]
             else:
                 raise ValueError('Shape of gain image has to match last two dimensions of input data.')
             del gain_xdata
 
+        result_shape = get_framewise_dark_correction_result_shape(src1_xdata.data_shape, spectrum_slices, bin_spectrum)
+        result_dtype = get_framewise_dark_correction_result_dtype(src1_xdata.data_dtype, undo_gain_factor)
+        # write directly into the result data item if it has the right shape, so that the corrected data does not have
+        # to be kept in memory.
+        result_data_item = self.computation.get_result('target')
+        result_xdata = result_data_item.xdata if result_data_item else None
+        out = result_xdata.data if result_xdata and result_xdata.data_shape == result_shape and result_xdata.data_dtype == result_dtype else None
+        corrected_image = function_framewise_dark_correction(data, spectrum_slices, top_dark_slices[0], bottom_dark_slices[0], int(cam_center),
+                                                             undo_gain_factor, gain_data, bin_spectrum, out=out)
+
         dimensional_calibrations = copy.deepcopy(list(src1_xdata.dimensional_calibrations))
         if bin_spectrum:
-            corrected_image = np.sum(corrected_image, axis=-2)
             dimensional_calibrations = dimensional_calibrations[:2] + dimensional_calibrations[3:]
 
         data_descriptor = DataAndMetadata.DataDescriptor(False, 2, 1 if bin_spectrum else 2)
@@ -308,6 +358,12 @@ def framewise_correction_4D(api: Facade.API_1, window: Facade.DocumentWindow, da
     dark_corrected_data_item = Facade.DataItem(DataItem.DataItem(large_format=True))
     document_model.append_data_item(dark_corrected_data_item._data_item)
     dark_corrected_data_item._data_item.session_id = document_model.session_id
+    # reserve the result for the initial spectrum area, so that the computation can write directly into it.
+    src_xdata = data_item.xdata
+    spectrum_slices = get_area_slices(spectrum_graphic.bounds, src_xdata.data_shape[2:])
+    dark_corrected_data_item._data_item.reserve_data(data_shape=get_framewise_dark_correction_result_shape(src_xdata.data_shape, spectrum_slices, True),
+                                                     data_dtype=get_framewise_dark_correction_result_dtype(src_xdata.data_dtype),
+                                                     data_descriptor=DataAndMetadata.DataDescriptor(False, 2, 1))
     api.library.create_computation('nion.framewise_dark_correction',
                                    inputs={'src1': data_item,
                                            'src2': average_data_item,
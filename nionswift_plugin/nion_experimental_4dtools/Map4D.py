@@ -1,6 +1,7 @@
 # system imports
 import gettext
 import typing
+import weakref
 
 import numpy as np
 
@@ -13,10 +14,15 @@ from nion.swift.model import Symbolic
 from nion.swift.model import DocumentModel
 from nion.ui import UserInterface
 
+from . import MaskedReduction
+
 _ = gettext.gettext
 
 _DataArrayType = np.typing.NDArray[typing.Any]
 
+# the computation handler is created for each execution, so keep the state for incremental updates per computation.
+_incremental_sums: weakref.WeakKeyDictionary[Symbolic.Computation, MaskedReduction.IncrementalMaskedSum] = weakref.WeakKeyDictionary()
+
 
 class Map4D:
     label = _("Map 4D")
@@ -63,19 +69,15 @@ class Map4D:
         assert map_regions is not None
         assert src.xdata
         src_xdata = src.xdata
-        data = np.reshape(src_xdata.data, src_xdata.data_shape[:2] + (-1,))  # flatten the last two dimensions
-        assert data is not None
         mask_data = np.zeros(src_xdata.data_shape[2:], dtype=np.bool_)
         for region in map_regions:
             mask_data = np.logical_or(mask_data, region.get_mask(src_xdata.data_shape[2:]))
-        if mask_data.any():
-            ind = np.arange(mask_data.size)[mask_data.ravel()]
-            new_data = np.sum(data[..., ind], axis=(-1))
-            # y = np.unique(np.indices(mask_data.shape)[0][mask_data])
-            # x = np.unique(np.indices(mask_data.shape)[1][mask_data])
-            # new_data = np.sum(xdata.data[..., x][..., y, :], axis=(-2, -1))
-        else:
-            new_data = np.sum(data, axis=-1)
+        if not mask_data.any():
+            # without a mask, sum the whole frames
+            mask_data = np.ones(src_xdata.data_shape[2:], dtype=np.bool_)
+        incremental_sum = _incremental_sums.setdefault(self.computation._computation, MaskedReduction.IncrementalMaskedSum())
+        data_key = (src_xdata.data_shape, src_xdata.data_dtype, src_xdata.timestamp)
+        new_data = incremental_sum.update(src_xdata.data, mask_data, data_key)
         self.__new_xdata = DataAndMetadata.new_data_and_metadata(new_data,
                                                                  dimensional_calibrations=src_xdata.dimensional_calibrations[:2],
                                                                  intensity_calibration=src_xdata.intensity_calibration)
@@ -13,6 +13,8 @@ from nion.swift.model import Symbolic
 from nion.swift.model import DocumentModel
 from nion.ui import UserInterface
 
+from . import MaskedReduction
+
 _ = gettext.gettext
 
 _DataArrayType = np.typing.NDArray[typing.Any]
@@ -210,29 +212,23 @@ class Map4DRGB:
         assert map_regions_b is not None
         assert src.xdata
         src_xdata = src.xdata
-        data = np.reshape(src_xdata.data, src_xdata.data_shape[:2] + (-1,))  # flatten the last two dimensions
         rgb_data = np.zeros(src_xdata.data_shape[:2] + (3,), dtype=np.uint8)
         map_regions_rgb = (map_regions_b, map_regions_g, map_regions_r)
         channels_enabled = (enabled_b, enabled_g, enabled_r)
         gammas = (gamma_b, gamma_g, gamma_r)
-        for i in range(len(map_regions_rgb)):
-            if not channels_enabled[i]:
-                continue
-            assert data is not None
-            map_regions = map_regions_rgb[i]
-            mask_data = np.zeros(src_xdata.data_shape[2:], dtype=np.bool_)
-            for region in map_regions:
-                mask_data = np.logical_or(mask_data, region.get_mask(src_xdata.data_shape[2:]))
-            if mask_data.any():
-                ind = np.arange(mask_data.size)[mask_data.ravel()]
-                new_data = np.sum(data[..., ind], axis=(-1))
-                #y = np.unique(np.indices(mask_data.shape)[0][mask_data])
-                #x = np.unique(np.indices(mask_data.shape)[1][mask_data])
-                #new_data = np.sum(xdata.data[..., x][..., y, :], axis=(-2, -1))
-                rgb_data[..., i] = self.convert_to_8_bit(new_data, gammas[i])
-
-            else:
-                rgb_data[..., i] = self.convert_to_8_bit(np.sum(data, axis=-1), gammas[i])
+        channels = [i for i in range(len(map_regions_rgb)) if channels_enabled[i]]
+        if channels:
+            masks = np.zeros((len(channels),) + tuple(src_xdata.data_shape[2:]), dtype=np.bool_)
+            for mask_data, i in zip(masks, channels):
+                for region in map_regions_rgb[i]:
+                    mask_data |= region.get_mask(src_xdata.data_shape[2:]).astype(np.bool_)
+                if not mask_data.any():
+                    # without a mask, sum the whole frames
+                    mask_data[...] = True
+            # calculate the sums of all enabled channels in one pass over the data
+            channel_data = MaskedReduction.masked_sums(src_xdata.data, masks)
+            for j, i in enumerate(channels):
+                rgb_data[..., i] = self.convert_to_8_bit(channel_data[..., j], gammas[i])
 
         self.__new_xdata = DataAndMetadata.new_data_and_metadata(rgb_data,
                                                                  dimensional_calibrations=src_xdata.dimensional_calibrations[:2],
@@ -0,0 +1,167 @@
+"""
+Masked reductions of 4D (scan x detector) data, i.e. virtual detector images.
+
+The data is processed in blocks of scan rows. Within a block, only the detector rows that contain masked pixels are
+read, and the sums are calculated as a matrix product of the (scan positions x detector pixels) view of the block with
+the (detector pixels x detectors) weight matrix, so any number of detectors is calculated in the same pass. For
+contiguous data this view does not copy, so the data is only read once. Data that is not in memory (i.e. an HDF5
+dataset) is read block by block.
+"""
+
+import typing
+
+import numpy
+import numpy.typing
+
+_NDArray = numpy.typing.NDArray[typing.Any]
+
+# the size in bytes of the data read for one block of scan rows.
+MASKED_REDUCTION_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def sum_dtype(dtype: numpy.typing.DTypeLike) -> numpy.dtype[typing.Any]:
+    """Return the dtype that "numpy.sum" uses for data of "dtype"."""
+    return typing.cast(numpy.dtype[typing.Any], numpy.sum(numpy.zeros((1,), dtype=dtype)).dtype)
+
+
+def mask_row_band(mask: _NDArray) -> slice:
+    """Return the slice of the first mask axis that contains all masked pixels."""
+    rows = numpy.flatnonzero(numpy.any(mask.reshape(mask.shape[0], -1), axis=-1))
+    if rows.size == 0:
+        return slice(0, 0)
+    return slice(int(rows[0]), int(rows[-1]) + 1)
+
+
+def weighted_sums(data: typing.Any, weights: _NDArray, block_size: typing.Optional[int] = None) -> _NDArray:
+    """Calculate the weighted sums of the frames of "data" for a stack of detectors in a single pass over the data.
+
+    "data" can be a numpy array or an array-like that supports slicing (i.e. an h5py dataset). Its last dimensions have
+    to match the shape of the detectors in "weights", the remaining dimensions are navigation dimensions. "weights" has
+    the detector index as first axis. The result has the navigation shape of "data" with the detector index as last
+    axis.
+    """
+    weights = numpy.asarray(weights)
+    detector_count = weights.shape[0]
+    detector_shape = weights.shape[1:]
+    data_shape = tuple(data.shape)
+    navigation_shape = data_shape[:len(data_shape) - len(detector_shape)]
+    assert len(navigation_shape) > 0
+    assert data_shape[len(navigation_shape):] == detector_shape
+    result_dtype = numpy.promote_types(sum_dtype(data.dtype), weights.dtype)
+    result = numpy.zeros(navigation_shape + (detector_count,), dtype=result_dtype)
+    band = mask_row_band(numpy.any(weights != 0, axis=0))
+    # the (detector pixels x detectors) matrix for the pixels in the band
+    weight_matrix = numpy.ascontiguousarray(numpy.reshape(weights[:, band], (detector_count, -1)).T)
+    band_size = weight_matrix.shape[0]
+    if band_size == 0:
+        return result
+    # read whole scan rows (i.e. indices of the first navigation axis) at a time, but at least one.
+    row_size = int(numpy.prod(navigation_shape[1:], dtype=numpy.int64)) * band_size * numpy.dtype(data.dtype).itemsize
+    rows_per_block = max(1, (block_size or MASKED_REDUCTION_BLOCK_SIZE) // max(1, row_size))
+    inner_slices = (slice(None),) * (len(navigation_shape) - 1) + (band,) + (slice(None),) * (len(detector_shape) - 1)
+    for row in range(0, navigation_shape[0], rows_per_block):
+        row_slice = slice(row, min(row + rows_per_block, navigation_shape[0]))
+        block = numpy.asarray(data[(row_slice,) + inner_slices])
+        # reshape is a view for contiguous data, because the band spans whole detector rows
+        block_sums = numpy.reshape(block, (-1, band_size)) @ weight_matrix
+        result[row_slice] = numpy.reshape(block_sums, block.shape[:len(navigation_shape)] + (detector_count,))
+    return result
+
+
+def masked_sums(data: typing.Any, masks: _NDArray, block_size: typing.Optional[int] = None) -> _NDArray:
+    """Sum "data" over the pixels of each mask in the stack "masks" in a single pass over the data.
+
+    The result has the dtype that "numpy.sum" would return for "data" and the mask index as last axis.
+    """
+    masks = numpy.asarray(masks, dtype=bool)
+    return weighted_sums(data, masks.astype(sum_dtype(data.dtype)), block_size)
+
+
+def masked_sum(data: typing.Any, mask: _NDArray, block_size: typing.Optional[int] = None) -> _NDArray:
+    """Sum "data" over the pixels selected by "mask" for every navigation index.
+
+    "data" can be a numpy array or an array-like that supports slicing (i.e. an h5py dataset). Its last dimensions have
+    to match the shape of "mask", the remaining dimensions are navigation dimensions. The result has the dtype that
+    "numpy.sum" would return for "data" and is zero where "mask" is empty.
+    """
+    return masked_sums(data, numpy.asarray(mask)[numpy.newaxis], block_size)[..., 0]
+
+
+def center_of_mass(data: typing.Any, mask: _NDArray, second_moments: bool = False, block_size: typing.Optional[int] = None) -> _NDArray:
+    """Calculate the center of mass of the frames of 4D "data" within "mask" in a single pass over the data.
+
+    The zeroth and first (and optionally the second) moments are accumulated together with "weighted_sums", so no copy
+    of the selected data is made. The result has the moment index as first axis and contains the y and x center of mass
+    in pixels, followed by the standard deviations of the intensity distribution in y and x if "second_moments" is set.
+    """
+    mask = numpy.asarray(mask, dtype=bool)
+    assert mask.ndim == 2
+    grid_y, grid_x = numpy.mgrid[:mask.shape[0], :mask.shape[1]]
+    # use coordinates relative to the mask center to keep the second moments accurate
+    center_y = float(numpy.mean(grid_y[mask])) if mask.any() else 0.0
+    center_x = float(numpy.mean(grid_x[mask])) if mask.any() else 0.0
+    y = (grid_y - center_y) * mask
+    x = (grid_x - center_x) * mask
+    weights = [mask.astype(numpy.float64), y, x]
+    if second_moments:
+        weights += [y ** 2, x ** 2]
+    moments = numpy.moveaxis(weighted_sums(data, numpy.stack(weights), block_size), -1, 0)
+    mean_y = moments[1] / moments[0]
+    mean_x = moments[2] / moments[0]
+    result = [center_y + mean_y, center_x + mean_x]
+    if second_moments:
+        # use Var(X) = E(X^2) - E(X)^2 and clip small negative values from rounding errors
+        result += [numpy.sqrt(numpy.maximum(moments[3] / moments[0] - mean_y ** 2, 0.0)),
+                   numpy.sqrt(numpy.maximum(moments[4] / moments[0] - mean_x ** 2, 0.0))]
+    return numpy.array(result)
+
+
+class IncrementalMaskedSum:
+    """Keep the mask and result of the last masked sum and update the result for a changed mask.
+
+    When only a few pixels of the mask change (i.e. a region is moved by a small amount), the sums over the newly
+    included pixels are added to the previous result and the sums over the newly excluded pixels are subtracted. The
+    whole sum is recalculated when the data changed or when more pixels changed than are contained in the new mask.
+
+    Floating point results are accumulated in double precision so that repeated updates do not drift.
+    """
+
+    def __init__(self) -> None:
+        self.full_updates = 0
+        self.incremental_updates = 0
+        self.__data_key: typing.Any = None
+        self.__mask: typing.Optional[_NDArray] = None
+        self.__accumulator: typing.Optional[_NDArray] = None
+
+    def update(self, data: typing.Any, mask: _NDArray, data_key: typing.Any, block_size: typing.Optional[int] = None) -> _NDArray:
+        """Return the masked sum of "data" for "mask".
+
+        "data_key" identifies the contents of "data". The previous result is only reused if it is equal to the key of
+        the last call.
+        """
+        mask = numpy.asarray(mask, dtype=bool)
+        result_dtype = sum_dtype(data.dtype)
+        previous_mask = self.__mask
+        if (self.__accumulator is None or previous_mask is None or previous_mask.shape != mask.shape or
+                self.__data_key != data_key):
+            added = mask
+            removed = None
+        else:
+            added = numpy.logical_and(mask, numpy.logical_not(previous_mask))
+            removed = numpy.logical_and(previous_mask, numpy.logical_not(mask))
+            if numpy.count_nonzero(added) + numpy.count_nonzero(removed) > numpy.count_nonzero(mask):
+                added = mask
+                removed = None
+        if removed is None or self.__accumulator is None:
+            accumulator_dtype = numpy.promote_types(result_dtype, numpy.float64) if numpy.issubdtype(result_dtype, numpy.inexact) else result_dtype
+            self.__accumulator = masked_sum(data, added, block_size).astype(accumulator_dtype)
+            self.full_updates += 1
+        else:
+            if added.any():
+                self.__accumulator += masked_sum(data, added, block_size)
+            if removed.any():
+                self.__accumulator -= masked_sum(data, removed, block_size)
+            self.incremental_updates += 1
+        self.__data_key = data_key
+        self.__mask = mask.copy()
+        return self.__accumulator.astype(result_dtype)
@@ -1,9 +1,11 @@
 # standard libraries
+import io
 import time
 import typing
 import unittest
 
 # third party libraries
+import h5py
 import numpy
 import scipy
 
@@ -26,6 +28,7 @@ from .. import DarkCorrection4D
 from .. import FramewiseDarkCorrection
 from .. import Map4D
 from .. import Map4DRGB
+from .. import MaskedReduction
 
 
 Facade.initialize()
@@ -68,6 +71,27 @@ class TestComputations4D(unittest.TestCase):
             self.assertIn("Center of Mass", map_data_item.title)
             self.assertEqual(1, len(display_item.graphics))
             self.assertEqual(1, len(map_display_item.graphics))
+            # the region does not contain any pixel center of the 4x4 frames, so the whole frames are used
+            grid_y, grid_x = numpy.mgrid[:4, :4]
+            total = numpy.sum(xdata.data, axis=(-2, -1))
+            expected = [numpy.sum(xdata.data * grid_y, axis=(-2, -1)) / total, numpy.sum(xdata.data * grid_x, axis=(-2, -1)) / total]
+            self.assertTrue(numpy.allclose(map_data_item.data, expected, rtol=1e-4))
+
+    def test_center_of_mass_4D_computation_with_second_moments(self) -> None:
+        with create_memory_profile_context() as test_context:
+            document_controller = test_context.create_document_controller_with_application()
+            document_model = document_controller.document_model
+            xdata = DataAndMetadata.new_data_and_metadata(numpy.random.rand(4, 5, 8, 8), data_descriptor=DataAndMetadata.DataDescriptor(False, 2, 2))
+            data_item = DataItem.new_data_item(xdata)
+            document_model.append_data_item(data_item)
+            display_item = document_model.get_display_item_for_data_item(data_item)
+            document_controller.selected_display_panel.set_display_panel_display_item(display_item)
+            api = Facade.get_api("~1.0", "~1.0")
+            map_data_item = CenterOfMass4D.center_of_mass_4D(api, Facade.DocumentWindow(document_controller), Facade.Display(display_item), [], second_moments=True)
+            document_model.recompute_all()
+            self.assertFalse(any(computation.error_text for computation in document_model.computations))
+            self.assertEqual((4, 4, 5), map_data_item.data.shape)
+            self.assertTrue(numpy.allclose(map_data_item.data, MaskedReduction.center_of_mass(xdata.data, numpy.ones((8, 8), dtype=bool), second_moments=True)))
 
     def test_dark_correction_4D_computation(self) -> None:
         with create_memory_profile_context() as test_context:
@@ -89,6 +113,31 @@ class TestComputations4D(unittest.TestCase):
             self.assertEqual(3, len(document_model.data_items))
             self.assertIn("Total Bin 4D", bin_data_item.title)
             self.assertIn("4D Dark Correction", corrected_data_item.title)
+            # the dark area covers the scan rows 2 and 3, the spectra are binned
+            expected = numpy.sum(xdata.data - numpy.mean(xdata.data[2:4], axis=(0, 1)), axis=2)
+            self.assertTrue(numpy.allclose(expected, corrected_data_item.data))
+            self.assertEqual(1, corrected_data_item.xdata.datum_dimension_count)
+
+    def test_dark_correction_4D_matches_direct_calculation(self) -> None:
+        rng = numpy.random.default_rng(17)
+        data = rng.integers(0, 1000, (5, 6, 8, 10)).astype(numpy.uint16)
+        dark_area_slices = (slice(3, 5), slice(1, 6))
+        crop_slices = (slice(1, 7), slice(2, 10))
+        gain_factor = rng.random((6, 8))
+        dark_image = DarkCorrection4D.calculate_dark_image(data, dark_area_slices, crop_slices)
+        expected_dark_image = numpy.mean(data[3:5, 1:6, 1:7, 2:10], axis=(0, 1))
+        self.assertTrue(numpy.allclose(expected_dark_image, dark_image))
+        expected = (data[..., 1:7, 2:10] - expected_dark_image) * gain_factor
+        for bin_spectrum in (False, True):
+            with self.subTest(bin_spectrum=bin_spectrum):
+                expected_result = numpy.sum(expected, axis=2) if bin_spectrum else expected
+                result = DarkCorrection4D.function_dark_correction_4D(data, dark_image, crop_slices, gain_factor, bin_spectrum)
+                self.assertTrue(numpy.allclose(expected_result, result))
+                with h5py.File(io.BytesIO(), "w") as f:
+                    dataset = f.create_dataset("data", data=data)
+                    out = f.create_dataset("out", shape=expected_result.shape, dtype=float)
+                    DarkCorrection4D.function_dark_correction_4D(dataset, dark_image, crop_slices, gain_factor, bin_spectrum, out=out)
+                    self.assertTrue(numpy.allclose(expected_result, out[()]))
 
     def test_framewise_dark_correction_4D_computation(self) -> None:
         with create_memory_profile_context() as test_context:
@@ -110,6 +159,38 @@ class TestComputations4D(unittest.TestCase):
             self.assertEqual(3, len(document_model.data_items))
             self.assertIn("Frame Average 4D", average_data_item.title)
             self.assertIn("Framewise Dark Correction", corrected_data_item.title)
+            # the spectrum covers frame row 4, below the center of the frame; the bottom dark area is row 5
+            expected = numpy.sum(xdata.data[..., 4:5, :] - xdata.data[..., 5:6, :], axis=2)
+            self.assertTrue(numpy.allclose(expected, corrected_data_item.data))
+
+    def test_framewise_dark_correction_matches_direct_calculation(self) -> None:
+        rng = numpy.random.default_rng(19)
+        data = rng.integers(0, 1000, (3, 4, 20, 12)).astype(numpy.uint16)
+        undo_gain_factor = 1 / (rng.random((20, 12)) + 0.5)
+        gain = rng.random((6, 9)) + 0.5
+        spectrum_slices = (slice(7, 13), slice(2, 11))
+        for cam_center in (13, 10, 7):
+            # reference calculation: undo gain, subtract the dark mean of each frame, apply gain
+            frames = data * undo_gain_factor
+            top_dark = numpy.mean(frames[..., 1:4, 2:11], axis=-2, keepdims=True)
+            bottom_dark = numpy.mean(frames[..., 15:19, 2:11], axis=-2, keepdims=True)
+            spectrum = frames[..., 7:13, 2:11]
+            split = cam_center - 7
+            expected = numpy.concatenate((spectrum[..., :split, :] - top_dark, spectrum[..., split:, :] - bottom_dark), axis=-2) * gain
+            for bin_spectrum in (False, True):
+                with self.subTest(cam_center=cam_center, bin_spectrum=bin_spectrum):
+                    expected_result = numpy.sum(expected, axis=-2) if bin_spectrum else expected
+                    result = FramewiseDarkCorrection.function_framewise_dark_correction(data, spectrum_slices, slice(1, 4), slice(15, 19), cam_center,
+                                                                                        undo_gain_factor, gain, bin_spectrum)
+                    self.assertTrue(numpy.allclose(expected_result, result))
+        with h5py.File(io.BytesIO(), "w") as f:
+            dataset = f.create_dataset("data", data=data)
+            out = f.create_dataset("out", shape=(3, 4, 6, 9), dtype=float)
+            FramewiseDarkCorrection.function_framewise_dark_correction(dataset, spectrum_slices, slice(1, 4), slice(15, 19), 10, out=out)
+            top_dark = numpy.mean(data[..., 1:4, 2:11], axis=-2, keepdims=True)
+            bottom_dark = numpy.mean(data[..., 15:19, 2:11], axis=-2, keepdims=True)
+            expected = numpy.concatenate((data[..., 7:10, 2:11] - top_dark, data[..., 10:13, 2:11] - bottom_dark), axis=-2)
+            self.assertTrue(numpy.allclose(expected, out[()]))
 
     def test_map_4D_computation(self) -> None:
         with create_memory_profile_context() as test_context:
@@ -136,6 +217,104 @@ class TestComputations4D(unittest.TestCase):
             self.assertIn("Map 4D", map_data_item.title)
             self.assertEqual(1, len(display_item.graphics))
             self.assertEqual(1, len(map_display_item.graphics))
+            # the region does not contain any pixel center of the 4x4 frames, so the whole frames are summed
+            self.assertTrue(numpy.allclose(map_data_item.data, numpy.sum(xdata.data, axis=(-2, -1))))
+
+    def test_masked_sum_matches_fancy_index_sum(self) -> None:
+        rng = numpy.random.default_rng(3)
+        rectangle = numpy.zeros((12, 10), dtype=bool)
+        rectangle[3:7, 2:9] = True
+        y, x = numpy.mgrid[:12, :10]
+        ring = numpy.logical_and(numpy.hypot(y - 6, x - 5) > 2, numpy.hypot(y - 6, x - 5) < 4)
+        for dtype in (numpy.float32, numpy.float64, numpy.uint16, numpy.int32):
+            data = (rng.random((5, 7, 12, 10)) * 1000).astype(dtype)
+            for mask in (rectangle, ring, numpy.ones_like(rectangle)):
+                for block_size in (1, 3000, None):
+                    with self.subTest(dtype=dtype, block_size=block_size):
+                        expected = numpy.sum(data[..., mask], axis=-1)
+                        result = MaskedReduction.masked_sum(data, mask, block_size)
+                        self.assertEqual(expected.dtype, result.dtype)
+                        self.assertTrue(numpy.allclose(expected, result, rtol=1e-5))
+        self.assertFalse(numpy.any(MaskedReduction.masked_sum(data, numpy.zeros_like(rectangle))))
+
+    def test_masked_sum_reads_hdf5_data_in_blocks(self) -> None:
+        data = numpy.random.default_rng(5).random((6, 5, 8, 8))
+        mask = numpy.zeros((8, 8), dtype=bool)
+        mask[2:5, 1:7] = True
+        with h5py.File(io.BytesIO(), "w") as f:
+            dataset = f.create_dataset("data", data=data)
+            result = MaskedReduction.masked_sum(dataset, mask, 8 * 8 * 8)
+        self.assertTrue(numpy.allclose(numpy.sum(data[..., mask], axis=-1), result))
+
+    def test_masked_sums_match_single_mask_sums(self) -> None:
+        data = numpy.random.default_rng(9).random((5, 6, 12, 10))
+        masks = numpy.zeros((4, 12, 10), dtype=bool)
+        masks[0, 1:4, 2:5] = True
+        masks[1, 8:11, :] = True
+        masks[2] = True
+        sums = MaskedReduction.masked_sums(data, masks, 4000)
+        self.assertEqual((5, 6, 4), sums.shape)
+        for i in range(masks.shape[0]):
+            self.assertTrue(numpy.allclose(MaskedReduction.masked_sum(data, masks[i]), sums[..., i]))
+
+    def test_center_of_mass_matches_direct_calculation(self) -> None:
+        data = numpy.random.default_rng(13).random((5, 6, 12, 10))
+        grid_y, grid_x = numpy.mgrid[:12, :10]
+        rectangle = numpy.zeros((12, 10), dtype=bool)
+        rectangle[2:9, 3:8] = True
+        for mask in (rectangle, numpy.ones_like(rectangle)):
+            with self.subTest(mask_size=numpy.count_nonzero(mask)):
+                masked_data = data * mask
+                total = numpy.sum(masked_data, axis=(-2, -1))
+                com_y = numpy.sum(masked_data * grid_y, axis=(-2, -1)) / total
+                com_x = numpy.sum(masked_data * grid_x, axis=(-2, -1)) / total
+                sigma_y = numpy.sqrt(numpy.sum(masked_data * (grid_y - com_y[..., numpy.newaxis, numpy.newaxis]) ** 2, axis=(-2, -1)) / total)
+                sigma_x = numpy.sqrt(numpy.sum(masked_data * (grid_x - com_x[..., numpy.newaxis, numpy.newaxis]) ** 2, axis=(-2, -1)) / total)
+                result = MaskedReduction.center_of_mass(data, mask, block_size=2000)
+                self.assertEqual((2, 5, 6), result.shape)
+                self.assertTrue(numpy.allclose(result, [com_y, com_x]))
+                result = MaskedReduction.center_of_mass(data, mask, second_moments=True)
+                self.assertTrue(numpy.allclose(result, [com_y, com_x, sigma_y, sigma_x]))
+
+    def test_incremental_masked_sum_matches_full_sum(self) -> None:
+        data = numpy.random.default_rng(7).random((6, 5, 16, 16)).astype(numpy.float32)
+        incremental_sum = MaskedReduction.IncrementalMaskedSum()
+        for top, left, size in [(4, 4, 6), (4, 5, 6), (5, 5, 6), (6, 4, 6), (0, 0, 2), (1, 0, 2)]:
+            mask = numpy.zeros((16, 16), dtype=bool)
+            mask[top:top + size, left:left + size] = True
+            with self.subTest(top=top, left=left, size=size):
+                result = incremental_sum.update(data, mask, "data")
+                self.assertEqual(numpy.float32, result.dtype)
+                self.assertTrue(numpy.allclose(numpy.sum(data[..., mask], axis=-1), result, rtol=1e-5))
+        # the jump to the small region at (0, 0) changes more pixels than the new mask contains
+        self.assertEqual(2, incremental_sum.full_updates)
+        self.assertEqual(4, incremental_sum.incremental_updates)
+        # changed data always needs a full update
+        incremental_sum.update(data * 2, mask, "doubled data")
+        self.assertEqual(3, incremental_sum.full_updates)
+
+    def test_map_4D_updates_when_region_moves(self) -> None:
+        with create_memory_profile_context() as test_context:
+            document_controller = test_context.create_document_controller_with_application()
+            document_model = document_controller.document_model
+            xdata = DataAndMetadata.new_data_and_metadata(numpy.random.randn(4, 5, 16, 16), data_descriptor=DataAndMetadata.DataDescriptor(False, 2, 2))
+            data_item = DataItem.new_data_item(xdata)
+            document_model.append_data_item(data_item)
+            display_item = document_model.get_display_item_for_data_item(data_item)
+            document_controller.selected_display_panel.set_display_panel_display_item(display_item)
+            api = Facade.get_api("~1.0", "~1.0")
+            region_graphic = Graphics.RectangleGraphic()
+            region_graphic.bounds = Geometry.FloatRect.from_tlhw(0.25, 0.25, 0.5, 0.5)
+            display_item.add_graphic(region_graphic)
+            map_data_item = Map4D.map_4D(api, Facade.DocumentWindow(document_controller), Facade.Display(display_item), [Facade.Graphic(region_graphic)])
+            for top in (0.25, 0.3125, 0.375):
+                region_graphic.bounds = Geometry.FloatRect.from_tlhw(top, 0.25, 0.5, 0.5)
+                document_model.recompute_all()
+                mask = region_graphic.get_mask((16, 16)).astype(bool)
+                self.assertTrue(numpy.allclose(map_data_item.data, numpy.sum(xdata.data[..., mask], axis=-1)))
+            incremental_sum = Map4D._incremental_sums[document_model.get_data_item_computation(map_data_item._data_item)]
+            self.assertEqual(1, incremental_sum.full_updates)
+            self.assertEqual(2, incremental_sum.incremental_updates)
 
     def test_map_4D_RGB_computation(self) -> None:
         with create_memory_profile_context() as test_context:
@@ -170,3 +349,34 @@ class TestComputations4D(unittest.TestCase):
             self.assertIn("Map 4D RGB", map_data_item.title)
             self.assertEqual(3, len(display_item.graphics))
             self.assertEqual(1, len(map_display_item.graphics))
+
+    def test_map_4D_RGB_channels_match_virtual_detector_images(self) -> None:
+        with create_memory_profile_context() as test_context:
+            document_controller = test_context.create_document_controller_with_application()
+            document_model = document_controller.document_model
+            xdata = DataAndMetadata.new_data_and_metadata(numpy.random.rand(4, 5, 16, 16), data_descriptor=DataAndMetadata.DataDescriptor(False, 2, 2))
+            data_item = DataItem.new_data_item(xdata)
+            document_model.append_data_item(data_item)
+            display_item = document_model.get_display_item_for_data_item(data_item)
+            document_controller.selected_display_panel.set_display_panel_display_item(display_item)
+            api = Facade.get_api("~1.0", "~1.0")
+            red_graphic = Graphics.RectangleGraphic()
+            red_graphic.bounds = Geometry.FloatRect.from_tlhw(0.1, 0.1, 0.3, 0.3)
+            display_item.add_graphic(red_graphic)
+            green_graphic = Graphics.EllipseGraphic()
+            green_graphic.bounds = Geometry.FloatRect.from_tlhw(0.4, 0.4, 0.5, 0.5)
+            display_item.add_graphic(green_graphic)
+            map_data_item = Map4DRGB.map_4D_RGB(api, Facade.DocumentWindow(document_controller), Facade.Display(display_item), [Facade.Graphic(red_graphic)], [Facade.Graphic(green_graphic)], [])
+            document_model.recompute_all()
+            self.assertFalse(any(computation.error_text for computation in document_model.computations))
+
+            def expected_channel(mask: typing.Optional[numpy.typing.NDArray[typing.Any]]) -> numpy.typing.NDArray[typing.Any]:
+                channel = numpy.sum(xdata.data[..., mask], axis=-1) if mask is not None else numpy.sum(xdata.data, axis=(-2, -1))
+                channel = channel - numpy.amin(channel)
+                return typing.cast(numpy.typing.NDArray[typing.Any], numpy.rint(255 * channel / numpy.amax(channel)))
+
+            rgb_data = map_data_item.data.astype(int)
+            # the channels are stored in the order blue, green, red; the blue channel has no region and sums the frames
+            self.assertLessEqual(numpy.amax(numpy.abs(rgb_data[..., 2] - expected_channel(red_graphic.get_mask((16, 16)).astype(bool)))), 1)
+            self.assertLessEqual(numpy.amax(numpy.abs(rgb_data[..., 1] - expected_channel(green_graphic.get_mask((16, 16)).astype(bool)))), 1)
+            self.assertLessEqual(numpy.amax(numpy.abs(rgb_data[..., 0] - expected_channel(None))), 1)
@@ -0,0 +1,80 @@
+# standard libraries
+import time
+import unittest
+
+# third party libraries
+import numpy
+
+# local libraries
+from nion.data import DataAndMetadata
+from nion.swift import Facade
+from nion.swift.model import DataItem
+
+from .. import DataCache
+
+
+Facade.initialize()
+
+
+def create_data_item(shape: tuple[int, ...]) -> Facade.DataItem:
+    xdata = DataAndMetadata.new_data_and_metadata(numpy.random.rand(*shape))
+    return Facade.DataItem(DataItem.new_data_item(xdata))
+
+
+class TestDataCache(unittest.TestCase):
+
+    def test_cache_keeps_several_data_items(self) -> None:
+        data_item1 = create_data_item((8, 8))
+        data_item2 = create_data_item((8, 8))
+        cache = DataCache.DataCache()
+        data1 = cache.get_cached_data(data_item1)
+        cache.get_cached_data(data_item2)
+        self.assertIs(data1, cache.get_cached_data(data_item1))
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(2, cache.misses)
+        self.assertEqual(2 * 8 * 8 * 8, cache.nbytes)
+
+    def test_cache_evicts_least_recently_used_entries_over_budget(self) -> None:
+        data_items = [create_data_item((8, 8)) for _ in range(3)]
+        cache = DataCache.DataCache(max_bytes=2 * 8 * 8 * 8)
+        for data_item in data_items:
+            cache.get_cached_data(data_item)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.evictions)
+        # the first data item was evicted, the last one is still cached
+        cache.get_cached_data(data_items[2])
+        self.assertEqual(1, cache.hits)
+        cache.get_cached_data(data_items[0])
+        self.assertEqual(4, cache.misses)
+
+    def test_cache_does_not_keep_entries_larger_than_budget(self) -> None:
+        cache = DataCache.DataCache(max_bytes=100)
+        data_item = create_data_item((8, 8))
+        self.assertTrue(numpy.array_equal(data_item.data, cache.get_cached_data(data_item)))
+        self.assertEqual(0, len(cache))
+
+    def test_cache_expires_entries_on_access(self) -> None:
+        cache = DataCache.DataCache(lifetime=0.05)
+        data_item1 = create_data_item((4, 4))
+        data_item2 = create_data_item((4, 4))
+        cache.get_cached_data(data_item1)
+        time.sleep(0.1)
+        cache.get_cached_data(data_item2)
+        self.assertEqual(1, len(cache))
+        self.assertEqual(1, cache.evictions)
+
+    def test_cache_reloads_modified_data(self) -> None:
+        cache = DataCache.DataCache(modify_data_fn=lambda data: data * 2)
+        data_item = create_data_item((4, 4))
+        cache.get_cached_data(data_item)
+        new_data = numpy.random.rand(4, 4)
+        data_item.set_data(new_data)
+        cached_data = cache.get_cached_data(data_item)
+        self.assertTrue(numpy.array_equal(new_data * 2, cached_data))
+        self.assertEqual(0, cache.hits)
+        self.assertEqual(1, len(cache))
+
+
+if __name__ == '__main__':
+    unittest.main()
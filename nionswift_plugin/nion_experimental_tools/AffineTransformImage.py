@@ -4,17 +4,182 @@ import typing
 
 # third party imports
 import numpy
+import numpy.typing
+import scipy.ndimage
+import scipy.sparse
 
 # local libraries
-from nion.data import xdata_1_0 as xd
 from nion.swift import Facade
 from nion.swift.model import Graphics
 from nion.swift.model import Symbolic
 from nion.data import DataAndMetadata
 from nion.data import Core
+from nion.experimental import Parallel
+from nion.experimental import Registration
+
+from . import MultiDimensionalProcessing
 
 _ = gettext.gettext
 
+_DataArrayType = numpy.typing.NDArray[typing.Any]
+
+# the size in bytes of the frames that are warped together in one block.
+WARP_BLOCK_SIZE = 16 * 1024 * 1024
+
+# the size in bytes of the frames that are warped together in one block when the frames are the last axes of the data
+# and have to be transposed for the sparse product. the transposed copy of a small block stays in the cache.
+WARP_TRANSPOSE_BLOCK_SIZE = 512 * 1024
+
+# the minimum number of frames for which a (cached) warp plan is used. building a plan costs about as much as warping
+# three frames directly, so fewer frames are warped one by one without keeping a plan.
+WARP_PLAN_MIN_FRAMES = 16
+
+
+def calculate_bilinear_gather(coordinates: _DataArrayType, frame_shape: typing.Tuple[int, int]) -> typing.Tuple[_DataArrayType, _DataArrayType]:
+    """Return the flat source indices and weights of the four neighbors for the points in "coordinates".
+
+    The results have shape (4, number of points) and give the same result as "scipy.ndimage.map_coordinates" with
+    "order=1": points outside of the frame are zero. Neighbors outside of the frame have index 0 and weight 0.
+    """
+    y = coordinates[0].ravel()
+    x = coordinates[1].ravel()
+    inside = (y >= 0) & (y <= frame_shape[0] - 1) & (x >= 0) & (x <= frame_shape[1] - 1)
+    y0 = numpy.floor(y)
+    x0 = numpy.floor(x)
+    wy = y - y0
+    wx = x - x0
+    indices = numpy.zeros((4, y.size), dtype=numpy.intp)
+    weights = numpy.zeros((4, y.size))
+    for i, (dy, dx, weight) in enumerate(((0, 0, (1 - wy) * (1 - wx)), (1, 0, wy * (1 - wx)), (0, 1, (1 - wy) * wx), (1, 1, wy * wx))):
+        yy = y0.astype(numpy.intp) + dy
+        xx = x0.astype(numpy.intp) + dx
+        valid = inside & (yy < frame_shape[0]) & (xx < frame_shape[1])
+        indices[i][valid] = yy[valid] * frame_shape[1] + xx[valid]
+        weights[i][valid] = weight[valid]
+    return indices, weights
+
+
+def _round_to_dtype(values: _DataArrayType, dtype: numpy.dtype[typing.Any]) -> _DataArrayType:
+    # scipy.ndimage rounds half away from zero when the output is an integer type
+    if numpy.issubdtype(dtype, numpy.integer):
+        values = numpy.copysign(numpy.floor(numpy.abs(values) + 0.5), values)
+    return values
+
+
+def get_warp_dtype(dtype: numpy.typing.DTypeLike) -> numpy.dtype[typing.Any]:
+    """Return the dtype of the interpolation weights for data of "dtype": single precision data is warped in single
+    precision, everything else in double precision."""
+    return numpy.dtype(numpy.float32) if numpy.dtype(dtype) in (numpy.float16, numpy.float32, numpy.complex64) else numpy.dtype(numpy.float64)
+
+
+class WarpPlan:
+    """Bilinear interpolation of frames of one shape to fixed "coordinates" (shape (2,) + frame shape).
+
+    The interpolation is stored as a sparse (frame pixels x frame pixels) matrix with at most four non-zero weights per
+    row, so that warping any number of frames is a single sparse matrix product. The weights have type "dtype".
+    """
+
+    def __init__(self, coordinates: _DataArrayType, dtype: numpy.typing.DTypeLike = numpy.float64) -> None:
+        self.frame_shape = (int(coordinates.shape[1]), int(coordinates.shape[2]))
+        frame_size = self.frame_shape[0] * self.frame_shape[1]
+        indices, weights = calculate_bilinear_gather(coordinates, self.frame_shape)
+        rows = numpy.broadcast_to(numpy.arange(frame_size), indices.shape)
+        non_zero = weights != 0
+        self.matrix = scipy.sparse.csr_matrix((weights[non_zero].astype(dtype), (rows[non_zero], indices[non_zero])), shape=(frame_size, frame_size))
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes)
+
+    def apply(self, frames: _DataArrayType) -> _DataArrayType:
+        """Return the warped "frames" (shape (frame pixels, number of frames)), in the precision of the weights for real
+        data."""
+        return typing.cast(_DataArrayType, self.matrix @ frames)
+
+
+# warp plans of the most recently used matrices and frame shapes, so that recomputing with unchanged vectors only
+# costs the sparse product. a plan needs about 45 bytes per frame pixel (180 MB for 2048 x 2048 frames).
+warp_plan_cache = Registration.LRUCache(8, max_bytes=256 * 1024 * 1024)
+
+
+def get_warp_plan(matrix: _DataArrayType, frame_shape: typing.Tuple[int, int], dtype: numpy.typing.DTypeLike = numpy.float64) -> WarpPlan:
+    """Return the (cached) warp plan of the affine transformation "matrix" for frames of shape "frame_shape" with
+    weights of type "dtype"."""
+    def create_warp_plan() -> WarpPlan:
+        new_coords = Core.calculate_coordinates_for_affine_transform(numpy.empty(frame_shape), matrix)
+        return WarpPlan(numpy.stack([new_coords[0].data, new_coords[1].data]), dtype)
+
+    key = (tuple(numpy.asarray(matrix, dtype=float).ravel().tolist()), tuple(frame_shape), numpy.dtype(dtype).str)
+    return warp_plan_cache.get_or_create(key, create_warp_plan)
+
+
+def function_map_frames(data: _DataArrayType, frame_axis: int, coordinates: _DataArrayType,
+                        out: typing.Optional[_DataArrayType] = None) -> _DataArrayType:
+    """Warp every frame of "data" to "coordinates" (shape (2,) + frame shape) with bilinear interpolation.
+
+    The frames are the two axes starting at "frame_axis" and are interpolated one by one, which is faster than building
+    a warp plan for a few frames. The result has the shape and dtype of "data" and is written into "out" if it is given.
+    """
+    data = numpy.asarray(data)
+    assert coordinates.shape == (2,) + data.shape[frame_axis:frame_axis + 2]
+    if out is None:
+        out = numpy.empty(data.shape, dtype=data.dtype)
+    assert out.shape == data.shape
+    src_frames = numpy.moveaxis(data, (frame_axis, frame_axis + 1), (-2, -1))
+    out_frames = numpy.moveaxis(out, (frame_axis, frame_axis + 1), (-2, -1))
+    for index in numpy.ndindex(src_frames.shape[:-2]):
+        scipy.ndimage.map_coordinates(src_frames[index], coordinates, order=1, output=out_frames[index])
+    return out
+
+
+def function_warp_frames(data: _DataArrayType, frame_axis: int, warp_plan: WarpPlan,
+                         out: typing.Optional[_DataArrayType] = None, num_workers: typing.Optional[int] = None) -> _DataArrayType:
+    """Warp every frame of "data" with "warp_plan".
+
+    The frames are the two axes starting at "frame_axis", all other axes (including color channels) index the frames.
+    The frames are interpolated in blocks, with all frames of a block warped by one sparse matrix product, and the
+    blocks are distributed to "num_workers" threads. The result has the shape and dtype of "data" and is written into
+    "out" if it is given.
+    """
+    data = numpy.asarray(data)
+    data_shape = data.shape
+    frame_shape = (data_shape[frame_axis], data_shape[frame_axis + 1])
+    assert frame_shape == warp_plan.frame_shape
+    frame_size = frame_shape[0] * frame_shape[1]
+    outer_count = int(numpy.prod(data_shape[:frame_axis], dtype=numpy.int64))
+    inner_count = int(numpy.prod(data_shape[frame_axis + 2:], dtype=numpy.int64))
+    if out is None:
+        out = numpy.empty(data_shape, dtype=data.dtype)
+    assert out.shape == data_shape
+    # view the data as (outer index x frame pixels x inner index), so that all frames of a block are warped at once.
+    # the reshape is a view for contiguous data.
+    src_view = numpy.reshape(data, (outer_count, frame_size, inner_count))
+    out_view = numpy.reshape(out, (outer_count, frame_size, inner_count))
+    item_size = max(data.dtype.itemsize, warp_plan.matrix.dtype.itemsize)
+    frames_per_block = max(1, WARP_BLOCK_SIZE // max(1, frame_size * item_size))
+    if inner_count < frames_per_block and outer_count > 1:
+        # blocks span several outer indices and are transposed to (frame pixels x frames) and back.
+        frames_per_block = max(1, WARP_TRANSPOSE_BLOCK_SIZE // max(1, frame_size * item_size))
+    inner_per_block = min(inner_count, frames_per_block)
+    outer_per_block = max(1, frames_per_block // inner_per_block)
+    blocks = [(slice(outer, min(outer + outer_per_block, outer_count)), slice(inner, min(inner + inner_per_block, inner_count)))
+              for outer in range(0, outer_count, outer_per_block)
+              for inner in range(0, inner_count, inner_per_block)]
+
+    def warp_block(outer_slice: slice, inner_slice: slice) -> None:
+        src = src_view[outer_slice, :, inner_slice]
+        block_shape = src.shape
+        frames = numpy.ascontiguousarray(numpy.moveaxis(src, 1, 0).reshape(frame_size, -1))
+        warped = warp_plan.apply(frames).reshape(frame_size, block_shape[0], block_shape[2])
+        out_view[outer_slice, :, inner_slice] = numpy.moveaxis(_round_to_dtype(warped, out.dtype), 0, 1)
+
+    def warp_blocks_on_thread(worker_blocks: typing.Sequence[typing.Tuple[slice, slice]]) -> None:
+        for outer_slice, inner_slice in worker_blocks:
+            warp_block(outer_slice, inner_slice)
+
+    Parallel.run_on_threads(warp_blocks_on_thread, Parallel.distribute(blocks, num_workers or MultiDimensionalProcessing.default_num_workers()))
+    return out
+
 
 class AffineTransformImage(Symbolic.ComputationHandlerLike):
     computation_id = "nion.affine_transform_image"
@@ -47,47 +212,26 @@ class AffineTransformImage(Symbolic.ComputationHandlerLike):
         xdata = src_data_item.xdata
         if not xdata:
             return
-        index: typing.Tuple[typing.Union[int, slice, numpy.signedinteger[typing.Any]], ...]
-        if (xdata.is_sequence or xdata.is_collection) and xdata.collection_dimension_count != 2:
-            navigation_dimensions = 0
-            if xdata.is_sequence:
-                navigation_dimensions += 1
-            navigation_dimensions += xdata.collection_dimension_count
-            navigation_dimensions_shape = xdata.data.shape[:navigation_dimensions]
-            result_data = numpy.zeros_like(xdata.data)
-            new_coords = Core.calculate_coordinates_for_affine_transform(xdata.data[numpy.unravel_index(0, navigation_dimensions_shape)], matrix)
-            for i in range(numpy.prod(navigation_dimensions_shape, dtype=numpy.uint64)):
-                index = numpy.unravel_index(i, navigation_dimensions_shape)
-                transformed = xd.warp(xdata.data[index], new_coords)
-                result_data[index] = transformed.data
-            self._affine_transformed_xdata = DataAndMetadata.new_data_and_metadata(result_data,
-                                                                                    intensity_calibration=xdata.intensity_calibration,
-                                                                                    dimensional_calibrations=xdata.dimensional_calibrations,
-                                                                                    data_descriptor=xdata.data_descriptor)
-        elif xdata.collection_dimension_count == 2: # Assume we want to distort allong the collection dimension in this case
-            navigation_dimensions_shape = tuple()
-            if xdata.is_sequence:
-                navigation_dimensions_shape = (xdata.data_shape[0],) + xdata.data_shape[3:]
+        frame_axes: typing.Tuple[int, ...]
+        if xdata.collection_dimension_count == 2: # Assume we want to distort allong the collection dimension in this case
+            frame_axes = tuple(xdata.collection_dimension_indexes)
+        elif xdata.is_sequence or xdata.is_collection:
+            frame_axes = tuple(xdata.datum_dimension_indexes)[:2]
+        else:
+            frame_axes = tuple()
+        if frame_axes:
+            frame_shape = (xdata.data_shape[frame_axes[0]], xdata.data_shape[frame_axes[1]])
+            if xdata.data.size // (frame_shape[0] * frame_shape[1]) >= WARP_PLAN_MIN_FRAMES:
+                result_data = function_warp_frames(xdata.data, frame_axes[0], get_warp_plan(matrix, frame_shape, get_warp_dtype(xdata.data.dtype)))
             else:
-                navigation_dimensions_shape = xdata.data_shape[2:]
-
-            if xdata.is_data_rgb_type:
-                navigation_dimensions_shape = navigation_dimensions_shape[:-1]
-            index = numpy.unravel_index(0, navigation_dimensions_shape)
-            index = ((index[0],) if xdata.is_sequence else tuple()) + (slice(None), slice(None)) + index[-xdata.datum_dimension_count:]
-            new_coords = Core.calculate_coordinates_for_affine_transform(xdata.data[index], matrix)
-            result_data = numpy.zeros_like(xdata.data)
-            for i in range(numpy.prod(navigation_dimensions_shape)):
-                index = numpy.unravel_index(i, navigation_dimensions_shape)
-                index = ((index[0],) if xdata.is_sequence else tuple()) + (slice(None), slice(None)) + index[-xdata.datum_dimension_count:]
-                transformed = xd.warp(xdata.data[index], new_coords)
-                result_data[index] = transformed.data
+                new_coords = Core.calculate_coordinates_for_affine_transform(numpy.empty(frame_shape), matrix)
+                result_data = function_map_frames(xdata.data, frame_axes[0], numpy.stack([new_coords[0].data, new_coords[1].data]))
             self._affine_transformed_xdata = DataAndMetadata.new_data_and_metadata(result_data,
                                                                                     intensity_calibration=xdata.intensity_calibration,
                                                                                     dimensional_calibrations=xdata.dimensional_calibrations,
                                                                                     data_descriptor=xdata.data_descriptor)
         else:
-            self._affine_transformed_xdata = xd.affine_transform(xdata, matrix)
+            self._affine_transformed_xdata = Core.function_affine_transform(xdata, matrix)
         metadata = dict(self._affine_transformed_xdata.metadata).copy()
         metadata["nion.affine_transform_image.transformation_matrix"] = matrix.tolist()
         self._affine_transformed_xdata._set_metadata(metadata)
@@ -1,15 +1,19 @@
 import typing
 import gettext
 import numpy
+import numpy.typing
 
 from nion.data import Core
 from nion.data import DataAndMetadata
 from nion.data import MultiDimensionalProcessing
+from nion.experimental import Registration
 from nion.swift.model import Symbolic
 from nion.swift import Facade
 from nion.typeshed import API_1_0 as API
 from nion.utils import Event
 
+from .MultiDimensionalProcessing import default_num_workers
+
 
 _ = gettext.gettext
 
@@ -106,22 +110,18 @@ class AlignMultiSI(Symbolic.ComputationHandlerLike):
         bounds = None
         if align_region:
             bounds = align_region.bounds
-        translations = Core.function_sequence_measure_relative_translation(haadf_xdata,
-                                                                           haadf_xdata[align_index],
-                                                                           True, bounds=bounds)
+        translations = Registration.function_sequence_measure_relative_translation(haadf_xdata,
+                                                                                   haadf_xdata[align_index],
+                                                                                   True, bounds=bounds)
         sequence_shape = haadf_sequence_data_item.xdata.sequence_dimension_shape
-        data_zeros = (0,) * si_xdata.datum_dimension_count
         c = int(numpy.prod(sequence_shape))
-        haadf_result_data = numpy.empty_like(haadf_xdata.data)
-        si_result_data = numpy.empty_like(si_xdata.data)
-        for i in range(c):
-            ii = numpy.unravel_index(i, sequence_shape)
-            current_xdata = DataAndMetadata.new_data_and_metadata(haadf_xdata.data[ii])
-            translation = translations.data[ii]
-            haadf_result_data[ii] = Core.function_shift(current_xdata, tuple(translation)).data
-            current_xdata = DataAndMetadata.new_data_and_metadata(si_xdata.data[ii])
-            si_result_data[ii] = Core.function_shift(current_xdata, tuple(translation) + data_zeros).data
-            self.progress_updated_event.fire(0, c, i+1)
+        num_workers = default_num_workers()
+        # progress counts the HAADF frames first, then the SI frames
+        haadf_result_data = Registration.shift_frames(haadf_xdata.data, translations.data, (0, 1), num_workers=num_workers,
+                                                      progress_fn=lambda n, count: self.progress_updated_event.fire(0, 2 * c, n))
+        # the SI is only interpolated along the two collection axes, in blocks along the energy axis
+        si_result_data = Registration.shift_frames(si_xdata.data, translations.data, (0, 1), num_workers=num_workers,
+                                                   progress_fn=lambda n, count: self.progress_updated_event.fire(0, 2 * c, c + n))
 
         self.__aligned_haadf_sequence = DataAndMetadata.new_data_and_metadata(haadf_result_data,
                                                                               intensity_calibration=haadf_xdata.intensity_calibration,
@@ -139,6 +139,23 @@ class AlignMultiSI(Symbolic.ComputationHandlerLike):
         self.computation.set_referenced_xdata("aligned_si", self.__aligned_si_sequence)
 
 
+def function_integrate_shifted_sequence(xdata: DataAndMetadata.DataAndMetadata, shifts: numpy.typing.NDArray[typing.Any],
+                                        shift_axes: typing.Tuple[int, ...],
+                                        weights: typing.Optional[numpy.typing.NDArray[typing.Any]] = None) -> DataAndMetadata.DataAndMetadata:
+    """Shift each slice of the sequence "xdata" along "shift_axes" and sum the slices (weighted by "weights").
+
+    Gives the same result as "function_apply_multi_dimensional_shifts" followed by "Core.function_sum" over the
+    sequence axis, but the shifted slices are accumulated into the sum directly instead of being stored.
+    """
+    data = xdata.data
+    assert data is not None
+    sequence_ndim = shifts.ndim - 1
+    frame_shift_axes = tuple(axis - sequence_ndim for axis in shift_axes)
+    summed_data = Registration.sum_shifted_frames(data, shifts, frame_shift_axes, weights=weights, num_workers=default_num_workers())
+    return DataAndMetadata.new_data_and_metadata(data=summed_data, intensity_calibration=xdata.intensity_calibration,
+                                                 dimensional_calibrations=xdata.dimensional_calibrations[sequence_ndim:])
+
+
 class AlignMultiSI2(Symbolic.ComputationHandlerLike):
     computation_id = "eels.align_multi_si2"
     label = _("Align and Integrate SI Sequence")
@@ -174,13 +191,9 @@ class AlignMultiSI2(Symbolic.ComputationHandlerLike):
         shifts_axes = tuple(haadf_xdata.datum_dimension_indexes)
         shifts_xdata = MultiDimensionalProcessing.function_measure_multi_dimensional_shifts(haadf_xdata, shifts_axes, reference_index=reference_index, bounds=bounds, max_shift=max_shift_)
         self.__shifts_xdata = Core.function_transpose_flip(shifts_xdata, transpose=True, flip_v=False, flip_h=False)
-        aligned_haadf_xdata = MultiDimensionalProcessing.function_apply_multi_dimensional_shifts(haadf_xdata, shifts_xdata.data, shifts_axes)
-        assert aligned_haadf_xdata
-        self.__integrated_haadf_xdata = Core.function_sum(aligned_haadf_xdata, axis=0)
+        self.__integrated_haadf_xdata = function_integrate_shifted_sequence(haadf_xdata, shifts_xdata.data, shifts_axes)
         shifts_axes = tuple(si_xdata.collection_dimension_indexes)
-        aligned_si_xdata = MultiDimensionalProcessing.function_apply_multi_dimensional_shifts(si_xdata, shifts_xdata.data, shifts_axes)
-        assert aligned_si_xdata
-        self.__integrated_si_xdata = Core.function_sum(aligned_si_xdata, axis=0)
+        self.__integrated_si_xdata = function_integrate_shifted_sequence(si_xdata, shifts_xdata.data, shifts_axes)
 
     def commit(self) -> None:
         self.computation.set_referenced_xdata("shifts", self.__shifts_xdata)
@@ -3,11 +3,14 @@ import typing
 
 import numpy
 
-from nion.data import Core
 from nion.data import DataAndMetadata
+from nion.experimental import Registration
 from nion.swift.model import Symbolic
 from nion.swift import Facade
 from nion.typeshed import API_1_0
+from nion.utils import Event
+
+from .MultiDimensionalProcessing import default_num_workers
 
 _ = gettext.gettext
 
@@ -28,6 +31,8 @@ class AlignMultiDimensionalSequence(Symbolic.ComputationHandlerLike):
         self.computation = computation
         self.__aligned_haadf_sequence: typing.Optional[DataAndMetadata.DataAndMetadata] = None
         self.__aligned_si_sequence: typing.Optional[DataAndMetadata.DataAndMetadata] = None
+        self.progress_updated_event = Event.Event()
+        typing.cast(typing.Any, self.computation._computation).progress_updated_event = self.progress_updated_event
 
     def execute(self, *,
                 si_sequence_data_item: typing.Optional[API_1_0.DataItem] = None,
@@ -45,14 +50,12 @@ class AlignMultiDimensionalSequence(Symbolic.ComputationHandlerLike):
             two_items = True
         si_xdata = si_sequence_data_item.xdata
         bounds = align_region.bounds
-        translations = Core.function_sequence_measure_relative_translation(haadf_xdata,
-                                                                           haadf_xdata[align_index],
-                                                                           True, bounds=bounds)
+        translations = Registration.function_sequence_measure_relative_translation(haadf_xdata,
+                                                                                   haadf_xdata[align_index],
+                                                                                   True, bounds=bounds)
         sequence_shape = haadf_sequence_data_item.xdata.sequence_dimension_shape
 
         c = int(numpy.prod(sequence_shape))
-        haadf_result_data = numpy.empty_like(haadf_xdata.data)
-        si_result_data = numpy.empty_like(si_xdata.data)
 
         align_data_shape = haadf_xdata.datum_dimension_shape
         align_axes_start_index: typing.Optional[int] = None
@@ -64,19 +67,17 @@ class AlignMultiDimensionalSequence(Symbolic.ComputationHandlerLike):
         else:
             raise RuntimeError('Could not find axes that match the HAADF shape in SI data item.')
 
-        si_translation = [0.0] * (len(si_xdata.data_shape) - len(sequence_shape))
         align_axes_start_index -= len(sequence_shape)
         assert align_axes_start_index >= 0
 
-        for i in range(c):
-            ii = numpy.unravel_index(i, sequence_shape)
-            current_xdata = DataAndMetadata.new_data_and_metadata(haadf_xdata.data[ii])
-            translation = translations.data[ii]
-            haadf_result_data[ii] = Core.function_shift(current_xdata, tuple(translation)).data
-            current_xdata = DataAndMetadata.new_data_and_metadata(si_xdata.data[ii])
-            si_translation[align_axes_start_index] = translation[0]
-            si_translation[align_axes_start_index+1] = translation[1]
-            si_result_data[ii] = Core.function_shift(current_xdata, tuple(si_translation)).data
+        num_workers = default_num_workers()
+        # progress counts the HAADF frames first, then the SI frames
+        haadf_result_data = Registration.shift_frames(haadf_xdata.data, translations.data, (0, 1), num_workers=num_workers,
+                                                      progress_fn=lambda n, count: self.progress_updated_event.fire(0, 2 * c, n))
+        # the SI is only interpolated along the two aligned axes, in blocks along the largest other axis
+        si_result_data = Registration.shift_frames(si_xdata.data, translations.data, (align_axes_start_index, align_axes_start_index + 1),
+                                                   num_workers=num_workers,
+                                                   progress_fn=lambda n, count: self.progress_updated_event.fire(0, 2 * c, c + n))
         if two_items:
             self.__aligned_haadf_sequence = DataAndMetadata.new_data_and_metadata(haadf_result_data,
                                                                                   intensity_calibration=haadf_xdata.intensity_calibration,
@@ -0,0 +1,63 @@
+"""
+Automatic rotation of DPC and center of mass fields.
+
+The rotation between scan and detector coordinates is found as the rotation that minimizes the mean squared curl of
+the rotated field. Because the curl is linear in the rotated components, the curl of the field rotated by "r" is
+"sin(r) * a + cos(r) * b" with "a = d(com_x)/dx + d(com_y)/dy" and "b = d(com_y)/dx - d(com_x)/dy". The mean squared
+curl therefore only depends on the three products "<a * a>", "<b * b>" and "<a * b>" and its minimum has a closed form.
+"""
+
+import hashlib
+import typing
+
+import numpy
+import numpy.typing
+
+from nion.experimental import Registration
+
+_DataArrayType = numpy.typing.NDArray[typing.Any]
+
+
+def calculate_curl_terms(com_x: _DataArrayType, com_y: _DataArrayType) -> typing.Tuple[float, float, float]:
+    """Return the mean products "<a * a>", "<b * b>" and "<a * b>" of the curl terms of the field (com_x, com_y).
+
+    The field is given by its components on the last two axes, any leading axes (e.g. a time series) are averaged.
+    """
+    a = numpy.gradient(com_x, axis=-1) + numpy.gradient(com_y, axis=-2)
+    b = numpy.gradient(com_y, axis=-1) - numpy.gradient(com_x, axis=-2)
+    return float(numpy.mean(a * a)), float(numpy.mean(b * b)), float(numpy.mean(a * b))
+
+
+def calculate_mean_squared_curl(rotation: float, curl_terms: typing.Tuple[float, float, float]) -> float:
+    """Return the mean squared curl of the field rotated by "rotation" (radians) from its "curl_terms"."""
+    aa, bb, ab = curl_terms
+    sin_r = numpy.sin(rotation)
+    cos_r = numpy.cos(rotation)
+    return float(sin_r * sin_r * aa + cos_r * cos_r * bb + 2.0 * sin_r * cos_r * ab)
+
+
+def calculate_rotation(com_x: _DataArrayType, com_y: _DataArrayType) -> float:
+    """Return the rotation (radians, in [0, pi)) that minimizes the mean squared curl of the field (com_x, com_y).
+
+    The curl does not change sign with the field, so the rotation is only defined up to pi. Use "flip_x" and "flip_y"
+    or a fixed rotation if the other solution is needed.
+    """
+    aa, bb, ab = calculate_curl_terms(com_x, com_y)
+    # mean squared curl = (aa + bb) / 2 + (bb - aa) / 2 * cos(2r) + ab * sin(2r), which is smallest where the
+    # oscillating part points in the opposite direction of (bb - aa, 2 * ab).
+    return float((numpy.arctan2(2.0 * ab, bb - aa) + numpy.pi) * 0.5 % numpy.pi)
+
+
+# rotations of the most recently used fields. the keys contain a digest of the field, so they change with the data and
+# everything that changes the field (e.g. slice indexes, crop and flips), but recomputing with changed display
+# parameters skips the calculation.
+rotation_cache = Registration.LRUCache(32)
+
+
+def get_rotation(com_x: _DataArrayType, com_y: _DataArrayType) -> float:
+    """Return the (cached) rotation of the field (com_x, com_y)."""
+    field_hash = hashlib.blake2b(digest_size=16)
+    field_hash.update(numpy.ascontiguousarray(com_x).data)
+    field_hash.update(numpy.ascontiguousarray(com_y).data)
+    key = (com_x.shape, com_x.dtype.str, com_y.dtype.str, field_hash.digest())
+    return rotation_cache.get_or_create(key, lambda: calculate_rotation(com_x, com_y))
@@ -5,17 +5,82 @@ import typing
 
 # third party libraries
 import numpy
+import numpy.typing
+import scipy.fft
 
 # local libraries
 from nion.data import DataAndMetadata
 from nion.data import Calibration
+from nion.experimental import Registration
 from nion.swift import Facade
 from nion.swift.model import Symbolic
 from nion.swift.model import Graphics
 from nion.typeshed import API_1_0
 
+from . import MultiDimensionalProcessing
+
 _ = gettext.gettext
 
+_DataArrayType = numpy.typing.NDArray[typing.Any]
+
+
+class DoubleGaussianKernel:
+    """The double Gaussian filter for frames of shape "frame_shape".
+
+    "filter" is the filter for the (fft-shifted) Fourier transform of a frame. "half_filter" is the same filter for the
+    unshifted real-input transform ("rfft2"), made symmetric so that the inverse real transform of the filtered
+    spectrum equals the real part of the inverse complex transform.
+    """
+
+    def __init__(self, frame_shape: typing.Tuple[int, int], sigma1: float, sigma2: float, weight2: float, dtype: numpy.typing.DTypeLike) -> None:
+        # set up linear indexes for y and x coordinates ranging from -height/2 to height/2 and -width/2 to width/2.
+        yy_min = int(math.floor(-frame_shape[0] / 2))
+        yy_max = int(math.floor(frame_shape[0] / 2))
+        xx_min = int(math.floor(-frame_shape[1] / 2))
+        xx_max = int(math.floor(frame_shape[1] / 2))
+        yy = numpy.linspace(yy_min, yy_max, frame_shape[0])[:, numpy.newaxis]
+        xx = numpy.linspace(xx_min, xx_max, frame_shape[1])[numpy.newaxis, :]
+
+        # calculate the pixel distance from the center
+        rr = numpy.sqrt(numpy.square(xx) + numpy.square(yy)) / (frame_shape[0] * 0.5)
+
+        self.filter = numpy.exp(-0.5 * numpy.square(rr / sigma1)) - (1.0 - weight2) * numpy.exp(-0.5 * numpy.square(rr / sigma2))
+        shifted_filter = numpy.fft.ifftshift(self.filter)
+        mirrored_filter = numpy.roll(shifted_filter[::-1, ::-1], 1, axis=(0, 1))
+        self.half_filter = ((shifted_filter + mirrored_filter) * 0.5)[:, :frame_shape[1] // 2 + 1].astype(dtype)
+
+
+# kernels of the most recently used frame shapes and sigmas, so that live data only costs the FFTs.
+double_gaussian_kernel_cache = Registration.LRUCache(8)
+
+
+def get_double_gaussian_kernel(frame_shape: typing.Tuple[int, int], sigma1: float, sigma2: float, weight2: float, dtype: numpy.typing.DTypeLike) -> DoubleGaussianKernel:
+    key = (tuple(frame_shape), float(sigma1), float(sigma2), float(weight2), numpy.dtype(dtype).str)
+    return double_gaussian_kernel_cache.get_or_create(key, lambda: DoubleGaussianKernel(frame_shape, sigma1, sigma2, weight2, dtype))
+
+
+def function_double_gaussian(data: _DataArrayType, sigma1: float, sigma2: float, weight2: float,
+                             workers: typing.Optional[int] = None) -> typing.Tuple[_DataArrayType, _DataArrayType]:
+    """Apply the double Gaussian filter to all frames (the last two axes) of "data".
+
+    The frames are filtered with one batched real-input FFT in the precision of the data (float32 stays float32). The
+    mean of each frame is kept. Returns the filtered data and the filtered (fft-shifted) Fourier transform of the
+    average frame.
+    """
+    data = numpy.asarray(data)
+    frame_shape = (data.shape[-2], data.shape[-1])
+    float_dtype = numpy.result_type(data.dtype, numpy.float32)
+    kernel = get_double_gaussian_kernel(frame_shape, sigma1, sigma2, weight2, float_dtype)
+    workers = workers or MultiDimensionalProcessing.default_num_workers()
+    fft_data = scipy.fft.rfft2(data.astype(float_dtype, copy=False), workers=workers)
+    filtered_fft_data = fft_data * kernel.half_filter
+    # make sure the filtered frames have the same mean as the unfiltered frames
+    filtered_fft_data[..., 0, 0] = fft_data[..., 0, 0]
+    result = scipy.fft.irfft2(filtered_fft_data, s=frame_shape, workers=workers)
+    # the full Fourier transform of the average frame, filtered like the frames themselves
+    average_fft_data = numpy.fft.fftshift(scipy.fft.fft2(numpy.mean(data, axis=tuple(range(data.ndim - 2)), dtype=float_dtype)))
+    return result, average_fft_data * kernel.filter.astype(float_dtype)
+
 
 class DoubleGaussian(Symbolic.ComputationHandlerLike):
     computation_id = "nion.extension.doublegaussian"
@@ -36,41 +101,23 @@ class DoubleGaussian(Symbolic.ComputationHandlerLike):
 
         sigma1 = ring_graphic.get_property("radius_2") * 2.0
         sigma2 = ring_graphic.get_property("radius_1") * 2.0
+        xdata = src.xdata
+        assert xdata
+        if xdata.datum_dimension_count != 2:
+            raise ValueError("Double Gaussian: data must be an image or a sequence or collection of images.")
         # get the data
-        data = src.data
-
-        # first calculate the FFT
-        shifted_fft_data = numpy.fft.fft2(data)
-        fft_data = numpy.fft.fftshift(shifted_fft_data)
-
-        # next, set up xx, yy arrays to be linear indexes for x and y coordinates ranging
-        # from -width/2 to width/2 and -height/2 to height/2.
-        yy_min = int(math.floor(-data.shape[0] / 2))
-        yy_max = int(math.floor(data.shape[0] / 2))
-        xx_min = int(math.floor(-data.shape[1] / 2))
-        xx_max = int(math.floor(data.shape[1] / 2))
-        xx, yy = numpy.meshgrid(numpy.linspace(yy_min, yy_max, data.shape[0]),
-                                numpy.linspace(xx_min, xx_max, data.shape[1]))
-
-        # calculate the pixel distance from the center
-        rr = numpy.sqrt(numpy.square(xx) + numpy.square(yy)) / (data.shape[0] * 0.5)
-
-        # finally, apply a filter to the Fourier space data.
-        filter = numpy.exp(-0.5 * numpy.square(rr / sigma1)) - (1.0 - weight2) * numpy.exp(-0.5 * numpy.square(rr / sigma2))
-        filtered_fft_data = fft_data * filter
+        data = xdata.data
+        assert data is not None
 
-        # and then do invert FFT and take the real value.
-        shifted_filtered_fft_data = numpy.fft.ifftshift(filtered_fft_data)
-        # make sure the filtered image has the same mean as the unfiltered image
-        shifted_filtered_fft_data[numpy.unravel_index(0, data.shape)] = shifted_fft_data[numpy.unravel_index(0, data.shape)]
-        result = numpy.fft.ifft2(shifted_filtered_fft_data).real
+        result, filtered_fft_data = function_double_gaussian(data, sigma1, sigma2, weight2)
 
-        intensity_calibration = src.xdata.intensity_calibration
-        dimensional_calibrations = src.xdata.dimensional_calibrations
-        self.__filtered_xdata = DataAndMetadata.new_data_and_metadata(result, intensity_calibration, dimensional_calibrations)
+        intensity_calibration = xdata.intensity_calibration
+        dimensional_calibrations = xdata.dimensional_calibrations
+        self.__filtered_xdata = DataAndMetadata.new_data_and_metadata(result, intensity_calibration, dimensional_calibrations,
+                                                                      data_descriptor=xdata.data_descriptor)
         fft_dimensional_calibrations = [Calibration.Calibration((-0.5 - 0.5 * data_shape_n) / (dimensional_calibration.scale * data_shape_n), 1.0 / (dimensional_calibration.scale * data_shape_n),
                                                         "1/" + dimensional_calibration.units) for
-                                        dimensional_calibration, data_shape_n in zip(dimensional_calibrations, data.shape)]
+                                        dimensional_calibration, data_shape_n in zip(dimensional_calibrations[-2:], data.shape[-2:])]
         self.__filtered_fft_xdata = DataAndMetadata.new_data_and_metadata(filtered_fft_data, dimensional_calibrations=fft_dimensional_calibrations)
 
     def commit(self) -> None:
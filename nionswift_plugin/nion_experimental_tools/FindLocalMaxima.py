@@ -1,5 +1,6 @@
 # standard libraries
 import gettext
+import itertools
 import math
 import typing
 
@@ -19,42 +20,112 @@ from nion.typeshed import API_1_0
 _ = gettext.gettext
 
 
-def function_find_local_maxima(input_xdata: DataAndMetadata._DataAndMetadataLike, spacing: int = 5, number_maxima: int = 10) -> typing.Tuple[typing.List[typing.Tuple[int, ...]], typing.List[float]]:
-    input_xdata = DataAndMetadata.promote_ndarray(input_xdata)
-
-    max_filtered = scipy.ndimage.maximum_filter(input_xdata.data, size=spacing)
-    local_maxima = max_filtered == input_xdata.data
+_DataArrayType = numpy.typing.NDArray[typing.Any]
 
-    if numpy.ndim(input_xdata.data) == 1:
-        footprint = numpy.array([True, False, True], dtype=bool)
-    elif numpy.ndim(input_xdata.data) == 2:
-        footprint = numpy.array([[True, True, True],
-                                 [True, False, True],
-                                 [True, True, True]], dtype=bool)
-    else:
-        raise ValueError(f'Only one- and two-dimensional data is supported by this function but input has {numpy.ndim(input_xdata.data)} dimensions.')
 
+def _find_local_maxima_flat(data: _DataArrayType, frame_ndim: int, spacing: int) -> typing.Tuple[_DataArrayType, _DataArrayType]:
+    # flat indices (in ascending order) and values of the local maxima of all frames (the last "frame_ndim" axes)
+    if frame_ndim not in (1, 2):
+        raise ValueError(f'Only one- and two-dimensional data is supported by this function but input has {frame_ndim} dimensions.')
+    batch_ndim = data.ndim - frame_ndim
+    max_filtered = scipy.ndimage.maximum_filter(data, size=(1,) * batch_ndim + (spacing,) * frame_ndim)
+    candidates = numpy.flatnonzero(max_filtered == data)
+    values = data.ravel()[candidates]
     # We want to select only the points that actually stand out from their neighbors. So far, also a flat region would
-    # be marked as local maximum.
-    selection_filtered = scipy.ndimage.maximum_filter(input_xdata.data, footprint=footprint)
-    selection = selection_filtered == input_xdata.data
-    local_maxima = numpy.logical_and(local_maxima, numpy.logical_not(selection))
-
-    if numpy.ndim(input_xdata.data) == 1:
-        x = numpy.mgrid[:local_maxima.shape[0]]
-        max_x, max_val = x[local_maxima], input_xdata.data[local_maxima]
-        max_list = sorted(zip(max_x, max_val), key=lambda key: key[-1], reverse=True) # type: ignore # mypy doesn't seem to recognize this
-    elif numpy.ndim(input_xdata.data) == 2:
-        y, x = numpy.mgrid[:local_maxima.shape[0], :local_maxima.shape[1]]
-        max_y, max_x, max_val = y[local_maxima], x[local_maxima], input_xdata.data[local_maxima]
-        max_list = sorted(zip(max_y, max_x, max_val), key=lambda key: key[-1], reverse=True) # type: ignore # mypy doesn't seem to recognize this
+    # be marked as local maximum. The neighbors are only looked up for the candidates, with the edges reflected like
+    # "scipy.ndimage.maximum_filter" does.
+    coordinates = numpy.unravel_index(candidates, data.shape)
+    neighbor_max: typing.Optional[_DataArrayType] = None
+    for offsets in itertools.product((-1, 0, 1), repeat=frame_ndim):
+        if not any(offsets):
+            continue
+        neighbor_coordinates = list(coordinates)
+        for i, offset in enumerate(offsets):
+            axis = batch_ndim + i
+            neighbor_coordinates[axis] = numpy.clip(coordinates[axis] + offset, 0, data.shape[axis] - 1)
+        neighbor_values = data[tuple(neighbor_coordinates)]
+        neighbor_max = neighbor_values if neighbor_max is None else numpy.maximum(neighbor_max, neighbor_values)
+    assert neighbor_max is not None
+    stands_out = neighbor_max != values
+    return candidates[stands_out], values[stands_out]
+
+
+def _select_largest(values: _DataArrayType, number: int) -> _DataArrayType:
+    # indices of the "number" largest "values" in descending order, equal values in ascending index order
+    if len(values) > number:
+        # partial selection of the largest values, keeping all values equal to the smallest selected one
+        threshold = numpy.partition(values, len(values) - number)[len(values) - number]
+        candidates = numpy.flatnonzero(values >= threshold)
     else:
-        raise ValueError(f'Only one- and two-dimensional data is supported by this function but input has {numpy.ndim(input_xdata.data)} dimensions.')
+        candidates = numpy.arange(len(values))
+    # sorting the reversed values stably and reversing the order again gives equal values in ascending index order
+    order = (len(candidates) - 1 - numpy.argsort(values[candidates][::-1], kind="stable"))[::-1]
+    return candidates[order[:number]]
+
+
+def _refine_positions(data: _DataArrayType, coordinates: typing.Sequence[_DataArrayType], frame_ndim: int) -> _DataArrayType:
+    # sub-pixel positions from a parabola through each maximum and its two neighbors along each frame axis
+    batch_ndim = data.ndim - frame_ndim
+    center_values = data[tuple(coordinates)].astype(numpy.float64)
+    positions = numpy.empty((len(center_values), frame_ndim))
+    for i in range(frame_ndim):
+        axis = batch_ndim + i
+        neighbor_values = list()
+        for offset in (-1, 1):
+            neighbor_coordinates = list(coordinates)
+            neighbor_coordinates[axis] = numpy.clip(coordinates[axis] + offset, 0, data.shape[axis] - 1)
+            neighbor_values.append(data[tuple(neighbor_coordinates)].astype(numpy.float64))
+        curvature = neighbor_values[0] - 2.0 * center_values + neighbor_values[1]
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            offsets = numpy.where(curvature != 0, 0.5 * (neighbor_values[0] - neighbor_values[1]) / curvature, 0.0)
+        positions[:, i] = coordinates[axis] + numpy.clip(offsets, -0.5, 0.5)
+    return positions
+
+
+def function_find_local_maxima(input_xdata: DataAndMetadata._DataAndMetadataLike, spacing: int = 5, number_maxima: int = 10,
+                               subpixel: bool = False) -> typing.Tuple[typing.List[typing.Tuple[float, ...]], typing.List[float]]:
+    input_xdata = DataAndMetadata.promote_ndarray(input_xdata)
+    data = numpy.asarray(input_xdata.data)
 
-    if len(max_list) > number_maxima:
-        max_list = max_list[:number_maxima]
+    if numpy.ndim(data) not in (1, 2):
+        raise ValueError(f'Only one- and two-dimensional data is supported by this function but input has {numpy.ndim(data)} dimensions.')
 
-    return [item[:-1] for item in max_list], [item[-1] for item in max_list]
+    max_indices, max_values = _find_local_maxima_flat(data, data.ndim, spacing)
+    selected = _select_largest(max_values, number_maxima)
+    coordinates = numpy.unravel_index(max_indices[selected], data.shape)
+    if subpixel:
+        points = [tuple(position) for position in _refine_positions(data, coordinates, data.ndim).tolist()]
+    else:
+        points = list(zip(*(coordinate.tolist() for coordinate in coordinates)))
+    return points, max_values[selected].tolist()
+
+
+def function_find_local_maxima_batch(data: _DataArrayType, frame_ndim: int = 2, spacing: int = 5, number_maxima: int = 10,
+                                     subpixel: bool = False) -> typing.Tuple[_DataArrayType, _DataArrayType]:
+    """Find the "number_maxima" largest local maxima in each frame (the last "frame_ndim" axes) of "data".
+
+    Returns a peak table with the positions (shape frames + (number_maxima, frame_ndim)) and the values (shape frames +
+    (number_maxima,)) of the maxima of each frame in descending order. Frames with fewer maxima are padded with NaN.
+    The positions are refined to sub-pixel precision if "subpixel" is set.
+    """
+    data = numpy.asarray(data)
+    batch_shape = data.shape[:data.ndim - frame_ndim]
+    frame_size = int(numpy.prod(data.shape[data.ndim - frame_ndim:], dtype=numpy.int64))
+    positions = numpy.full(batch_shape + (number_maxima, frame_ndim), numpy.nan)
+    values = numpy.full(batch_shape + (number_maxima,), numpy.nan)
+    max_indices, max_values = _find_local_maxima_flat(data, frame_ndim, spacing)
+    # the flat indices are in ascending order, so the maxima of each frame are consecutive
+    frame_starts = numpy.searchsorted(max_indices, numpy.arange(int(numpy.prod(batch_shape, dtype=numpy.int64)) + 1) * frame_size)
+    for frame_index, (start, stop) in enumerate(zip(frame_starts[:-1], frame_starts[1:])):
+        selected = start + _select_largest(max_values[start:stop], number_maxima)
+        coordinates = numpy.unravel_index(max_indices[selected], data.shape)
+        ii = numpy.unravel_index(frame_index, batch_shape)
+        if subpixel:
+            positions[ii][:len(selected)] = _refine_positions(data, coordinates, frame_ndim)
+        else:
+            positions[ii][:len(selected)] = numpy.stack(coordinates[len(batch_shape):], axis=-1)
+        values[ii][:len(selected)] = max_values[selected]
+    return positions, values
 
 
 class FindLocalMaxima(Symbolic.ComputationHandlerLike):
@@ -62,18 +133,19 @@ class FindLocalMaxima(Symbolic.ComputationHandlerLike):
     label = _("Find Local Maxima")
     inputs = {"input_data_item": {"label": _("Input data item"), "data_type": "xdata"},
               "spacing": {"label": _("Spacing")},
-              "number_maxima": {"label": _("Number maxima")}}
+              "number_maxima": {"label": _("Number maxima")},
+              "subpixel": {"label": _("Sub-pixel positions")}}
     outputs = dict[str, typing.Any]()
 
     def __init__(self, computation: Facade.Computation, **kwargs: typing.Any) -> None:
         self.computation = computation
-        self.__max_points: typing.List[typing.Tuple[int, ...]] = []
+        self.__max_points: typing.List[typing.Tuple[float, ...]] = []
         self.__max_vals: typing.List[float] = []
         self.__api = Facade.get_api(version="~1.0")
 
-    def execute(self, *, input_data_item: Facade.DataItem, spacing: int, number_maxima: int, **kwargs: typing.Any) -> None: # type: ignore
+    def execute(self, *, input_data_item: Facade.DataItem, spacing: int, number_maxima: int, subpixel: bool = False, **kwargs: typing.Any) -> None: # type: ignore
         assert input_data_item.xdata is not None
-        self.__max_points, self.__max_vals = function_find_local_maxima(input_data_item.xdata.data, spacing, number_maxima)
+        self.__max_points, self.__max_vals = function_find_local_maxima(input_data_item.xdata.data, spacing, number_maxima, subpixel)
         return None
 
     def commit(self) -> None:
@@ -106,7 +178,8 @@ def find_local_maxima(api: API_1_0.API, data_item: Facade.DataItem) -> None:
     api.library.create_computation("nion.find_local_maxima",
                                    inputs={"input_data_item": data_item,
                                            "spacing": 5,
-                                           "number_maxima": 10},
+                                           "number_maxima": 10,
+                                           "subpixel": False},
                                    outputs={"max_graphics": None})
 
 
@@ -3,13 +3,14 @@ import logging
 import typing
 
 import numpy
-import scipy.optimize
 
 from nion.data import DataAndMetadata
 from nion.swift.model import Symbolic
 from nion.typeshed import API_1_0 as API
 from nion.swift import Facade
 
+from . import DPCRotation
+
 _ = gettext.gettext
 
 
@@ -34,14 +35,8 @@ class MakeColorCOM(Symbolic.ComputationHandlerLike):
         self.__result_xdata: typing.Optional[DataAndMetadata.DataAndMetadata] = None
         self.__divergence_xdata: typing.Optional[DataAndMetadata.DataAndMetadata] = None
 
-    def __calculate_curl(self, rotation: float, com_x: float, com_y: float) -> float:
-        com_x_rotated = com_x * numpy.cos(rotation) - com_y * numpy.sin(rotation)
-        com_y_rotated = com_x * numpy.sin(rotation) + com_y * numpy.cos(rotation)
-        curl_com = numpy.gradient(com_y_rotated, axis=1) - numpy.gradient(com_x_rotated, axis=0)
-        return float(numpy.mean(curl_com**2))
-
     def execute(self, src: typing.Optional[Facade.DataItem] = None, com_x_index: int = 0, com_y_index: int = 0,
-                magnitude_min: float = 0.0, magnitude_max: float = 0.0, rotation_str: typing.Optional[str] = None,
+                magnitude_min: float = 0.0, magnitude_max: float = 0.0, rotation: typing.Optional[str] = None,
                 crop_region: typing.Optional[Facade.Graphic] = None, **kwargs: typing.Any) -> None:
         assert src
         assert crop_region
@@ -60,19 +55,15 @@ class MakeColorCOM(Symbolic.ComputationHandlerLike):
         com_x = com_x[crop_slices] - numpy.mean(com_x[crop_slices])
         com_y = com_y[crop_slices] - numpy.mean(com_y[crop_slices])
         # Don't use "if rotation" here because that would also calculate rotation for a given value of 0
-        if not rotation_str or rotation_str == "None":
-            res = scipy.optimize.minimize_scalar(self.__calculate_curl, 0, args=(com_x, com_y), bounds=(0, numpy.pi*2), method='bounded')
-            if res.success:
-                rotation = res.x
-                logging.debug(f'Calculated optimal rotation: {rotation*180/numpy.pi:.1f} degree.')
-            else:
-                logging.warning(f'Could not find the optimal rotation. Optimize error: {res.message}\nUsing rotation=0 as default.')
-                rotation = 0
+        if not rotation or rotation == "None":
+            # the rotation only depends on the field, so changes of other parameters reuse it
+            rotation_angle = DPCRotation.get_rotation(com_x, com_y)
+            logging.debug(f'Calculated optimal rotation: {rotation_angle*180/numpy.pi:.1f} degree.')
         else:
-            rotation = float(rotation_str) / 180.0 * numpy.pi
+            rotation_angle = float(rotation) / 180.0 * numpy.pi
 
-        com_x_rotated = com_x * numpy.cos(rotation) - com_y * numpy.sin(rotation)
-        com_y_rotated = com_x * numpy.sin(rotation) + com_y * numpy.cos(rotation)
+        com_x_rotated = com_x * numpy.cos(rotation_angle) - com_y * numpy.sin(rotation_angle)
+        com_y_rotated = com_x * numpy.sin(rotation_angle) + com_y * numpy.cos(rotation_angle)
 
         divergence = numpy.gradient(com_x_rotated, axis=1) + numpy.gradient(com_y_rotated, axis=0)
 
@@ -1,19 +1,70 @@
 import gettext
 import logging
 import typing
-import warnings
 
 import numpy
-import scipy.optimize
+import numpy.typing
+import scipy.fft
 
 from nion.data import DataAndMetadata
+from nion.experimental import Registration
 from nion.swift import Facade
 from nion.swift.model import Symbolic
 from nion.typeshed import API_1_0
 
+from . import DPCRotation
+from . import MultiDimensionalProcessing
+
 
 _ = gettext.gettext
 
+_DataArrayType = numpy.typing.NDArray[typing.Any]
+
+
+class IDPCKernel:
+    """The Fourier space integration kernels of the x and y gradients for the real-input transform ("rfft2")."""
+
+    def __init__(self, frame_shape: typing.Tuple[int, int], scales: typing.Tuple[float, float], dtype: numpy.typing.DTypeLike) -> None:
+        freq_v = numpy.fft.fftfreq(frame_shape[0], d=scales[0])[:, numpy.newaxis]
+        freq_u = numpy.fft.rfftfreq(frame_shape[1], d=scales[1])[numpy.newaxis, :]
+        freq_squared = freq_u ** 2 + freq_v ** 2
+        freq_squared[0, 0] = 1.0
+        self.kernel_x = (freq_u / (1j * freq_squared)).astype(dtype)
+        self.kernel_y = (freq_v / (1j * freq_squared)).astype(dtype)
+        # the zero frequency (the undefined mean of the integrated image) is set to zero. so is the derivative at the
+        # nyquist frequency of even sizes, which has no defined sign (this matches the real part of the full FFT).
+        self.kernel_x[0, 0] = 0.0
+        self.kernel_y[0, 0] = 0.0
+        if frame_shape[0] % 2 == 0:
+            self.kernel_y[frame_shape[0] // 2, :] = 0.0
+        if frame_shape[1] % 2 == 0:
+            self.kernel_x[:, frame_shape[1] // 2] = 0.0
+
+
+# kernels of the most recently used frame shapes and calibrations.
+idpc_kernel_cache = Registration.LRUCache(8)
+
+
+def get_idpc_kernel(frame_shape: typing.Tuple[int, int], scales: typing.Tuple[float, float], dtype: numpy.typing.DTypeLike) -> IDPCKernel:
+    key = (tuple(frame_shape), tuple(float(scale) for scale in scales), numpy.dtype(dtype).str)
+    return idpc_kernel_cache.get_or_create(key, lambda: IDPCKernel(frame_shape, scales, dtype))
+
+
+def function_integrate_dpc(gradx: _DataArrayType, grady: _DataArrayType, scales: typing.Tuple[float, float],
+                           workers: typing.Optional[int] = None) -> _DataArrayType:
+    """Integrate the gradients "gradx" and "grady" of the frames (the last two axes) to the iDPC image.
+
+    All frames (e.g. a time series) are integrated with one batched real-input FFT in the precision of the data.
+    "scales" are the pixel sizes along y and x. The result has a mean of zero.
+    """
+    frame_shape = (gradx.shape[-2], gradx.shape[-1])
+    float_dtype = numpy.result_type(gradx.dtype, grady.dtype, numpy.float32)
+    kernel = get_idpc_kernel(frame_shape, scales, numpy.result_type(float_dtype, numpy.complex64))
+    workers = workers or MultiDimensionalProcessing.default_num_workers()
+    fft_idpc = scipy.fft.rfft2(gradx.astype(float_dtype, copy=False), workers=workers) * kernel.kernel_x
+    fft_idpc += scipy.fft.rfft2(grady.astype(float_dtype, copy=False), workers=workers) * kernel.kernel_y
+    return typing.cast(_DataArrayType, scipy.fft.irfft2(fft_idpc, s=frame_shape, workers=workers))
+
 
 class MakeIDPC(Symbolic.ComputationHandlerLike):
     computation_id = "nion.make_idpc"
@@ -32,12 +83,6 @@ class MakeIDPC(Symbolic.ComputationHandlerLike):
         self.computation = computation
         self.__result_xdata: typing.Optional[DataAndMetadata.DataAndMetadata] = None
 
-    def __calculate_curl(self, rotation: float, com_x: float, com_y: float) -> float:
-        com_x_rotated = com_x * numpy.cos(rotation) - com_y * numpy.sin(rotation)
-        com_y_rotated = com_x * numpy.sin(rotation) + com_y * numpy.cos(rotation)
-        curl_com = numpy.gradient(com_y_rotated, axis=1) - numpy.gradient(com_x_rotated, axis=0)
-        return float(numpy.mean(curl_com**2))
-
     def execute(self, *,
                 src: typing.Optional[Facade.DataItem] = None, gradient_x_index: int = 0, gradient_y_index: int = 0,
                 flip_x: bool = False, flip_y: bool = False, rotation_str: typing.Optional[str] = None,
@@ -49,43 +94,49 @@ class MakeIDPC(Symbolic.ComputationHandlerLike):
         assert dpc_xdata
         assert dpc_xdata.is_datum_2d
         assert dpc_xdata.is_sequence or dpc_xdata.collection_dimension_count == 1
-        gradx = dpc_xdata.data[gradient_x_index]
-        grady = dpc_xdata.data[gradient_y_index]
-        top_x = crop_region.bounds[0][1] * gradx.shape[1]
-        top_y = crop_region.bounds[0][0] * gradx.shape[0]
-        crop_slices = (slice(int(top_y), int(top_y + crop_region.bounds[1][0] * gradx.shape[0])),
-                       slice(int(top_x), int(top_x + crop_region.bounds[1][1] * gradx.shape[1])))
+        # a sequence of DPC pairs (e.g. a time series) has the components in its collection axis and is integrated
+        # as a whole. otherwise the components are in the first axis.
+        is_series = dpc_xdata.is_sequence and dpc_xdata.collection_dimension_count == 1
+        component_axis = 1 if is_series else 0
+        gradx = numpy.take(dpc_xdata.data, gradient_x_index, axis=component_axis)
+        grady = numpy.take(dpc_xdata.data, gradient_y_index, axis=component_axis)
+        frame_shape = gradx.shape[-2:]
+        top_x = crop_region.bounds[0][1] * frame_shape[1]
+        top_y = crop_region.bounds[0][0] * frame_shape[0]
+        crop_slices = (Ellipsis,
+                       slice(int(top_y), int(top_y + crop_region.bounds[1][0] * frame_shape[0])),
+                       slice(int(top_x), int(top_x + crop_region.bounds[1][1] * frame_shape[1])))
         # Subtract the mean of each component so that we remove any global offset
-        gradx = gradx[crop_slices] - numpy.mean(gradx[crop_slices])
-        grady = grady[crop_slices] - numpy.mean(grady[crop_slices])
+        gradx = gradx[crop_slices] - numpy.mean(gradx[crop_slices], axis=(-2, -1), keepdims=True)
+        grady = grady[crop_slices] - numpy.mean(grady[crop_slices], axis=(-2, -1), keepdims=True)
         if flip_x:
             gradx *= -1.0
         if flip_y:
             grady *= -1.0
         # Don't use "if rotation" here because that would also calculate rotation for a given value of 0
         if not rotation_str or rotation_str == "None":
-            res = scipy.optimize.minimize_scalar(self.__calculate_curl, 0, args=(gradx, grady), bounds=(0, numpy.pi*2), method='bounded')
-            if res.success:
-                rotation = res.x
-                logging.debug(f'Calculated optimal rotation: {rotation*180/numpy.pi:.1f} degree.')
-            else:
-                logging.warning(f'Could not find the optimal rotation. Optimize error: {res.message}\nUsing rotation=0 as default.')
-                rotation = 0
+            # the rotation only depends on the field, so changes of other parameters reuse it
+            rotation = DPCRotation.get_rotation(gradx, grady)
+            logging.debug(f'Calculated optimal rotation: {rotation*180/numpy.pi:.1f} degree.')
         else:
             rotation = float(rotation_str) / 180.0 * numpy.pi
 
-        gradx_rotated = gradx * numpy.cos(rotation) - grady * numpy.sin(rotation)
-        grady_rotated = gradx * numpy.sin(rotation) + grady * numpy.cos(rotation)
-        freq_v = numpy.fft.fftfreq(gradx.shape[-2], d=dpc_xdata.dimensional_calibrations[-2].scale)
-        freq_u = numpy.fft.fftfreq(gradx.shape[-1], d=dpc_xdata.dimensional_calibrations[-1].scale)
-        freqs = numpy.meshgrid(freq_u, freq_v)
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            fft_idpc = (numpy.fft.fft2(gradx_rotated) * freqs[0] + numpy.fft.fft2(grady_rotated) * freqs[1]) / (1j * (freqs[0]**2 + freqs[1]**2))
-        fft_idpc[numpy.isnan(fft_idpc)] = 0
-        self.__result_xdata = DataAndMetadata.new_data_and_metadata(numpy.real(numpy.fft.ifft2(fft_idpc)),
-                                                                    intensity_calibration=dpc_xdata.intensity_calibration,
-                                                                    dimensional_calibrations=dpc_xdata.dimensional_calibrations[1:])
+        # python floats keep the precision of the data
+        cos_rotation = float(numpy.cos(rotation))
+        sin_rotation = float(numpy.sin(rotation))
+        gradx_rotated = gradx * cos_rotation - grady * sin_rotation
+        grady_rotated = gradx * sin_rotation + grady * cos_rotation
+        scales = (dpc_xdata.dimensional_calibrations[-2].scale, dpc_xdata.dimensional_calibrations[-1].scale)
+        idpc = function_integrate_dpc(gradx_rotated, grady_rotated, scales)
+        if is_series:
+            self.__result_xdata = DataAndMetadata.new_data_and_metadata(idpc,
+                                                                        intensity_calibration=dpc_xdata.intensity_calibration,
+                                                                        dimensional_calibrations=[dpc_xdata.dimensional_calibrations[0]] + list(dpc_xdata.dimensional_calibrations[2:]),
+                                                                        data_descriptor=DataAndMetadata.DataDescriptor(True, 0, 2))
+        else:
+            self.__result_xdata = DataAndMetadata.new_data_and_metadata(idpc,
+                                                                        intensity_calibration=dpc_xdata.intensity_calibration,
+                                                                        dimensional_calibrations=dpc_xdata.dimensional_calibrations[1:])
 
     def commit(self) -> None:
         if self.__result_xdata:
@@ -2,9 +2,15 @@ import typing
 import gettext
 import copy
 import math
+import functools
+import itertools
+import operator
+import os
 import numpy
 import numpy.typing
+import scipy.ndimage
 
+from nion.data import Calibration
 from nion.data import Core
 from nion.data import DataAndMetadata
 from nion.data import MultiDimensionalProcessing
@@ -17,6 +23,8 @@ from nion.ui import Declarative
 from nion.utils import Registry
 from nion.utils import Observable
 from nion.swift import Facade
+from nion.experimental import Parallel
+from nion.experimental import Registration
 
 try:
     import mkl
@@ -32,6 +40,10 @@ _DataArrayType = numpy.typing.NDArray[typing.Any]
 
 computation_settings: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
 
+# Upper limit (in bytes) for the amount of input data that is read at once when integrating along an axis. Large
+# data items are stored in HDF5 files, so keeping this bounded avoids loading the whole data set into memory.
+INTEGRATION_MEMORY_BUDGET = 512 * 1024 * 1024
+
 
 class MultiDimensionalProcessingComputation(Symbolic.ComputationHandlerLike):
 
@@ -113,6 +125,77 @@ def function_crop_along_axis(input_xdata: DataAndMetadata.DataAndMetadata, crop_
     return input_xdata[crop_slices]
 
 
+def _iterate_navigation_chunks(data_shape: typing.Sequence[int], navigation_axes: typing.Sequence[int], item_size: int, memory_budget: int) -> typing.Iterator[typing.Tuple[slice, ...]]:
+    """Yield slices that split "data_shape" into chunks of at most "memory_budget" bytes along the navigation axes.
+
+    Integration axes are never split. Chunks are always at least two elements long along each navigation axis (unless
+    the axis itself is shorter) because einsum takes a different code path for length-one axes, which would change the
+    rounding of the result. For the same reason a remainder of one element is merged into the previous chunk.
+    """
+    navigation_axes = sorted(navigation_axes)
+    chunk_shape = list(data_shape)
+    chunk_size = item_size * functools.reduce(operator.mul, chunk_shape, 1)
+    for axis in navigation_axes:
+        if chunk_size <= memory_budget:
+            break
+        size_per_index = chunk_size // chunk_shape[axis]
+        chunk_shape[axis] = max(min(2, chunk_shape[axis]), memory_budget // size_per_index)
+        chunk_size = size_per_index * chunk_shape[axis]
+    axis_slices: typing.List[typing.List[slice]] = []
+    for axis in navigation_axes:
+        starts = list(range(0, data_shape[axis], chunk_shape[axis]))
+        if len(starts) > 1 and data_shape[axis] - starts[-1] == 1:
+            starts.pop()
+        stops = starts[1:] + [data_shape[axis]]
+        axis_slices.append([slice(start, stop) for start, stop in zip(starts, stops)])
+    for navigation_slices in itertools.product(*axis_slices):
+        slices: typing.List[slice] = [slice(None)] * len(data_shape)
+        for axis, navigation_slice in zip(navigation_axes, navigation_slices):
+            slices[axis] = navigation_slice
+        yield tuple(slices)
+
+
+def function_integrate_along_axis_chunked(input_xdata: DataAndMetadata.DataAndMetadata,
+                                          integration_axes: typing.Tuple[int, ...],
+                                          integration_mask: typing.Optional[_DataArrayType] = None,
+                                          memory_budget: typing.Optional[int] = None) -> DataAndMetadata.DataAndMetadata:
+    """Same as "MultiDimensionalProcessing.function_integrate_along_axis" but reads the input in bounded chunks.
+
+    The input is split along the non-integrated axes into chunks of at most "memory_budget" bytes (defaults to
+    INTEGRATION_MEMORY_BUDGET). Each chunk is read from the underlying data (which can be an HDF5 dataset), integrated
+    and written into a preallocated result. The integration of each element is unchanged, so the result is identical
+    to integrating the whole data set at once.
+    """
+    memory_budget = memory_budget if memory_budget is not None else INTEGRATION_MEMORY_BUDGET
+    data_shape = input_xdata.data_shape
+    navigation_axes = [i for i in range(len(data_shape)) if i not in integration_axes]
+    if not navigation_axes:
+        # Integrating everything gives a single number, there is nothing to split.
+        return MultiDimensionalProcessing.function_integrate_along_axis(input_xdata, integration_axes, integration_mask)
+
+    input_data = input_xdata.data
+    assert input_data is not None
+    result_xdata: typing.Optional[DataAndMetadata.DataAndMetadata] = None
+    result_data: typing.Optional[_DataArrayType] = None
+    for slices in _iterate_navigation_chunks(data_shape, navigation_axes, numpy.dtype(input_xdata.data_dtype).itemsize, memory_budget):
+        chunk_xdata = DataAndMetadata.new_data_and_metadata(data=numpy.asarray(input_data[slices]),
+                                                            intensity_calibration=input_xdata.intensity_calibration,
+                                                            dimensional_calibrations=input_xdata.dimensional_calibrations,
+                                                            data_descriptor=input_xdata.data_descriptor)
+        chunk_result_xdata = MultiDimensionalProcessing.function_integrate_along_axis(chunk_xdata, integration_axes, integration_mask)
+        if result_data is None:
+            result_xdata = chunk_result_xdata
+            result_data = numpy.empty(tuple(data_shape[i] for i in navigation_axes), dtype=chunk_result_xdata.data.dtype)
+        result_data[tuple(slices[i] for i in navigation_axes)] = chunk_result_xdata.data
+
+    assert result_xdata is not None
+    assert result_data is not None
+    return DataAndMetadata.new_data_and_metadata(data=result_data,
+                                                 intensity_calibration=result_xdata.intensity_calibration,
+                                                 dimensional_calibrations=result_xdata.dimensional_calibrations,
+                                                 data_descriptor=result_xdata.data_descriptor)
+
+
 class IntegrateAlongAxis(MultiDimensionalProcessingComputation):
     computation_id = "nion.integrate_along_axis"
     label = _("Integrate")
@@ -176,7 +259,7 @@ class IntegrateAlongAxis(MultiDimensionalProcessingComputation):
             integration_axis_shape = tuple((input_xdata.data_shape[i] for i in integration_axis_indices))
             integration_mask = integration_graphic.mask_xdata_with_shape(integration_axis_shape).data
 
-        self.__result_xdata = MultiDimensionalProcessing.function_integrate_along_axis(input_xdata, tuple(integration_axis_indices), integration_mask)
+        self.__result_xdata = function_integrate_along_axis_chunked(input_xdata, tuple(integration_axis_indices), integration_mask)
         return None
 
 
@@ -185,6 +268,128 @@ class IntegrateAlongAxis(MultiDimensionalProcessingComputation):
         return None
 
 
+def default_num_workers() -> int:
+    # Use a little bit more than half the CPU cores, but not more than 20 because then we actually get a slowdown
+    # because of our HDF5 storage handler not being able to grant parallel access to the data
+    return max(1, min(int(round((os.cpu_count() or 8) * 0.6)), 20))
+
+
+def function_measure_multi_dimensional_shifts(xdata: DataAndMetadata.DataAndMetadata,
+                                              shift_axes: typing.Tuple[int, ...],
+                                              reference_index: typing.Optional[int] = None,
+                                              bounds: typing.Optional[typing.Union[Core.NormIntervalType, Core.NormRectangleType]] = None,
+                                              max_shift: typing.Optional[int] = None,
+                                              origin: typing.Optional[typing.Tuple[int, ...]] = None,
+                                              num_workers: typing.Optional[int] = None) -> DataAndMetadata.DataAndMetadata:
+    """Same as "MultiDimensionalProcessing.function_measure_multi_dimensional_shifts" with a configurable worker count.
+
+    The frames are split into "num_workers" contiguous sections that are registered on separate threads (the FFTs
+    release the GIL). Each frame is registered exactly like in the serial case, so the shifts do not depend on the
+    number of workers. When "max_shift" is used together with "reference_index" the mask of each frame depends on the
+    shift of the previous frame, so at most two threads (one on each side of the reference) can be used.
+    "num_workers" defaults to "default_num_workers()".
+    """
+    num_workers = num_workers if num_workers and num_workers > 0 else default_num_workers()
+
+    iteration_shape: typing.Tuple[int, ...] = tuple()
+    dimensional_calibrations = list()
+    intensity_calibration = None
+    for i in range(len(xdata.data_shape)):
+        if not i in shift_axes:
+            iteration_shape += (xdata.data_shape[i],)
+            dimensional_calibrations.append(xdata.dimensional_calibrations[i])
+        else:
+            intensity_calibration = Calibration.Calibration(scale=xdata.dimensional_calibrations[i].scale, units=xdata.dimensional_calibrations[i].units)
+
+    register_slice: typing.Union[slice, typing.Tuple[slice, slice]]
+    if len(shift_axes) > 1:
+        result_shape = iteration_shape + (2,)
+        dimensional_calibrations.append(Calibration.Calibration())
+        if bounds is not None:
+            assert numpy.ndim(bounds) == 2
+            bounds_2d = typing.cast(Core.NormRectangleType, bounds)
+            shape = (xdata.data_shape[shift_axes[0]], xdata.data_shape[shift_axes[1]])
+            register_slice = (slice(max(0, int(round(bounds_2d[0][0] * shape[0]))), min(int(round((bounds_2d[0][0] + bounds_2d[1][0]) * shape[0])), shape[0])),
+                              slice(max(0, int(round(bounds_2d[0][1] * shape[1]))), min(int(round((bounds_2d[0][1] + bounds_2d[1][1]) * shape[1])), shape[1])))
+        else:
+            register_slice = (slice(0, None), slice(0, None))
+    else:
+        result_shape = iteration_shape + (1,)
+        if bounds is not None:
+            assert numpy.ndim(bounds) == 1
+            bounds_1d = typing.cast(Core.NormIntervalType, bounds)
+            length = xdata.data_shape[shift_axes[0]]
+            register_slice = slice(max(0, int(round(bounds_1d[0] * length))), min(int(round(bounds_1d[1] * length)), length))
+        else:
+            register_slice = slice(0, None)
+
+    data = xdata.data
+    assert data is not None
+
+    def get_frame(index: int) -> _DataArrayType:
+        coords = numpy.unravel_index(index, iteration_shape)
+        return typing.cast(_DataArrayType, data[coords[:shift_axes[0]] + (...,) + coords[shift_axes[0]:]])
+
+    reference_data = get_frame(reference_index) if reference_index is not None else None
+    frame_shape = get_frame(0)[register_slice].shape
+    if origin is None:
+        origin = tuple([0] * len(frame_shape))
+
+    mask = None
+    # If we measure shifts relative to the last frame, we can always use a mask that is centered around the input origin
+    if max_shift is not None and reference_index is None:
+        mask = MultiDimensionalProcessing._make_mask(max_shift, origin, frame_shape)
+
+    shifts = numpy.zeros(result_shape, dtype=numpy.float32)
+    start_index = 0 if reference_index is not None else 1
+    navigation_len = int(numpy.prod(iteration_shape, dtype=numpy.int64))
+
+    ranges: typing.List[range]
+    if max_shift is not None and reference_index is not None:
+        if reference_index == 0:
+            ranges = [range(start_index, navigation_len)]
+        elif reference_index == navigation_len - 1:
+            ranges = [range(navigation_len - 1, start_index - 1, -1)]
+        else:
+            ranges = [range(reference_index, start_index - 1, -1), range(reference_index, navigation_len)]
+    else:
+        sections = list(range(start_index, navigation_len, max(1, math.ceil((navigation_len - start_index) / num_workers))))
+        sections.append(navigation_len)
+        ranges = [range(sections[i], sections[i + 1]) for i in range(len(sections) - 1)]
+
+    # all frames are registered against the same reference, so its terms are calculated once for all threads
+    reference = Registration.TemplateMatchReference(reference_data[register_slice], frame_shape) if reference_data is not None else None
+
+    def register_frames_on_thread(range_: range) -> None:
+        if _has_mkl:
+            mkl.set_num_threads_local(1)
+        local_mask = mask
+        for i in range_:
+            frame = get_frame(i)[register_slice]
+            if reference is None:
+                # relative shifts use every frame only once as reference, so caching its terms would not help
+                shifts[numpy.unravel_index(i, iteration_shape)] = Registration.register_template(get_frame(i - range_.step)[register_slice], frame, ccorr_mask=local_mask,
+                                                                                                 use_cache=False)[1]
+                continue
+            if max_shift is not None and i != range_.start:
+                last_shift = shifts[numpy.unravel_index(i - range_.step, iteration_shape)]
+                local_mask = MultiDimensionalProcessing._make_mask(max_shift, tuple(o + round(s) for o, s in zip(origin, last_shift)), frame_shape)
+            shifts[numpy.unravel_index(i, iteration_shape)] = reference.register(frame, ccorr_mask=local_mask)[1]
+
+    Parallel.run_on_threads(register_frames_on_thread, ranges)
+
+    shifts = numpy.squeeze(shifts)
+
+    if reference_index is None:
+        if len(iteration_shape) == 2:
+            shifts = numpy.cumsum(shifts, axis=1)
+        shifts = numpy.cumsum(shifts, axis=0)
+
+    return DataAndMetadata.new_data_and_metadata(data=shifts,
+                                                 intensity_calibration=intensity_calibration,
+                                                 dimensional_calibrations=dimensional_calibrations)
+
+
 class MeasureShifts(MultiDimensionalProcessingComputation):
     computation_id = "nion.measure_shifts"
     label = _("Measure Shifts")
@@ -193,6 +398,7 @@ class MeasureShifts(MultiDimensionalProcessingComputation):
               "reference_index": {"label": _("Reference index for shifts")},
               "relative_shifts": {"label": _("Measure shifts relative to previous slice")},
               "max_shift": {"label": _("Max shift between consecutive frames (in pixels, <= 0 to disable)")},
+              "num_workers": {"label": _("Number of worker threads (<= 0 for automatic)")},
               "bounds_graphic": {"label": _("Shift bounds")},
               }
     outputs = {"shifts": {"label": _("Shifts")},
@@ -220,7 +426,7 @@ class MeasureShifts(MultiDimensionalProcessingComputation):
 
         return shift_axis
 
-    def execute(self, *, input_data_item: Facade.DataItem, axes_description: str, reference_index: typing.Optional[int] = None, relative_shifts: bool=True, max_shift: int=0, bounds_graphic: typing.Optional[Facade.Graphic]=None, **kwargs: typing.Any) -> None: # type: ignore
+    def execute(self, *, input_data_item: Facade.DataItem, axes_description: str, reference_index: typing.Optional[int] = None, relative_shifts: bool=True, max_shift: int=0, num_workers: int=0, bounds_graphic: typing.Optional[Facade.Graphic]=None, **kwargs: typing.Any) -> None: # type: ignore
         input_xdata = input_data_item.xdata
         assert input_xdata is not None
         bounds: typing.Optional[typing.Union[typing.Tuple[float, float], typing.Tuple[typing.Tuple[float, float], typing.Tuple[float, float]]]] = None
@@ -246,13 +452,14 @@ class MeasureShifts(MultiDimensionalProcessingComputation):
         else:
             raise ValueError(f"Unknown shift axis: '{shift_axis}'.")
 
-        self.__shifts_xdata = MultiDimensionalProcessing.function_measure_multi_dimensional_shifts(input_xdata, tuple(shift_axis_indices), reference_index=reference_index, bounds=bounds, max_shift=max_shift_)
+        self.__shifts_xdata = function_measure_multi_dimensional_shifts(input_xdata, tuple(shift_axis_indices), reference_index=reference_index, bounds=bounds, max_shift=max_shift_, num_workers=num_workers)
         settings_dict = computation_settings.setdefault(self.computation._computation.processing_id, dict())
         settings_dict["axes_description"] = axes_description
         # Reference index cannot be None, otherwise the computation will fail to run the next time
         settings_dict["reference_index"] = reference_index or 0
         settings_dict["relative_shifts"] = relative_shifts
         settings_dict["max_shift"] = max_shift
+        settings_dict["num_workers"] = num_workers
         return None
 
     def commit(self) -> None:
@@ -269,6 +476,7 @@ def measure_shifts(api: Facade.API_1, window: Facade.DocumentWindow, data_item:
               "reference_index": settings_dict.get("reference_index", 0),
               "relative_shifts": settings_dict.get("relative_shifts", False),
               "max_shift": settings_dict.get("max_shift", 0),
+              "num_workers": settings_dict.get("num_workers", 0),
               }
     if bounds_graphic:
         inputs["bounds_graphic"] = bounds_graphic
@@ -310,6 +518,106 @@ class MeasureShiftsMenuItemDelegate:
         return None
 
 
+def calculate_valid_area_slices(data_shape: typing.Tuple[int, ...], shift_axes: typing.Sequence[int], shifts: _DataArrayType) -> typing.Tuple[slice, ...]:
+    """Return slices (one for each axis in "data_shape") that crop the shift axes to the valid area of "shifts"."""
+    shift_axis_shape = tuple(data_shape[i] for i in range(len(data_shape)) if i in shift_axes)
+    valid_area = calculate_valid_area_from_shifts(shift_axis_shape, shifts)
+    slices: typing.Tuple[slice, ...] = tuple()
+    k = 0
+    for i in range(len(data_shape)):
+        if i in shift_axes:
+            slices += (slice(valid_area[k], valid_area[k+2]),)
+            k += 1
+        else:
+            slices += (slice(0, None),)
+    return slices
+
+
+def _crop_dimensional_calibrations(dimensional_calibrations: typing.Sequence[Calibration.Calibration], crop_slices: typing.Sequence[slice]) -> typing.List[Calibration.Calibration]:
+    return [Calibration.Calibration(calibration.offset + (crop_slice.start or 0) * calibration.scale, calibration.scale, calibration.units)
+            for calibration, crop_slice in zip(dimensional_calibrations, crop_slices)]
+
+
+def function_apply_multi_dimensional_shifts(xdata: DataAndMetadata.DataAndMetadata,
+                                            shifts: _DataArrayType,
+                                            shift_axes: typing.Tuple[int, ...],
+                                            out: typing.Optional[DataAndMetadata.DataAndMetadata] = None,
+                                            crop_to_valid: bool = False) -> DataAndMetadata.DataAndMetadata:
+    """Same as "MultiDimensionalProcessing.function_apply_multi_dimensional_shifts" but can crop while shifting.
+
+    The data is shifted one slice at a time. If "crop_to_valid" is set, each shifted slice is cropped to the valid area
+    of "shifts" before it is written to the result, so the result never has to hold the full shifted data. If "out" is
+    given, the result is written to it directly. It must already have the (cropped) result shape.
+    """
+    # Find the axes that we do not want to shift (== iteration shape)
+    iteration_shape: typing.Tuple[int, ...] = tuple()
+    iteration_shape_offset = 0
+    for i in range(len(xdata.data_shape)):
+        if not i in shift_axes:
+            iteration_shape += (xdata.data_shape[i],)
+        elif len(iteration_shape) == 0:
+            iteration_shape_offset += 1
+    # If we are shifting along more than one axis the shifts will have an extra axis to hold the shifts for these axes.
+    shifts_shape = shifts.shape[:-1] if len(shift_axes) > 1 else shifts.shape
+    for i in range(len(iteration_shape) - len(shifts_shape) + 1):
+        if iteration_shape[i:i+len(shifts_shape)] == shifts_shape:
+            shifts_end_axis = i + len(shifts_shape)
+            break
+    else:
+        raise ValueError("Did not find any axis matching the shifts shape.")
+
+    # Drop all iteration axes after the last shift axis, so that we work on larger sub-arrays
+    squeezed_iteration_shape = iteration_shape[:shifts_end_axis]
+
+    if crop_to_valid:
+        crop_slices = calculate_valid_area_slices(xdata.data_shape, shift_axes, shifts)
+    else:
+        crop_slices = tuple(slice(0, None) for _ in xdata.data_shape)
+    result_shape = tuple(len(range(length)[crop_slice]) for length, crop_slice in zip(xdata.data_shape, crop_slices))
+
+    if out is None:
+        result = numpy.empty(result_shape, dtype=xdata.data_dtype)
+    else:
+        assert out.data_shape == result_shape
+        result = out.data
+    data = xdata.data
+    assert data is not None
+
+    def shift_slice(key: typing.Tuple[typing.Union[int, slice], ...], shift: _DataArrayType) -> None:
+        # Axes that are indexed with a slice in "key" are part of the shifted sub-array, so they also need to be cropped
+        sub_array_crop = tuple(crop_slices[i] for i, k in enumerate(key) if isinstance(k, slice)) + crop_slices[len(key):]
+        result_key = tuple(slice(None) if isinstance(k, slice) else k for k in key)
+        result[result_key] = scipy.ndimage.shift(data[key], shift, order=1)[sub_array_crop]
+
+    navigation_len = int(numpy.prod(squeezed_iteration_shape, dtype=numpy.int64))
+    num_threads = default_num_workers()
+    sections = list(range(0, navigation_len, max(1, navigation_len // num_threads)))
+    sections.append(navigation_len)
+
+    def shift_slices_on_thread(range_: range) -> None:
+        shifts_array = numpy.zeros(len(shift_axes) + (len(iteration_shape) - len(squeezed_iteration_shape)))
+        for i in range_:
+            coords = typing.cast(typing.Tuple[int, ...], numpy.unravel_index(i, squeezed_iteration_shape))
+            if shifts_end_axis < len(shifts.shape):
+                for j, ind in enumerate(shift_axes):
+                    shifts_array[ind - len(squeezed_iteration_shape)] = shifts[coords[:shifts_end_axis]][j]
+                shift_slice(coords, shifts_array)
+            elif iteration_shape_offset != 0:
+                shifts_array[0] = shifts[coords]
+                shift_slice(tuple([slice(None) for _ in range(iteration_shape_offset)]) + coords, shifts_array)
+            else:
+                shifts_array[0] = shifts[coords]
+                shift_slice(coords, shifts_array)
+
+    Parallel.run_on_threads(shift_slices_on_thread, [range(sections[i], sections[i+1]) for i in range(len(sections) - 1)])
+
+    return DataAndMetadata.new_data_and_metadata(data=result,
+                                                 intensity_calibration=xdata.intensity_calibration,
+                                                 dimensional_calibrations=_crop_dimensional_calibrations(xdata.dimensional_calibrations, crop_slices),
+                                                 metadata=xdata.metadata,
+                                                 data_descriptor=xdata.data_descriptor)
+
+
 class ApplyShifts(MultiDimensionalProcessingComputation):
     computation_id = "nion.apply_shifts"
     label = _("Apply Shifts")
@@ -376,20 +684,18 @@ class ApplyShifts(MultiDimensionalProcessingComputation):
 
         return shift_axis
 
-    def execute(self, *, input_data_item: Symbolic.DataSource, shifts_data_item: Symbolic.DataSource, axes_description: str, crop_to_valid: bool, **kwargs: typing.Any) -> None: # type: ignore
-        input_xdata = input_data_item.xdata
-        assert input_xdata is not None
-        assert shifts_data_item.xdata is not None
-        assert shifts_data_item.data is not None
-        shifts_shape = shifts_data_item.xdata.data_shape
+    @staticmethod
+    def get_shifts_and_shift_axes(input_xdata: DataAndMetadata.DataAndMetadata, shifts_xdata: DataAndMetadata.DataAndMetadata, axes_description: str) -> typing.Tuple[_DataArrayType, typing.List[int]]:
+        assert shifts_xdata.data is not None
+        shifts_shape = shifts_xdata.data_shape
         # Handle the special case of shifts created by "AlignImageSequence" here: This computation calculates the shifts
         # for a 1D collection or a sequence of 2D data and transposes the result so that Swift can display it as a
         # line plot. Try to detect that case and transpose back.
         if len(shifts_shape) == 2 and shifts_shape[0] == 2 and shifts_shape[-1] == input_xdata.data_shape[0]:
             # HDF5 datasets don't implement .T, so convert to real numpy array first
-            shifts = numpy.asarray(shifts_data_item.data).T
+            shifts = numpy.asarray(shifts_xdata.data).T
         else:
-            shifts  = shifts_data_item.data
+            shifts  = shifts_xdata.data
         split_description = axes_description.split("-")
         shift_axis = split_description[0]
         if shift_axis == "collection":
@@ -407,27 +713,24 @@ class ApplyShifts(MultiDimensionalProcessingComputation):
             shift_axis_indices = list(input_xdata.datum_dimension_indexes)
         else:
             raise ValueError(f"Unknown shift axis: '{shift_axis}'.")
-        # Like this we directly write to the underlying storage and don't have to cache everything in memory first
-        result_data_item = self.computation.get_result('shifted')
-        if result_data_item.xdata.data_shape == input_xdata.data_shape:
-            MultiDimensionalProcessing.function_apply_multi_dimensional_shifts(input_xdata, shifts, tuple(shift_axis_indices), out=result_data_item.xdata)
-            result_xdata = result_data_item.xdata
-        else: # But if the shape in the data item does not match the input's shape we cannot do that
-            result_xdata = MultiDimensionalProcessing.function_apply_multi_dimensional_shifts(input_xdata, shifts, tuple(shift_axis_indices))
+        return shifts, shift_axis_indices
+
+    def execute(self, *, input_data_item: Symbolic.DataSource, shifts_data_item: Symbolic.DataSource, axes_description: str, crop_to_valid: bool, **kwargs: typing.Any) -> None: # type: ignore
+        input_xdata = input_data_item.xdata
+        assert input_xdata is not None
+        assert shifts_data_item.xdata is not None
+        shifts, shift_axis_indices = self.get_shifts_and_shift_axes(input_xdata, shifts_data_item.xdata, axes_description)
         if crop_to_valid:
-            shift_axis_shape = [input_xdata.data_shape[i] for i in range(len(input_xdata.data_shape)) if i in shift_axis_indices]
-            valid_area = calculate_valid_area_from_shifts(tuple(shift_axis_shape), shifts)
-            slice_tuple: typing.Tuple[slice, ...] = tuple()
-            k = 0
-            for i in range(len(input_xdata.data_shape)):
-                if i in shift_axis_indices:
-                    slice_tuple += (slice(valid_area[k], valid_area[k+2]),)
-                    k += 1
-                else:
-                    slice_tuple += (slice(0, None),)
-            self.__result_xdata = result_xdata[slice_tuple]
+            crop_slices = calculate_valid_area_slices(input_xdata.data_shape, shift_axis_indices, shifts)
+            result_shape = tuple(len(range(length)[crop_slice]) for length, crop_slice in zip(input_xdata.data_shape, crop_slices))
         else:
-            self.__result_xdata = result_xdata
+            result_shape = input_xdata.data_shape
+        # Like this we directly write to the underlying storage and don't have to cache everything in memory first.
+        # Each slice is cropped right after shifting it, so we never need the full shifted data.
+        result_data_item = self.computation.get_result('shifted')
+        out = result_data_item.xdata if result_data_item.xdata and result_data_item.xdata.data_shape == result_shape else None
+        # But if the shape in the data item does not match the result shape we have to create the result in memory
+        self.__result_xdata = function_apply_multi_dimensional_shifts(input_xdata, shifts, tuple(shift_axis_indices), out=out, crop_to_valid=crop_to_valid)
         settings_dict = computation_settings.setdefault(self.computation._computation.processing_id, dict())
         settings_dict["crop_to_valid"] = crop_to_valid
         return None
@@ -443,13 +746,19 @@ def apply_shifts(api: Facade.API_1, window: Facade.DocumentWindow, input_di: Fac
     input_xdata = input_di.xdata
     assert input_xdata
     assert input_xdata.data_dtype
-    data_item.reserve_data(data_shape=input_xdata.data_shape, data_dtype=input_xdata.data_dtype, data_descriptor=input_xdata.data_descriptor)
-    data_item.dimensional_calibrations = input_xdata.dimensional_calibrations
+    settings_dict = computation_settings.get("nion.align_and_integrate_image_sequence", dict())
+    # Reserve the result at the shape it will have after cropping, so that the computation can write into it directly
+    crop_slices = tuple(slice(0, None) for _ in input_xdata.data_shape)
+    if settings_dict.get("crop_to_valid", False) and shifts_di.xdata is not None:
+        shifts, shift_axis_indices = ApplyShifts.get_shifts_and_shift_axes(input_xdata, shifts_di.xdata, shift_axis)
+        crop_slices = calculate_valid_area_slices(input_xdata.data_shape, shift_axis_indices, shifts)
+    result_shape = tuple(len(range(length)[crop_slice]) for length, crop_slice in zip(input_xdata.data_shape, crop_slices))
+    data_item.reserve_data(data_shape=result_shape, data_dtype=input_xdata.data_dtype, data_descriptor=input_xdata.data_descriptor)
+    data_item.dimensional_calibrations = _crop_dimensional_calibrations(input_xdata.dimensional_calibrations, crop_slices)
     data_item.intensity_calibration = input_xdata.intensity_calibration
     data_item.metadata = copy.deepcopy(input_xdata.metadata)
     result_data_item = Facade.DataItem(data_item)
 
-    settings_dict = computation_settings.get("nion.align_and_integrate_image_sequence", dict())
     inputs = {"input_data_item": {"object": input_di, "type": "data_source"},
               "shifts_data_item": {"object": shifts_di, "type": "data_source"},
               "axes_description": shift_axis,
@@ -777,6 +1086,7 @@ class AlignImageSequence(Symbolic.ComputationHandlerLike):
               "reference_index": {"label": _("Reference index for shifts")},
               "relative_shifts": {"label": _("Measure shifts relative to previous slice")},
               "max_shift": {"label": _("Max shift between consecutive frames (in pixels, <= 0 to disable)")},
+              "num_workers": {"label": _("Number of worker threads (<= 0 for automatic)")},
               "show_shifted_output": {"label": _("Show shifted output")},
               "crop_to_valid": {"label": _("Crop result to valid area")},
               "bounds_graphic": {"label": _("Shift bounds")},
@@ -789,7 +1099,7 @@ class AlignImageSequence(Symbolic.ComputationHandlerLike):
     def __init__(self, computation: typing.Any, **kwargs: typing.Any) -> None:
         self.computation = computation
 
-    def execute(self, *, input_data_item: Symbolic.DataSource, reference_index: typing.Optional[int] = None, relative_shifts: bool=True, max_shift: int=0, show_shifted_output: bool = False, crop_to_valid: bool = True, bounds_graphic: typing.Optional[Facade.Graphic]=None, **kwargs: typing.Any) -> None: # type: ignore
+    def execute(self, *, input_data_item: Symbolic.DataSource, reference_index: typing.Optional[int] = None, relative_shifts: bool=True, max_shift: int=0, num_workers: int=0, show_shifted_output: bool = False, crop_to_valid: bool = True, bounds_graphic: typing.Optional[Facade.Graphic]=None, **kwargs: typing.Any) -> None: # type: ignore
         input_xdata = input_data_item.xdata
         assert input_xdata is not None
         bounds = None
@@ -799,15 +1109,12 @@ class AlignImageSequence(Symbolic.ComputationHandlerLike):
         reference_index = reference_index if not relative_shifts else None
         shifts_axes = tuple(input_xdata.datum_dimension_indexes)
         assert len(shifts_axes) == 2, "This computation only works for sequences and collections of 2D data."
-        shifts_xdata = MultiDimensionalProcessing.function_measure_multi_dimensional_shifts(input_xdata, shifts_axes, reference_index=reference_index, bounds=bounds, max_shift=max_shift_)
+        shifts_xdata = function_measure_multi_dimensional_shifts(input_xdata, shifts_axes, reference_index=reference_index, bounds=bounds, max_shift=max_shift_, num_workers=num_workers)
         self.__valid_area_tlbr: typing.Optional[typing.Tuple[int, int, int, int]] = calculate_valid_area_from_shifts(input_xdata.datum_dimension_shape, shifts_xdata.data)
         self.__shifts_xdata = Core.function_transpose_flip(shifts_xdata, transpose=True, flip_v=False, flip_h=False)
-        aligned_input_xdata = MultiDimensionalProcessing.function_apply_multi_dimensional_shifts(input_xdata, shifts_xdata.data, shifts_axes)
-        assert aligned_input_xdata is not None
+        aligned_input_xdata = function_apply_multi_dimensional_shifts(input_xdata, shifts_xdata.data, shifts_axes, crop_to_valid=crop_to_valid)
         aligned_input_xdata._set_metadata(input_xdata.metadata)
         if crop_to_valid:
-            top, left, bottom, right = self.__valid_area_tlbr
-            aligned_input_xdata = aligned_input_xdata[..., top:bottom, left:right]
             self.__valid_area_tlbr = None
         self.__integrated_input_xdata = Core.function_sum(aligned_input_xdata, axis=0)
         self.__integrated_input_xdata._set_metadata(input_xdata.metadata)
@@ -818,6 +1125,7 @@ class AlignImageSequence(Symbolic.ComputationHandlerLike):
         settings_dict["reference_index"] = reference_index or 0
         settings_dict["relative_shifts"] = relative_shifts
         settings_dict["max_shift"] = max_shift
+        settings_dict["num_workers"] = num_workers
         settings_dict["show_shifted_output"] = show_shifted_output
         settings_dict["crop_to_valid"] = crop_to_valid
         return None
@@ -867,13 +1175,14 @@ class AlignImageSequence(Symbolic.ComputationHandlerLike):
 
 def align_image_sequence(api: Facade.API_1, window: Facade.DocumentWindow, data_item: Facade.DataItem,
                          reference_index: int, relative_shifts: bool, max_shift: int, show_shifted_output: bool,
-                         crop_to_valid: bool, bounds_graphic: Facade.Graphic | None) -> tuple[Facade.DataItem, Facade.DataItem, Facade.DataItem | None]:
+                         crop_to_valid: bool, bounds_graphic: Facade.Graphic | None, num_workers: int = 0) -> tuple[Facade.DataItem, Facade.DataItem, Facade.DataItem | None]:
     result_data_item = api.library.create_data_item()
     shifts = api.library.create_data_item_from_data(numpy.zeros((2, 2)))  # create real data so we can update the display below
     inputs = {"input_data_item": {"object": data_item, "type": "data_source"},
               "reference_index": reference_index,
               "relative_shifts": relative_shifts,
               "max_shift": max_shift,
+              "num_workers": num_workers,
               "show_shifted_output": show_shifted_output,
               "crop_to_valid": crop_to_valid
               }
@@ -943,7 +1252,8 @@ class AlignImageSequenceMenuItemDelegate:
                                  settings_dict.get("max_shift", 0),
                                  settings_dict.get("show_shifted_output", False),
                                  settings_dict.get("crop_to_valid", True),
-                                 bounds_graphic)
+                                 bounds_graphic,
+                                 settings_dict.get("num_workers", 0))
         except Exception as e:
             import traceback
             traceback.print_exc()
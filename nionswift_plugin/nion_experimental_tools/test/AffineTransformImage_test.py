@@ -3,9 +3,11 @@ import typing
 import unittest
 
 import numpy
+import scipy.ndimage
 
 # local libraries
 from nion.swift import Facade
+from nion.data import Core
 from nion.data import DataAndMetadata
 from nion.swift.test import TestContext
 from nion.ui import TestUI
@@ -165,3 +167,67 @@ class TestAffineTransformImage(unittest.TestCase):
             self.assertEqual(len(data_item.graphics), 2)
             self.assertEqual(api.library.data_item_count, 2)
             self.assertTrue(numpy.allclose(document_model.data_items[1].data, numpy.rot90(data, axes=(1, 2))))
+
+    def test_warp_frames_matches_map_coordinates(self):
+        matrix = numpy.array(((1.1, 0.3), (-0.2, 0.9)))
+        coordinates = numpy.stack([c.data for c in Core.calculate_coordinates_for_affine_transform(numpy.empty((7, 6)), matrix)])
+        rng = numpy.random.default_rng(0)
+        for dtype in (numpy.float32, numpy.float64, numpy.uint8):
+            for frame_axis in (0, 1, 2):
+                with self.subTest(dtype=dtype, frame_axis=frame_axis):
+                    shape = [3, 4, 2]
+                    shape[frame_axis:frame_axis] = [7, 6]
+                    data = (rng.random(shape) * 200).astype(dtype)
+                    frames = numpy.moveaxis(data, (frame_axis, frame_axis + 1), (0, 1))
+                    expected = numpy.empty_like(frames)
+                    for index in numpy.ndindex(frames.shape[2:]):
+                        expected[(...,) + index] = scipy.ndimage.map_coordinates(frames[(...,) + index], coordinates, order=1, output=dtype)
+                    expected = numpy.moveaxis(expected, (0, 1), (frame_axis, frame_axis + 1))
+                    result = AffineTransformImage.function_warp_frames(data, frame_axis, AffineTransformImage.WarpPlan(coordinates), num_workers=3)
+                    self.assertEqual(dtype, result.dtype)
+                    # exact half-way values of integer data may round either way depending on the summation order
+                    atol = 1 if dtype == numpy.uint8 else 1e-5
+                    self.assertTrue(numpy.allclose(expected.astype(float), result.astype(float), atol=atol))
+
+    def test_warp_plan_is_cached_per_matrix_and_frame_shape(self):
+        hits = AffineTransformImage.warp_plan_cache.hits
+        matrix = numpy.array(((0.0, 1.0), (1.0, 0.0)))
+        warp_plan = AffineTransformImage.get_warp_plan(matrix, (5, 4))
+        self.assertIs(warp_plan, AffineTransformImage.get_warp_plan(matrix.copy(), (5, 4)))
+        self.assertIsNot(warp_plan, AffineTransformImage.get_warp_plan(matrix, (4, 5)))
+        self.assertIsNot(warp_plan, AffineTransformImage.get_warp_plan(matrix * 2, (5, 4)))
+        self.assertEqual(hits + 1, AffineTransformImage.warp_plan_cache.hits)
+        data = numpy.random.default_rng(1).random((3, 5, 4))
+        new_coords = Core.calculate_coordinates_for_affine_transform(numpy.empty((5, 4)), matrix)
+        for frame, warped_frame in zip(data, AffineTransformImage.function_warp_frames(data, 1, warp_plan)):
+            expected = scipy.ndimage.map_coordinates(frame, numpy.stack([new_coords[0].data, new_coords[1].data]), order=1)
+            self.assertTrue(numpy.allclose(expected, warped_frame))
+
+    def test_warp_plan_in_single_precision_for_single_precision_data(self):
+        matrix = numpy.array(((1.1, 0.3), (-0.2, 0.9)))
+        self.assertEqual(numpy.float32, AffineTransformImage.get_warp_dtype(numpy.float32))
+        self.assertEqual(numpy.float64, AffineTransformImage.get_warp_dtype(numpy.uint16))
+        warp_plan = AffineTransformImage.get_warp_plan(matrix, (7, 6), numpy.float32)
+        self.assertEqual(numpy.float32, warp_plan.matrix.dtype)
+        self.assertIsNot(warp_plan, AffineTransformImage.get_warp_plan(matrix, (7, 6)))
+        coordinates = numpy.stack([c.data for c in Core.calculate_coordinates_for_affine_transform(numpy.empty((7, 6)), matrix)])
+        data = numpy.random.default_rng(3).random((40, 7, 6)).astype(numpy.float32)
+        result = AffineTransformImage.function_warp_frames(data, 1, warp_plan)
+        self.assertEqual(numpy.float32, result.dtype)
+        for frame, warped_frame in zip(data, result):
+            self.assertTrue(numpy.allclose(scipy.ndimage.map_coordinates(frame, coordinates, order=1), warped_frame, atol=1e-6))
+
+    def test_map_frames_matches_warp_frames(self):
+        matrix = numpy.array(((1.1, 0.3), (-0.2, 0.9)))
+        coordinates = numpy.stack([c.data for c in Core.calculate_coordinates_for_affine_transform(numpy.empty((7, 6)), matrix)])
+        data = numpy.random.default_rng(2).random((3, 7, 6, 2))
+        expected = AffineTransformImage.function_warp_frames(data, 1, AffineTransformImage.WarpPlan(coordinates))
+        self.assertTrue(numpy.allclose(expected, AffineTransformImage.function_map_frames(data, 1, coordinates)))
+
+    def test_warp_plan_cache_is_bounded_by_bytes(self):
+        matrix = numpy.array(((0.9, 0.1), (0.1, 0.9)))
+        warp_plan = AffineTransformImage.get_warp_plan(matrix, (64, 64))
+        sparse_matrix = warp_plan.matrix
+        self.assertEqual(sparse_matrix.data.nbytes + sparse_matrix.indices.nbytes + sparse_matrix.indptr.nbytes, warp_plan.nbytes)
+        self.assertIsNotNone(AffineTransformImage.warp_plan_cache.max_bytes)
+        self.assertLessEqual(AffineTransformImage.warp_plan_cache.nbytes, typing.cast(int, AffineTransformImage.warp_plan_cache.max_bytes))
@@ -0,0 +1,46 @@
+import unittest
+
+import numpy
+
+from nionswift_plugin.nion_experimental_tools import DPCRotation
+
+
+def rotate(com_x: numpy.typing.NDArray[numpy.float64], com_y: numpy.typing.NDArray[numpy.float64], rotation: float) -> tuple[numpy.typing.NDArray[numpy.float64], numpy.typing.NDArray[numpy.float64]]:
+    return com_x * numpy.cos(rotation) - com_y * numpy.sin(rotation), com_x * numpy.sin(rotation) + com_y * numpy.cos(rotation)
+
+
+def mean_squared_curl(com_x: numpy.typing.NDArray[numpy.float64], com_y: numpy.typing.NDArray[numpy.float64], rotation: float) -> float:
+    com_x_rotated, com_y_rotated = rotate(com_x, com_y, rotation)
+    return float(numpy.mean((numpy.gradient(com_y_rotated, axis=1) - numpy.gradient(com_x_rotated, axis=0)) ** 2))
+
+
+class TestDPCRotation(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = numpy.random.default_rng(5)
+        potential = numpy.cumsum(numpy.cumsum(rng.normal(size=(30, 40)), axis=0), axis=1)
+        self.com_x = numpy.gradient(potential, axis=1)
+        self.com_y = numpy.gradient(potential, axis=0)
+
+    def test_mean_squared_curl_from_curl_terms_matches_direct_calculation(self) -> None:
+        curl_terms = DPCRotation.calculate_curl_terms(self.com_x, self.com_y)
+        for rotation in numpy.linspace(0, 2 * numpy.pi, 7):
+            self.assertAlmostEqual(mean_squared_curl(self.com_x, self.com_y, rotation), DPCRotation.calculate_mean_squared_curl(rotation, curl_terms))
+
+    def test_calculate_rotation_finds_rotation_of_curl_free_field(self) -> None:
+        for rotation in (0.3, 1.9, 4.0):
+            with self.subTest(rotation=rotation):
+                com_x, com_y = rotate(self.com_x, self.com_y, rotation)
+                calculated_rotation = DPCRotation.calculate_rotation(com_x, com_y)
+                self.assertTrue(0 <= calculated_rotation < numpy.pi)
+                self.assertAlmostEqual((-rotation) % numpy.pi, calculated_rotation, places=6)
+                brute_force = min(mean_squared_curl(com_x, com_y, r) for r in numpy.linspace(0, numpy.pi, 721))
+                self.assertLessEqual(mean_squared_curl(com_x, com_y, calculated_rotation), brute_force + 1e-12)
+
+    def test_get_rotation_is_cached_for_the_same_field(self) -> None:
+        misses = DPCRotation.rotation_cache.misses
+        rotation = DPCRotation.get_rotation(self.com_x, self.com_y)
+        self.assertEqual(rotation, DPCRotation.get_rotation(self.com_x.copy(), self.com_y.copy()))
+        self.assertEqual(misses + 1, DPCRotation.rotation_cache.misses)
+        DPCRotation.get_rotation(-self.com_x, self.com_y)
+        self.assertEqual(misses + 2, DPCRotation.rotation_cache.misses)
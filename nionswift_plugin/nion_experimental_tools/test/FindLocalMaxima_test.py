@@ -0,0 +1,44 @@
+import unittest
+
+import numpy
+
+from nionswift_plugin.nion_experimental_tools import FindLocalMaxima
+
+
+class TestFindLocalMaxima(unittest.TestCase):
+
+    def test_function_find_local_maxima_keeps_equal_maxima_in_raster_order(self):
+        data = numpy.zeros((40, 40))
+        data[[5, 20, 30, 10], [30, 5, 30, 10]] = [1.0, 2.0, 1.0, 1.0]
+
+        maxima, values = FindLocalMaxima.function_find_local_maxima(data, number_maxima=3)
+
+        self.assertSequenceEqual([(20, 5), (5, 30), (10, 10)], maxima)
+        self.assertSequenceEqual([2.0, 1.0, 1.0], values)
+
+    def test_function_find_local_maxima_refines_to_subpixel_positions(self):
+        y, x = numpy.mgrid[:32, :32]
+        data = numpy.exp(-((y - 12.3) ** 2 + (x - 20.8) ** 2) / 8.0)
+
+        maxima, values = FindLocalMaxima.function_find_local_maxima(data, number_maxima=1, subpixel=True)
+
+        self.assertAlmostEqual(12.3, maxima[0][0], delta=0.05)
+        self.assertAlmostEqual(20.8, maxima[0][1], delta=0.05)
+
+    def test_function_find_local_maxima_batch_returns_peak_table_per_frame(self):
+        data = numpy.zeros((2, 3, 30, 30))
+        data[0, 1, [8, 20], [8, 15]] = [1.0, 2.0]
+        data[1, 2, 10, 10] = 1.0
+
+        positions, values = FindLocalMaxima.function_find_local_maxima_batch(data, number_maxima=2)
+
+        self.assertEqual((2, 3, 2, 2), positions.shape)
+        self.assertEqual((2, 3, 2), values.shape)
+        self.assertTrue(numpy.array_equal([[20, 15], [8, 8]], positions[0, 1]))
+        self.assertTrue(numpy.array_equal([2.0, 1.0], values[0, 1]))
+        self.assertTrue(numpy.array_equal([10, 10], positions[1, 2, 0]))
+        self.assertTrue(numpy.all(numpy.isnan(positions[1, 2, 1])))
+        self.assertTrue(numpy.all(numpy.isnan(values[0, 0])))
+        for index in numpy.ndindex(2, 3):
+            maxima, frame_values = FindLocalMaxima.function_find_local_maxima(data[index], number_maxima=2)
+            self.assertSequenceEqual(frame_values, values[index][:len(frame_values)].tolist())
@@ -1,11 +1,15 @@
 import gettext
+import io
 import typing
 import unittest
 
+import h5py
 import numpy
 
 # local libraries
 from nion.data import DataAndMetadata
+from nion.data import MultiDimensionalProcessing as MultiDimensionalProcessingData
+from nion.experimental import Registration
 from nion.swift import Application
 from nion.swift import Facade
 from nion.swift.model import DataItem
@@ -203,6 +207,32 @@ class TestMultiDimensionalProcessing(unittest.TestCase):
             # the region will cover the centers of the middle two pixels vertically x three pixels horizontally = 6.0
             self.assertTrue(numpy.allclose(integrated.data, 6.0))
 
+    def test_function_integrate_along_axis_chunked_matches_integrate_along_axis(self) -> None:
+        rng = numpy.random.default_rng(42)
+        data = rng.random((9, 7, 12, 11)).astype(numpy.float32)
+        data_descriptor = DataAndMetadata.DataDescriptor(False, 2, 2)
+        xdata = DataAndMetadata.new_data_and_metadata(data, data_descriptor=data_descriptor)
+        for integration_axes in [(2, 3), (0, 1), (0,), (3,), (1, 2)]:
+            integration_mask = rng.random(tuple(data.shape[i] for i in integration_axes)) > 0.5
+            for mask in [None, integration_mask]:
+                expected = MultiDimensionalProcessingData.function_integrate_along_axis(xdata, integration_axes, mask)
+                for memory_budget in [1, 2000, 20000, 1024 * 1024]:
+                    with self.subTest(integration_axes=integration_axes, mask=mask is not None, memory_budget=memory_budget):
+                        integrated = MultiDimensionalProcessing.function_integrate_along_axis_chunked(xdata, integration_axes, mask, memory_budget)
+                        self.assertEqual(integrated.data_descriptor, expected.data_descriptor)
+                        self.assertEqual(integrated.data.dtype, expected.data.dtype)
+                        self.assertTrue(numpy.array_equal(integrated.data, expected.data))
+
+    def test_function_integrate_along_axis_chunked_reads_hdf5_dataset(self) -> None:
+        data = numpy.random.default_rng(7).random((6, 5, 8, 9))
+        data_descriptor = DataAndMetadata.DataDescriptor(False, 2, 2)
+        with h5py.File(io.BytesIO(), "w") as fp:
+            dataset = fp.create_dataset("data", data=data)
+            xdata = DataAndMetadata.new_data_and_metadata(dataset, data_descriptor=data_descriptor)
+            integrated = MultiDimensionalProcessing.function_integrate_along_axis_chunked(xdata, (2, 3), memory_budget=1000)
+        expected = MultiDimensionalProcessingData.function_integrate_along_axis(DataAndMetadata.new_data_and_metadata(data, data_descriptor=data_descriptor), (2, 3))
+        self.assertTrue(numpy.array_equal(integrated.data, expected.data))
+
     def test_align_si_computation(self) -> None:
         with create_memory_profile_context() as test_context:
             document_controller = test_context.create_document_controller_with_application()
@@ -260,6 +290,20 @@ class TestMultiDimensionalProcessing(unittest.TestCase):
             self.assertIn("(Align and Integrate SI Sequence - Integrated SI)", aligned_si.title)
             self.assertIn("Measured Shifts", shifts.title)
 
+    def test_integrate_shifted_sequence_matches_apply_shifts_and_sum(self) -> None:
+        rng = numpy.random.default_rng(3)
+        si_xdata = DataAndMetadata.new_data_and_metadata(rng.random((5, 8, 9, 16)), data_descriptor=DataAndMetadata.DataDescriptor(True, 2, 1))
+        shifts = rng.normal(size=(5, 2)) * 2
+        aligned_si_xdata = MultiDimensionalProcessingData.function_apply_multi_dimensional_shifts(si_xdata, shifts, (1, 2))
+        assert aligned_si_xdata
+        expected = numpy.sum(aligned_si_xdata.data, axis=0)
+        integrated_si_xdata = AlignMultiSI.function_integrate_shifted_sequence(si_xdata, shifts, (1, 2))
+        self.assertTrue(numpy.allclose(expected, integrated_si_xdata.data))
+        self.assertEqual(si_xdata.dimensional_calibrations[1:], integrated_si_xdata.dimensional_calibrations)
+        weights = rng.random(5)
+        weighted_si_xdata = AlignMultiSI.function_integrate_shifted_sequence(si_xdata, shifts, (1, 2), weights=weights)
+        self.assertTrue(numpy.allclose(numpy.tensordot(weights, aligned_si_xdata.data, axes=1), weighted_si_xdata.data))
+
     def test_align_sequence_of_multi_dim_data_computation(self) -> None:
         with create_memory_profile_context() as test_context:
             document_controller = test_context.create_document_controller_with_application()
@@ -307,6 +351,35 @@ class TestMultiDimensionalProcessing(unittest.TestCase):
             self.assertIn("Double Gaussian", result_data_item.title)
             self.assertIn("Filtered FFT", fft_data_item.title)
 
+    def test_double_gaussian_computation_for_sequence(self) -> None:
+        with create_memory_profile_context() as test_context:
+            document_controller = test_context.create_document_controller_with_application()
+            document_model = document_controller.document_model
+            api = Facade.get_api("~1.0", "~1.0")
+            # setup
+            data = numpy.random.randn(3, 8, 10).astype(numpy.float32)
+            data_item = DataItem.new_data_item(DataAndMetadata.new_data_and_metadata(data, data_descriptor=DataAndMetadata.DataDescriptor(True, 0, 2)))
+            document_model.append_data_item(data_item)
+            # make computation and execute
+            result_data_item, fft_data_item = DoubleGaussian.double_gaussian(api, Facade.DocumentWindow(document_controller), Facade.DataItem(data_item))
+            document_model.recompute_all()
+            document_controller.periodic()
+            # check results
+            self.assertFalse(any(computation.error_text for computation in document_model.computations))
+            self.assertEqual(data.shape, result_data_item.data.shape)
+            self.assertEqual(numpy.float32, result_data_item.data.dtype)
+            self.assertTrue(result_data_item.xdata.is_sequence)
+            self.assertEqual((8, 10), fft_data_item.data.shape)
+            for frame, filtered_frame in zip(data, result_data_item.data):
+                expected, _ = DoubleGaussian.function_double_gaussian(frame.astype(numpy.float64), 0.5, 0.3, 0.3)
+                self.assertTrue(numpy.allclose(expected, filtered_frame, atol=1e-5))
+
+    def test_double_gaussian_keeps_the_mean_of_each_frame(self) -> None:
+        data = numpy.random.randn(2, 3, 16, 16)
+        filtered, filtered_fft = DoubleGaussian.function_double_gaussian(data, 0.5, 0.3, 0.3)
+        self.assertTrue(numpy.allclose(numpy.mean(data, axis=(-2, -1)), numpy.mean(filtered, axis=(-2, -1))))
+        self.assertEqual((16, 16), filtered_fft.shape)
+
     def test_find_local_maxima_computation(self) -> None:
         with create_memory_profile_context() as test_context:
             document_controller = test_context.create_document_controller_with_application()
@@ -367,6 +440,43 @@ class TestMultiDimensionalProcessing(unittest.TestCase):
             self.assertFalse(any(computation.error_text for computation in document_model.computations))
             self.assertIn("iDPC", idpc_data_item.title)
 
+    def test_iDPC_computation_for_sequence_of_dpc_pairs(self) -> None:
+        with create_memory_profile_context() as test_context:
+            document_controller = test_context.create_document_controller_with_application()
+            document_model = document_controller.document_model
+            api = Facade.get_api("~1.0", "~1.0")
+            # setup
+            data = numpy.random.randn(3, 2, 8, 8).astype(numpy.float32)
+            xdata = DataAndMetadata.new_data_and_metadata(data, data_descriptor=DataAndMetadata.DataDescriptor(True, 1, 2))
+            data_item = DataItem.new_data_item(xdata)
+            document_model.append_data_item(data_item)
+            # make computation and execute
+            idpc_data_item = MakeIDPC.iDPC(api, Facade.DocumentWindow(document_controller), Facade.DataItem(data_item))
+            document_model.recompute_all()
+            document_controller.periodic()
+            # check results
+            self.assertFalse(any(computation.error_text for computation in document_model.computations))
+            self.assertTrue(idpc_data_item.xdata.is_sequence)
+            self.assertEqual((3, 6, 6), idpc_data_item.data.shape)
+            self.assertEqual(numpy.float32, idpc_data_item.data.dtype)
+
+    def test_function_integrate_dpc_matches_full_fft_integration(self) -> None:
+        rng = numpy.random.default_rng(0)
+        for shape in ((8, 8), (9, 12), (2, 7, 9)):
+            with self.subTest(shape=shape):
+                gradx = rng.standard_normal(shape)
+                grady = rng.standard_normal(shape)
+                freqs = numpy.meshgrid(numpy.fft.fftfreq(shape[-1], d=2.0), numpy.fft.fftfreq(shape[-2], d=0.5))
+                freq_squared = freqs[0] ** 2 + freqs[1] ** 2
+                freq_squared[0, 0] = 1.0
+                fft_idpc = (numpy.fft.fft2(gradx) * freqs[0] + numpy.fft.fft2(grady) * freqs[1]) / (1j * freq_squared)
+                fft_idpc[..., 0, 0] = 0.0
+                expected = numpy.real(numpy.fft.ifft2(fft_idpc))
+                self.assertTrue(numpy.allclose(expected, MakeIDPC.function_integrate_dpc(gradx, grady, (0.5, 2.0))))
+                idpc = MakeIDPC.function_integrate_dpc(gradx.astype(numpy.float32), grady.astype(numpy.float32), (0.5, 2.0))
+                self.assertEqual(numpy.float32, idpc.dtype)
+                self.assertTrue(numpy.allclose(expected, idpc, atol=1e-5))
+
     def test_measure_shifts_computation_and_apply_shifts_computation(self) -> None:
         with self.subTest(msg="Test for a sequence of 2D data. Measure shifts in data axis."):
             with create_memory_profile_context() as test_context:
@@ -420,6 +530,79 @@ class TestMultiDimensionalProcessing(unittest.TestCase):
                 self.assertFalse(any(computation.error_text for computation in document_model.computations))
                 self.assertIn("(Apply Shifts)", shifted_data_item.title)
 
+    def test_function_measure_multi_dimensional_shifts_does_not_depend_on_num_workers(self) -> None:
+        rng = numpy.random.default_rng(3)
+        data = rng.random((12, 16, 16))
+        xdata = DataAndMetadata.new_data_and_metadata(data, data_descriptor=DataAndMetadata.DataDescriptor(True, 0, 2))
+        for reference_index, max_shift in [(None, None), (None, 3), (0, None), (0, 3), (11, 3), (5, 3)]:
+            expected = MultiDimensionalProcessingData.function_measure_multi_dimensional_shifts(xdata, (1, 2), reference_index=reference_index, max_shift=max_shift)
+            for num_workers in [1, 2, 5, 32]:
+                with self.subTest(reference_index=reference_index, max_shift=max_shift, num_workers=num_workers):
+                    shifts = MultiDimensionalProcessing.function_measure_multi_dimensional_shifts(xdata, (1, 2), reference_index=reference_index, max_shift=max_shift, num_workers=num_workers)
+                    self.assertTrue(numpy.array_equal(shifts.data, expected.data))
+
+    def test_function_measure_multi_dimensional_shifts_shares_reference_between_workers(self) -> None:
+        rng = numpy.random.default_rng(4)
+        cache = Registration.registration_cache
+        for data_shape, data_descriptor, shift_axes in [((12, 16, 16), DataAndMetadata.DataDescriptor(True, 0, 2), (1, 2)),
+                                                         ((12, 40), DataAndMetadata.DataDescriptor(True, 0, 1), (1,))]:
+            with self.subTest(data_shape=data_shape):
+                xdata = DataAndMetadata.new_data_and_metadata(rng.random(data_shape), data_descriptor=data_descriptor)
+                expected = MultiDimensionalProcessingData.function_measure_multi_dimensional_shifts(xdata, shift_axes, reference_index=4)
+                misses, length = cache.misses, len(cache)
+                shifts = MultiDimensionalProcessing.function_measure_multi_dimensional_shifts(xdata, shift_axes, reference_index=4, num_workers=4)
+                self.assertTrue(numpy.array_equal(shifts.data, expected.data))
+                # the reference is neither hashed nor looked up in the cache
+                self.assertEqual((misses, length), (cache.misses, len(cache)))
+
+    def test_function_apply_multi_dimensional_shifts_crops_to_valid_area(self) -> None:
+        rng = numpy.random.default_rng(5)
+        for data_descriptor, data_shape, shift_axes, shifts_shape in [(DataAndMetadata.DataDescriptor(True, 0, 2), (6, 20, 22), (1, 2), (6, 2)),
+                                                                      (DataAndMetadata.DataDescriptor(True, 2, 1), (4, 9, 10, 7), (1, 2), (4, 2)),
+                                                                      (DataAndMetadata.DataDescriptor(False, 2, 1), (9, 10, 30), (2,), (9, 10))]:
+            with self.subTest(data_shape=data_shape, shift_axes=shift_axes):
+                xdata = DataAndMetadata.new_data_and_metadata(rng.random(data_shape), data_descriptor=data_descriptor)
+                shifts = rng.normal(size=shifts_shape)
+                expected = MultiDimensionalProcessingData.function_apply_multi_dimensional_shifts(xdata, shifts, shift_axes)
+                expected = expected[MultiDimensionalProcessing.calculate_valid_area_slices(data_shape, shift_axes, shifts)]
+                shifted = MultiDimensionalProcessing.function_apply_multi_dimensional_shifts(xdata, shifts, shift_axes, crop_to_valid=True)
+                self.assertSequenceEqual(shifted.data_shape, expected.data_shape)
+                self.assertTrue(numpy.array_equal(shifted.data, expected.data))
+                self.assertEqual(shifted.dimensional_calibrations, expected.dimensional_calibrations)
+                out = DataAndMetadata.new_data_and_metadata(numpy.zeros(expected.data_shape), data_descriptor=data_descriptor)
+                MultiDimensionalProcessing.function_apply_multi_dimensional_shifts(xdata, shifts, shift_axes, out=out, crop_to_valid=True)
+                self.assertTrue(numpy.array_equal(out.data, expected.data))
+
+    def test_apply_shifts_computation_writes_cropped_result(self) -> None:
+        with create_memory_profile_context() as test_context:
+            document_controller = test_context.create_document_controller_with_application()
+            document_model = document_controller.document_model
+            api = Facade.get_api("~1.0", "~1.0")
+            xdata = DataAndMetadata.new_data_and_metadata(numpy.random.randn(5, 16, 16), data_descriptor=DataAndMetadata.DataDescriptor(True, 0, 2))
+            data_item = DataItem.new_data_item(xdata)
+            document_model.append_data_item(data_item)
+            shifts = numpy.array([[0.0, 0.0], [1.5, -2.0], [3.0, 1.0], [-1.0, 0.5], [0.0, 2.5]])
+            shifts_data_item = DataItem.new_data_item(DataAndMetadata.new_data_and_metadata(shifts))
+            document_model.append_data_item(shifts_data_item)
+            settings_dict = MultiDimensionalProcessing.computation_settings.setdefault("nion.align_and_integrate_image_sequence", dict())
+            old_crop_to_valid = settings_dict.get("crop_to_valid")
+            settings_dict["crop_to_valid"] = True
+            try:
+                shifted_data_item = MultiDimensionalProcessing.apply_shifts(api, Facade.DocumentWindow(document_controller), Facade.DataItem(data_item), Facade.DataItem(shifts_data_item), "data")
+            finally:
+                if old_crop_to_valid is None:
+                    settings_dict.pop("crop_to_valid")
+                else:
+                    settings_dict["crop_to_valid"] = old_crop_to_valid
+            # the result is reserved at the cropped shape: rows 3 to 15 and columns 3 to 14
+            self.assertSequenceEqual(shifted_data_item.xdata.data_shape, (5, 12, 11))
+            document_model.recompute_all()
+            document_controller.periodic()
+            self.assertFalse(any(computation.error_text for computation in document_model.computations))
+            expected = MultiDimensionalProcessingData.function_apply_multi_dimensional_shifts(xdata, shifts, (1, 2))
+            self.assertTrue(numpy.array_equal(shifted_data_item.xdata.data, expected.data[:, 3:15, 3:14]))
+            self.assertAlmostEqual(shifted_data_item.xdata.dimensional_calibrations[1].offset, 3.0)
+
     def test_crop_multidimensional_computation(self) -> None:
         with create_memory_profile_context() as test_context:
             document_controller = test_context.create_document_controller_with_application()